@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: how long `import hl7validator` takes, per module.
+
+Runs `python -X importtime -c "import hl7validator"` in fresh interpreters and
+reports the total and the slowest modules, like `-X importtime` does but
+sorted and averaged. Exits with 1 when the total goes over the budget, so it
+can gate CI.
+
+    python benchmarks/import_time.py --budget-ms 400
+    IMPORT_TIME_BUDGET_MS=400 python benchmarks/import_time.py
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+# Loaded on first use only, importing the package must not pull them in
+LAZY_MODULES = ["pandas", "flasgger", "flask_babel"]
+
+
+def import_times(module="hl7validator"):
+    """
+    Cumulative import time in microseconds of every module imported by `import module`,
+    from a fresh interpreter
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "WARMUP": "false"},
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative)
+        except ValueError:
+            continue
+    return times
+
+
+def measure(module="hl7validator", runs=5):
+    """
+    Import times averaged over several runs
+    :return: dict of module name to cumulative microseconds
+    """
+    totals = defaultdict(int)
+    for _ in range(runs):
+        for name, us in import_times(module).items():
+            totals[name] += us
+    return {name: us // runs for name, us in totals.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the import time of hl7validator")
+    parser.add_argument("--module", default="hl7validator")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=float(os.getenv("IMPORT_TIME_BUDGET_MS", 500)),
+        help="fail when the import takes longer (env IMPORT_TIME_BUDGET_MS, default 500)",
+    )
+    args = parser.parse_args(argv)
+
+    times = measure(args.module, args.runs)
+    total_ms = times[args.module] / 1000
+
+    print(f"{'cumulative [ms]':>16} | module")
+    for name, us in sorted(times.items(), key=lambda item: item[1], reverse=True)[: args.top]:
+        print(f"{us / 1000:16.1f} | {name}")
+
+    failed = False
+    eager = [name for name in LAZY_MODULES if name in times]
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"FAIL: import {args.module} took {total_ms:.1f}ms, budget is {args.budget_ms:.0f}ms")
+        failed = True
+    else:
+        print(f"OK: import {args.module} took {total_ms:.1f}ms, budget is {args.budget_ms:.0f}ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Rendering benchmark: highlight and tree views of growing ORU messages.
+
+Times render_message (one pass for both views, eager tree) against the
+separate highlight_message and build_tree_structure calls on messages with
+more and more OBX segments, and reports the time per segment. Validation is
+done beforehand and not timed. Exits with 1 when the time per segment of the
+largest message grows more than --max-growth times over the smallest one,
+i.e. when rendering stops scaling linearly.
+
+    python benchmarks/render.py --sizes 250 500 1000 2000
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from hl7validator import app
+from hl7validator.api import (
+    ValidationContext,
+    hl7validatorapi,
+    highlight_message,
+    build_tree_structure,
+    render_message,
+)
+
+HEADER = (
+    "MSH|^~\\&|LAB|HCIS|EHR|HCIS|20240101000000||ORU^R01^ORU_R01|1|P|2.5\r"
+    "PID|||1^^^HCIS||DOE^JOHN||19700101|M\r"
+    "OBR|1||42|GLU^Glucose^LN"
+)
+OBX = "OBX|{i}|NM|GLU^Glucose^LN||{i}.5|mg/dL^mg/dL|70-110|N|||F"
+
+
+def oru(observations):
+    return "\r".join([HEADER] + [OBX.format(i=i) for i in range(1, observations + 1)])
+
+
+def timed(render, msg):
+    """
+    Seconds to render msg, from a fresh context so every run parses the segments
+    """
+    context = ValidationContext(msg)
+    validation = hl7validatorapi(msg, context=context)
+    start = time.perf_counter()
+    render(msg, validation, context)
+    return time.perf_counter() - start
+
+
+def separate(msg, validation, context):
+    _, validation = highlight_message(msg, validation, context=context)
+    return build_tree_structure(msg, validation, context=context)
+
+
+def single_pass(msg, validation, context):
+    return render_message(msg, validation, context=context)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure highlight and tree rendering time")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[250, 500, 1000, 2000], help="OBX segments")
+    parser.add_argument("--max-growth", type=float, default=1.5, help="allowed growth of the time per segment")
+    args = parser.parse_args(argv)
+    app.logger.setLevel(logging.CRITICAL)
+
+    print(f"{'segments':>9} | {'separate [ms]':>13} | {'single pass [ms]':>16} | {'per segment [ms]':>16}")
+    per_segment = []
+    for size in sorted(args.sizes):
+        msg = oru(size)
+        segments = size + 3
+        before = timed(separate, msg)
+        after = timed(single_pass, msg)
+        per_segment.append(after / segments)
+        print(f"{segments:9} | {before * 1000:13.1f} | {after * 1000:16.1f} | {after * 1000 / segments:16.3f}")
+
+    growth = per_segment[-1] / per_segment[0]
+    if growth > args.max_growth:
+        print(f"FAIL: time per segment grew {growth:.2f}x, allowed {args.max_growth}x")
+        return 1
+    print(f"OK: time per segment grew {growth:.2f}x, allowed {args.max_growth}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Validation benchmark: hl7apy validate() calls against the single-traversal TreeValidator.
+
+validate_message checks the message, then every segment, then every field of
+every segment. This times those checks on ORU messages with more and more OBX
+segments, once as hl7apy validate() calls (each walking its whole subtree and
+raising its first error) and once with TreeValidator, which walks the message
+once and looks the segments and fields up. Parsing is done beforehand and not
+timed. Exits with 1 when the TreeValidator is not faster on every size.
+
+    python benchmarks/validate.py --sizes 100 400 1600
+"""
+
+import argparse
+import sys
+import time
+from unittest import mock
+
+from hl7apy import validation as hl7apy_validation
+
+from hl7validator.api import ValidationContext, ValidationReport
+from hl7validator.engine import TreeValidator
+from render import oru
+
+
+def elements(msg):
+    return [msg] + [el for segment in msg.children for el in [segment] + list(segment.children)]
+
+
+def hl7apy_validate(msg):
+    report = ValidationReport()
+    # hl7apy opens its report file with open(), hand it the in-memory report instead
+    with mock.patch.object(hl7apy_validation, "open", lambda *args: args[0], create=True):
+        for element in elements(msg):
+            try:
+                element.validate(report_file=report)
+            except Exception:
+                pass
+
+
+def tree_validate(msg):
+    validator = TreeValidator()
+    report = ValidationReport()
+    for element in elements(msg):
+        outcome = validator.collect(element)
+        if outcome.failure is None:
+            validator.write(outcome, report)
+
+
+def timed(validate, msg):
+    """
+    Seconds to validate msg, parsed beforehand
+    """
+    parsed = ValidationContext(msg).parse()
+    start = time.perf_counter()
+    validate(parsed)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure validation time")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 400, 1600], help="OBX segments")
+    args = parser.parse_args(argv)
+
+    print(f"{'segments':>9} | {'hl7apy [ms]':>11} | {'single traversal [ms]':>21} | {'speedup':>7}")
+    slower = []
+    for size in sorted(args.sizes):
+        msg = oru(size)
+        before = timed(hl7apy_validate, msg)
+        after = timed(tree_validate, msg)
+        print(f"{size + 3:9} | {before * 1000:11.1f} | {after * 1000:21.1f} | {before / after:6.1f}x")
+        if after >= before:
+            slower.append(size + 3)
+
+    if slower:
+        print(f"FAIL: single traversal not faster with {', '.join(map(str, slower))} segments")
+        return 1
+    print("OK: single traversal faster on every size")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
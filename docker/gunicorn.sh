@@ -17,25 +17,67 @@ ERROR_LOG="$LOG_DIR/message_validation.log"
 
 # Get number of workers from environment or default to 2
 WORKERS="${GUNICORN_WORKERS:-2}"
-THREADS="${GUNICORN_THREADS:-2}"
+# Threads beyond the admission slots wait in the admission queues, where they can be answered with a 429
+THREADS="${GUNICORN_THREADS:-8}"
 BIND_ADDRESS="${GUNICORN_BIND:-0.0.0.0:80}"
 LOG_LEVEL="${GUNICORN_LOG_LEVEL:-info}"
 
+# Load every HL7 version in the master before forking, workers share it copy-on-write
+export WARMUP="${WARMUP:-true}"
+
 echo "Starting HL7 V2 Validator..."
 echo "Workers: $WORKERS"
 echo "Threads per worker: $THREADS"
 echo "Binding to: $BIND_ADDRESS"
 echo "Log level: $LOG_LEVEL"
+echo "Warm-up: $WARMUP"
+
+# Workers write their metrics here and /metrics adds them up; start from zero on each start
+export METRICS_DIR="${METRICS_DIR:-/tmp/hl7validator-metrics}"
+rm -rf "$METRICS_DIR"
+mkdir -p "$METRICS_DIR"
+
+# Run the queued validation jobs of POST /api/hl7/v1/jobs in their own processes, next to the web workers
+JOBS_PID=""
+if [ "${JOBS_RUNNER:-true}" = "true" ]; then
+    echo "Job runner: ${JOBS_DB:-data/jobs.sqlite3}"
+    python -m hl7validator jobs ${JOBS_WORKERS:+-j $JOBS_WORKERS} &
+    JOBS_PID=$!
+fi
 
 # Start gunicorn with configurable settings
 # Use the installed package module instead of run.py
-exec gunicorn "hl7validator:app" \
+set -- gunicorn "hl7validator:app" \
     --workers $WORKERS \
     --threads $THREADS \
     --bind $BIND_ADDRESS \
     --access-logfile $ACCESS_LOG \
     --error-logfile $ERROR_LOG \
     --log-level $LOG_LEVEL \
+    --capture-output \
+    --preload \
     --timeout 120 \
     --graceful-timeout 30 \
     --keep-alive 5
+
+if [ -z "$JOBS_PID" ]; then
+    exec "$@"
+fi
+
+# With the job runner this shell stays PID 1 and hands the container's SIGTERM to both processes:
+# gunicorn finishes its requests, the runner saves its results and puts its job back in the queue
+"$@" &
+GUNICORN_PID=$!
+STOPPING=""
+trap 'STOPPING=1; kill -TERM $GUNICORN_PID $JOBS_PID 2>/dev/null' TERM INT
+wait $GUNICORN_PID
+STATUS=$?
+if [ -n "$STOPPING" ]; then
+    # wait was interrupted by the signal, gunicorn is still shutting down
+    wait $GUNICORN_PID
+    STATUS=$?
+fi
+# gunicorn may also have exited on its own
+kill -TERM $JOBS_PID 2>/dev/null
+wait $JOBS_PID
+exit $STATUS
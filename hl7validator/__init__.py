@@ -1,7 +1,6 @@
 import os
+import threading
 from flask import Flask, request, session
-from flask_babel import Babel
-from flasgger import Swagger
 
 # Import version
 from hl7validator.__version__ import __version__
@@ -16,6 +15,44 @@ app.config['LANGUAGES'] = {
     'pt': 'Português'
 }
 app.config['VERSION'] = __version__
+# Batch validation: worker processes (defaults to one per core) and messages per task
+app.config['BATCH_WORKERS'] = int(os.getenv('BATCH_WORKERS', os.cpu_count() or 1))
+app.config['BATCH_CHUNKSIZE'] = int(os.getenv('BATCH_CHUNKSIZE', 16))
+# Validation result cache: max entries (0 disables it) and time to live in seconds
+app.config['RESULT_CACHE_SIZE'] = int(os.getenv('RESULT_CACHE_SIZE', 0))
+app.config['RESULT_CACHE_TTL'] = int(os.getenv('RESULT_CACHE_TTL', 3600))
+# Rendered segments shared across messages, keyed by version and segment text: max entries (0 disables it)
+app.config['SEGMENT_CACHE_SIZE'] = int(os.getenv('SEGMENT_CACHE_SIZE', 4096))
+# Metrics snapshots shared by the gunicorn workers for /metrics (unset: this worker only), and
+# seconds a worker's snapshot may lag behind
+app.config['METRICS_DIR'] = os.getenv('METRICS_DIR', '')
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.getenv('METRICS_FLUSH_INTERVAL', 1))
+# Time budget of one validation in seconds, and the largest message (characters) and segment
+# count validated at all; 0 disables a limit
+app.config['VALIDATION_TIMEOUT'] = float(os.getenv('VALIDATION_TIMEOUT', 30))
+app.config['MAX_MESSAGE_SIZE'] = int(os.getenv('MAX_MESSAGE_SIZE', 4 * 1024 * 1024))
+app.config['MAX_SEGMENTS'] = int(os.getenv('MAX_SEGMENTS', 10000))
+# Admission control per worker: requests running at once and waiting at once in each lane (the web
+# form, and the validation/converter APIs), and seconds a request waits before a 429
+app.config['ADMISSION_INTERACTIVE_CONCURRENCY'] = int(os.getenv('ADMISSION_INTERACTIVE_CONCURRENCY', 2))
+app.config['ADMISSION_INTERACTIVE_QUEUE'] = int(os.getenv('ADMISSION_INTERACTIVE_QUEUE', 16))
+app.config['ADMISSION_BULK_CONCURRENCY'] = int(os.getenv('ADMISSION_BULK_CONCURRENCY', 2))
+app.config['ADMISSION_BULK_QUEUE'] = int(os.getenv('ADMISSION_BULK_QUEUE', 4))
+app.config['ADMISSION_MAX_WAIT'] = float(os.getenv('ADMISSION_MAX_WAIT', 5))
+# Asynchronous jobs: SQLite queue file, seconds a runner holds a job between saves, and seconds
+# an idle runner waits before looking at the queue again
+app.config['JOBS_DB'] = os.getenv('JOBS_DB', 'data/jobs.sqlite3')
+app.config['JOBS_LEASE'] = float(os.getenv('JOBS_LEASE', 300))
+app.config['JOBS_POLL_INTERVAL'] = float(os.getenv('JOBS_POLL_INTERVAL', 1))
+# NDJSON batch streams are never buffered, so they get their own (larger) size limit
+app.config['STREAM_MAX_CONTENT_LENGTH'] = int(os.getenv('STREAM_MAX_CONTENT_LENGTH', 1024 * 1024 * 1024))
+# Load every HL7 version at import, so gunicorn --preload warms up once before forking workers
+app.config['WARMUP'] = os.getenv('WARMUP', 'False').lower() == 'true'
+# Logging: records waiting for the background writer before new ones are dropped, share of
+# messages whose body is logged and the characters of it kept (0 keeps the whole body)
+app.config['LOG_QUEUE_SIZE'] = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+app.config['LOG_MESSAGE_SAMPLE_RATE'] = float(os.getenv('LOG_MESSAGE_SAMPLE_RATE', 1))
+app.config['LOG_MESSAGE_MAX_LENGTH'] = int(os.getenv('LOG_MESSAGE_MAX_LENGTH', 500))
 app.debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
 
 def get_locale():
@@ -29,28 +66,66 @@ def get_locale():
     # 3. Try to match browser's accept languages
     return request.accept_languages.best_match(app.config['LANGUAGES'].keys()) or 'en'
 
-babel = Babel(app, locale_selector=get_locale)
-
-swagger = Swagger(
-    app,
-    template={
-        "swagger": "2.0",
-        "info": {
-            "title": "HL7 Validator",
-            "description": "HL7 Validation API",
-            "contact": {
-                "responsibleOrganization": "HL7PT",
-                "responsibleDeveloper": "Joao Almeida",
-                "email": "geral@hl7.pt",
-                "url": "http://hl7.pt",
-            },
-            "termsOfService": "http://me.com/terms",
-            "version": __version__,
+SWAGGER_TEMPLATE = {
+    "swagger": "2.0",
+    "info": {
+        "title": "HL7 Validator",
+        "description": "HL7 Validation API",
+        "contact": {
+            "responsibleOrganization": "HL7PT",
+            "responsibleDeveloper": "Joao Almeida",
+            "email": "geral@hl7.pt",
+            "url": "http://hl7.pt",
         },
-        "host": "version2.hl7.pt",  # overrides localhost:500
-        "basePath": "",  # base bash for blueprint registration
-        "schemes": ["https"],
+        "termsOfService": "http://me.com/terms",
+        "version": __version__,
     },
-)
+    "host": "version2.hl7.pt",  # overrides localhost:500
+    "basePath": "",  # base bash for blueprint registration
+    "schemes": ["https"],
+}
+
+# Babel and Flasgger are only needed to serve web requests, so the CLI, the
+# MLLP listener and plain imports never load them
+babel = None
+swagger = None
+_extensions_lock = threading.Lock()
+
+
+def init_extensions():
+    """
+    Set up Babel and Flasgger, once, before the first request is handled
+    """
+    global babel, swagger
+    if swagger is not None:
+        return
+    with _extensions_lock:
+        if swagger is not None:
+            return
+        from flask_babel import Babel
+        from flasgger import Swagger
+
+        babel = Babel(app, locale_selector=get_locale)
+        swagger = Swagger(app, template=SWAGGER_TEMPLATE)
+
+
+_wsgi_app = app.wsgi_app
+
+
+def wsgi_app(environ, start_response):
+    init_extensions()
+    return _wsgi_app(environ, start_response)
+
+
+app.wsgi_app = wsgi_app
+
+from hl7validator.logs import queue_logging
+
+# log records are written by a background thread, see hl7validator.logs
+queue_logging(app.logger)
 
 from hl7validator import views
+
+if app.config['WARMUP']:
+    from hl7validator.warmup import warm_up
+    warm_up()
@@ -1,13 +1,54 @@
 """Main entry point for hl7validator package."""
 
 from hl7validator import app
+from hl7validator.logs import queue_logging
+import argparse
 import os
+import sys
 import logging
 from logging.handlers import RotatingFileHandler
 
 
-def main():
-    """Main entry point for the application."""
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="hl7validator", description="HL7 v2 message validator")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("web", help="run the web application (default)")
+
+    mllp = commands.add_parser("mllp", help="run an MLLP listener that answers with validation ACKs")
+    mllp.add_argument("--host", default=os.getenv("MLLP_HOST", "0.0.0.0"))
+    mllp.add_argument("--port", type=int, default=int(os.getenv("MLLP_PORT", 2575)))
+    mllp.add_argument("--validation-level", choices=["strict", "tolerant"], default="tolerant")
+
+    validate = commands.add_parser(
+        "validate", help="validate files, directories or globs and write one JSON line per message"
+    )
+    validate.add_argument("paths", nargs="+", help="files, directories or glob patterns")
+    validate.add_argument("-o", "--output", help="JSONL output file (default: stdout)")
+    validate.add_argument("-j", "--workers", type=int, help="worker processes (default: BATCH_WORKERS)")
+    validate.add_argument("--validation-level", choices=["strict", "tolerant"], default="tolerant")
+    validate.add_argument("--encoding", default="utf-8", help="encoding of the input files")
+    validate.add_argument(
+        "--no-format-checks", action="store_true", help="do not check dates, times, numbers and coded value lengths"
+    )
+    validate.add_argument("-v", "--verbose", action="store_true", help="log every message like the web app")
+
+    convert = commands.add_parser(
+        "convert", help="flatten the messages of files, directories or globs into one table"
+    )
+    convert.add_argument("paths", nargs="+", help="files, directories or glob patterns")
+    convert.add_argument("-o", "--output", help="output file, format from its extension (default: CSV on stdout)")
+    convert.add_argument("-f", "--format", choices=["csv", "parquet", "arrow"], help="output format")
+    convert.add_argument("--encoding", default="utf-8", help="encoding of the input files")
+
+    jobs = commands.add_parser("jobs", help="run queued validation jobs of POST /api/hl7/v1/jobs")
+    jobs.add_argument("-j", "--workers", type=int, help="worker processes (default: BATCH_WORKERS)")
+
+    return parser.parse_args(argv)
+
+
+def file_logging():
+    """Log to logs/message_validation.log, for the commands that run a server"""
     if not app.debug:
         if not os.path.exists("logs"):
             os.mkdir("logs")
@@ -22,9 +63,39 @@ def main():
         file_handler.setLevel(logging.INFO)
         app.logger.addHandler(file_handler)
         app.logger.setLevel(logging.INFO)
+        # the file is written by the logging thread, not the request or validation threads
+        queue_logging(app.logger)
+
+
+def main(argv=None):
+    """Main entry point for the application."""
+    args = parse_args(argv)
+
+    if args.command == "validate":
+        from hl7validator.bulk import run
+
+        # Per-message outcomes are already in the JSONL output
+        if not args.verbose:
+            app.logger.setLevel(logging.CRITICAL)
+        return run(args)
+    elif args.command == "convert":
+        from hl7validator.columnar import run
+
+        return run(args)
+    elif args.command == "jobs":
+        from hl7validator.jobs import run
+
+        file_logging()
+        return run(args)
+    elif args.command == "mllp":
+        from hl7validator.mllp import serve
 
-    app.run()
+        file_logging()
+        serve(args.host, args.port, args.validation_level)
+    else:
+        file_logging()
+        app.run()
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Admission control of the HTTP API, per worker process.
+
+Requests doing validation or conversion work go through a lane: interactive
+traffic (the web form and its tree view) and bulk traffic (the validation,
+batch and converter APIs) each have their own slots, so bulk clients can never
+take the capacity the web form needs. A request takes a free slot of its lane,
+or waits for one in the lane's bounded queue for at most ADMISSION_MAX_WAIT
+seconds. When the queue is full, or the wait runs out, it is answered at once
+with ``429 Too Many Requests`` and a ``Retry-After`` worked out from how long
+the lane's requests take, instead of piling up in gunicorn's backlog until
+the client times out.
+"""
+
+import math
+import threading
+import time
+
+from werkzeug.wsgi import ClosingIterator
+
+from hl7validator import app
+
+
+class Overloaded(Exception):
+    """
+    A lane has no free slot and no room left in its queue
+    :param lane: name of the lane
+    :param retry_after: seconds after which a retry is likely to be admitted
+    """
+
+    def __init__(self, lane, retry_after):
+        super().__init__(f"Too many {lane} requests, retry in {retry_after} seconds")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class Lane:
+    """
+    :param concurrency: requests running at once, 0 for no limit
+    :param queue: requests waiting for a slot at once
+    """
+
+    def __init__(self, name, concurrency, queue):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        # moving average of the seconds a request of the lane takes, for Retry-After
+        self.service_time = 1.0
+
+
+class AdmissionController:
+    """
+    Slots and queues of the lanes of one worker process
+    :param lanes: dict of lane name to (concurrency, queue depth)
+    :param max_wait: seconds a request waits in a queue before it is turned away
+    """
+
+    def __init__(self, lanes, max_wait=5.0):
+        self.lanes = {name: Lane(name, *limits) for name, limits in lanes.items()}
+        self.max_wait = max_wait
+        self._condition = threading.Condition()
+
+    def acquire(self, name):
+        """
+        Take a slot of a lane, waiting in its queue when it is full
+        :return: start time of the request, to pass to release
+        :raises Overloaded: when the queue is full or no slot was freed in time
+        """
+        lane = self.lanes[name]
+        with self._condition:
+            if lane.concurrency and lane.in_flight >= lane.concurrency:
+                if lane.waiting >= lane.queue:
+                    raise self._reject(lane)
+                lane.waiting += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: lane.in_flight < lane.concurrency, timeout=self.max_wait
+                    )
+                finally:
+                    lane.waiting -= 1
+                if not admitted:
+                    raise self._reject(lane)
+            lane.in_flight += 1
+        return time.monotonic()
+
+    def release(self, name, started):
+        lane = self.lanes[name]
+        with self._condition:
+            lane.in_flight -= 1
+            lane.service_time = 0.8 * lane.service_time + 0.2 * (time.monotonic() - started)
+            self._condition.notify_all()
+
+    def released_after(self, iterable, name, started):
+        """
+        Iterable of a streamed response that gives the slot back once it is sent or closed,
+        whichever comes first
+        """
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.release(name, started)
+
+        def stream():
+            try:
+                yield from iterable
+            finally:
+                release()
+
+        # closed without being read, the generator above never started
+        return ClosingIterator(stream(), [release])
+
+    def _reject(self, lane):
+        lane.rejected += 1
+        # the requests ahead (running and queued) shared out over the lane's slots
+        ahead = (lane.in_flight + lane.waiting) / max(lane.concurrency, 1)
+        return Overloaded(lane.name, max(1, math.ceil(ahead * lane.service_time)))
+
+    def stats(self):
+        with self._condition:
+            return {
+                lane.name: {
+                    "concurrency": lane.concurrency,
+                    "queue": lane.queue,
+                    "in_flight": lane.in_flight,
+                    "waiting": lane.waiting,
+                    "rejected": lane.rejected,
+                }
+                for lane in self.lanes.values()
+            }
+
+
+admission = AdmissionController(
+    {
+        "interactive": (app.config["ADMISSION_INTERACTIVE_CONCURRENCY"], app.config["ADMISSION_INTERACTIVE_QUEUE"]),
+        "bulk": (app.config["ADMISSION_BULK_CONCURRENCY"], app.config["ADMISSION_BULK_QUEUE"]),
+    },
+    app.config["ADMISSION_MAX_WAIT"],
+)
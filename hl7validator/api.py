@@ -5,10 +5,24 @@ from hl7apy.core import Field
 from hl7apy.consts import VALIDATION_LEVEL
 from flask import abort
 from hl7validator import app
-import os
+from hl7validator import datatypes
+from hl7validator.cache import result_cache, segment_cache
+from hl7validator.deadline import Deadline, ValidationTimeout
+from hl7validator.details import DetailSet, location_path, make_detail, make_location
+from hl7validator import metrics
+from hl7validator.engine import TreeValidator
+from hl7validator.logs import log_message, truncate
+from hl7validator.metadata import get_index
+from hl7validator.metrics import stage
+from hl7validator.structure import check_structure, find_structure, has_structure_component
+from hl7validator.tokenizer import Tokens
+import html
+import io
+import json
+import logging
 import re
-import pandas as pd
-from datetime import datetime
+from collections import namedtuple
+from functools import lru_cache
 
 classes_list = {}
 
@@ -16,6 +30,18 @@ classes_list = {}
 # https://blog.miguelgrinberg.com/post/designing-a-restful-api-with-python-and-flask
 
 
+class InvalidSegment(Exception):
+    """
+    A segment hl7apy could not parse, raised for every message the segment is in.
+    The segment cache keeps the error message only: the exception hl7apy raised would
+    keep the frames, and the messages, of every request it was raised again in.
+    """
+
+
+# what the segment cache holds for a segment that could not be parsed
+Unparsable = namedtuple("Unparsable", ["message"])
+
+
 class resultMessage:
     statusCode: str
     message: str
@@ -23,13 +49,14 @@ class resultMessage:
     warnings: list
     resource: str
     hl7version: str
+    timedOut: bool
 
     def __init__(self):
         self.details = ""
         self.warnings = []
 
 
-def set_reference(setmsg, hl7version):
+def set_reference(setmsg, hl7version, tokens=None):
     """
     Add MSH-9.3 (message structure) when missing for v2.3.1 and earlier.
 
@@ -37,14 +64,20 @@ def set_reference(setmsg, hl7version):
     (e.g., ADT^A01 -> ADT_A01), which works for most messages. However, some special
     cases need explicit handling:
     - ACK messages: structure is "ACK" (not "ACK_ACK")
-    - Some ADT variants share the same structure (e.g., A04/A08/A13 all use ADT_A01)
+    - Some trigger events share the same structure (e.g., A04/A08/A13 all use ADT_A01),
+      see structure.SHARED_STRUCTURES
+    - Events the version defines no structure for get the structure of that message
+      code whose segment order the message follows
 
     MSH-9.3 by HL7 standard:
     - v2.3.1 and earlier: Optional
     - v2.4 and later: Required
 
     We only add MSH-9.3 for v2.3.1 and earlier where it's optional. For v2.4+,
-    it should already be present per the standard.
+    it should already be present per the standard. Before v2.3.1 MSH-9 has no
+    structure component, the structure automaton checks those messages instead.
+
+    :param tokens: Tokens of the message, tokenized here when not given
     """
     # Normalize ACK messages across all versions
     # Handle incomplete ACK formats: |ACK| or |ACK^|
@@ -57,24 +90,26 @@ def set_reference(setmsg, hl7version):
     # ACK is special: structure is "ACK" not "ACK_ACK"
     if "|ACK^ACK|" in setmsg and "|ACK^ACK^" not in setmsg:
         setmsg = setmsg.replace("|ACK^ACK|", "|ACK^ACK^ACK|", 1)
-        app.logger.info(f"Auto-added MSH-9.3 for ACK message: ACK^ACK -> ACK^ACK^ACK")
+        app.logger.debug("Auto-added MSH-9.3 for ACK message: ACK^ACK -> ACK^ACK^ACK")
         return setmsg
 
     # Only auto-add MSH-9.3 for v2.3.1 and earlier (where it's optional per HL7 standard)
     # For v2.4+, MSH-9.3 is required, so missing it is an error that should be reported
     if hl7version not in ["2.1", "2.2", "2.3", "2.3.1"]:
         return setmsg
+    # Before v2.3.1 MSH-9 has no third component, adding one would be an error itself
+    if not has_structure_component(hl7version):
+        return setmsg
 
-    # Extract MSH-9 to check if MSH-9.3 is missing
+    # Read MSH-9 to check if MSH-9.3 is missing
     try:
-        msh_segment = setmsg.split('\r')[0]
-        fields = msh_segment.split('|')
+        if tokens is None:
+            tokens = Tokens(setmsg)
 
-        if len(fields) <= 9:
+        if len(tokens.field_bounds(0)) <= 10:
             return setmsg
 
-        msh_9 = fields[8]
-        components = msh_9.split('^')
+        components = tokens.components(0, 9)
 
         # Only process if we have exactly 2 components (message_code^trigger_event)
         if len(components) != 2:
@@ -86,215 +121,378 @@ def set_reference(setmsg, hl7version):
         if not message_code or not trigger_event:
             return setmsg
 
-        # Special cases that don't follow MESSAGE_CODE_TRIGGER_EVENT pattern
+        # Trigger events sharing a structure (e.g. ADT^A04 -> ADT_A01), or the structure
+        # whose segment order the message follows when the version defines none for the event.
         # For everything else, hl7apy's automatic inference works fine
-        special_structures = {
-            # ACK is just "ACK", not "ACK_ACK"
-            ("ACK", "ACK"): "ACK",
-            # ADT messages that share structures
-            ("ADT", "A04"): "ADT_A01",
-            ("ADT", "A08"): "ADT_A01",
-            ("ADT", "A13"): "ADT_A01",
-            ("ADT", "A07"): "ADT_A06",
-            ("ADT", "A10"): "ADT_A09",
-            ("ADT", "A11"): "ADT_A09",
-            ("ADT", "A12"): "ADT_A09",
-            ("ADT", "A14"): "ADT_A05",
-            ("ADT", "A28"): "ADT_A05",
-            ("ADT", "A31"): "ADT_A05",
-        }
-
-        structure = special_structures.get((message_code, trigger_event))
+        structure = find_structure(hl7version, message_code, trigger_event, tokens.segment_ids())
+        if structure == f"{message_code}_{trigger_event}":
+            return setmsg
 
-        # If it's a special case, add the structure
+        # If it's a special case, add the structure at the end of MSH-9; MSH comes
+        # first, so its offsets are the same in the message and its normalized form
         if structure:
-            old_msh9 = f"|{message_code}^{trigger_event}|"
-            new_msh9 = f"|{message_code}^{trigger_event}^{structure}|"
-            setmsg = setmsg.replace(old_msh9, new_msh9, 1)
-            app.logger.info(f"Auto-added MSH-9.3: {message_code}^{trigger_event} -> {message_code}^{trigger_event}^{structure}")
+            end = tokens.field_span(0, 9)[1]
+            setmsg = setmsg[:end] + tokens.delimiters.component + structure + setmsg[end:]
+            app.logger.debug("Auto-added MSH-9.3: %s^%s -> %s^%s^%s", message_code, trigger_event,
+                             message_code, trigger_event, structure)
         # Otherwise, let hl7apy infer it automatically (no need to add MSH-9.3)
 
     except Exception as e:
-        app.logger.error(f"Error in set_reference: {e}")
+        app.logger.error("Error in set_reference: %s", e)
 
     return setmsg
 
 
 def check_simple_format(value):
-    # Define pattern for checking the format
-    date_pattern = r"\d{4}(\d{2}(\d{2})?)?"
-
-    # Check if the value matches the expected pattern
-    if not re.match(date_pattern, value):
+    """
+    Check a DT value, see datatypes.is_valid
+    """
+    if not datatypes.is_valid("DT", value):
         return False, "Value does not match the expected format."
+    return True, "Format is valid."
 
-    # Try to parse the value up to the highest precision provided
-    format_str = "%Y"
-    if len(value) > 4:
-        format_str += "%m"
-    if len(value) > 6:
-        format_str += "%d"
-
-    try:
-        parsed_date = datetime.strptime(value, format_str)
-    except ValueError:
-        return False, "Failed to parse date."
 
+def check_format(value):
+    """
+    Check a DTM value, see datatypes.is_valid
+    """
+    if not datatypes.is_valid("DTM", value):
+        return False, "Datetime does not match the expected format."
     return True, "Format is valid."
 
 
-def check_format(value):
-    # Split the datetime and timezone parts, if a timezone is present
-    parts = value.split("+") if "+" in value else value.split("-")
-    datetime_part = parts[0]
-    timezone_part = (
-        "+" + parts[1]
-        if len(parts) > 1 and "+" in value
-        else "-" + parts[1]
-        if len(parts) > 1
-        else None
-    )
+def set_message_to_validate(msg):
+    """
+    replace newline chars for messages since parse_message does not take into account custom_chars
+    :param msg:
+    :return: the message with CR segment terminators, see Tokens.normalized
+    """
+    return Tokens(msg).normalized()
 
-    # Define patterns for checking the format
-    datetime_pattern = r"\d{4}(\d{2}(\d{2}(\d{2}(\d{2}(\d{2}(\.\d{1,4})?)?)?)?)?)?"
-    timezone_pattern = r"[+-]\d{4}"
-
-    # Check if the datetime part matches the expected pattern
-    if not re.match(datetime_pattern, datetime_part):
-        return False, "Datetime part does not match the expected format."
-
-    # If a timezone part is present, check if it matches the expected pattern
-    if timezone_part and not re.match(timezone_pattern, timezone_part):
-        return False, "Timezone part does not match the expected format."
-
-    # Try to parse the datetime part up to the highest precision provided
-    # The format varies depending on the length of the datetime part
-    format_str = "%Y"
-    if len(datetime_part) > 4:
-        format_str += "%m"
-    if len(datetime_part) > 6:
-        format_str += "%d"
-    if len(datetime_part) > 8:
-        format_str += "%H"
-    if len(datetime_part) > 10:
-        format_str += "%M"
-    if len(datetime_part) > 12:
-        format_str += "%S"
 
-    try:
-        parsed_datetime = datetime.strptime(datetime_part, format_str)
-    except ValueError:
-        return False, "Failed to parse datetime part."
+class ValidationReport:
+    """
+    In-memory sink for hl7apy validation reports, owned by a single request.
 
-    return True, "Format is valid."
+    TreeValidator writes the problems of each validated element here the way hl7apy
+    writes its report file, instead of in a shared file in the working directory.
+    Like the file it replaces, each validation overwrites the previous report.
+    """
 
+    def __init__(self):
+        self.lines = []
+
+    def __enter__(self):
+        self.lines = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def write(self, text):
+        self.lines.append(text)
 
-def define_custom_chars(msg):
+    def consume(self):
+        """
+        Return the report lines and empty the report
+        :return: list of lines, split as they would be read back from a text file
+        """
+        lines = list(io.StringIO("".join(self.lines), newline=None))
+        self.lines = []
+        return lines
+
+
+class ValidationContext:
     """
-    Create dict for custom escape characters for HL7v2 messages
-    :param msg: msg to be evaluated
-    :return: custom characters, nOne if default.
+    Per-request state shared by every validation and rendering stage.
+
+    The message is tokenized once (segment and field offsets, see Tokens), and each parsed
+    tree (whole message or single segment) is built the first time a stage asks
+    for it and reused afterwards, so hl7validatorapi, highlight_message and
+    build_tree_structure never parse the same text twice.
     """
-    if "\r\n" in msg:
-        return {
-            "FIELD": "|",
-            "COMPONENT": "^",
-            "REPETITION": "~",
-            "ESCAPE": "\\",
-            "SUBCOMPONENT": "&",
-            "GROUP": "\r\n",
-            "SEGMENT": "\r\n",
-        }
-    elif "\r" in msg:
-        return None
-    else:
-        return {
-            "FIELD": "|",
-            "COMPONENT": "^",
-            "REPETITION": "~",
-            "ESCAPE": "\\",
-            "SUBCOMPONENT": "&",
-            "GROUP": "\r",
-            "SEGMENT": "\n",
-        }
 
+    def __init__(self, msg, validation_level="tolerant"):
+        self.msg = msg
+        self.validation_level = validation_level
+        # segments and fields are sliced from the message by offset, see Tokens
+        with stage("tokenize"):
+            self.tokens = Tokens(msg) if msg else None
+            self.setmsg = self.tokens.normalized() if msg else msg
+        self.segments = self.tokens.lines if msg else []
+        self.hl7version = None
+        self._parsed_msg = None
+        self._tolerant_msg = None
+        self._reference_msgs = {}
+        self._parsed_segments = {}
+        self.report = ValidationReport()
+        self.validator = TreeValidator()
+        # details and warnings of the running validation, returned as they are when it times out
+        self.details = None
+        self.warnings = []
 
-def set_message_to_validate(msg):
-    """
-    replace newline chars for messages since parse_message does not take into account custom_chars
-    :param msg:
-    :return:
-    """
-    if "\r\n" in msg:
-        return msg.replace("\r\n", "\r")
-    elif "\n" in msg:
-        return msg.replace("\n", "\r")
-    elif "\r" not in msg:
-        return msg + "\r"
-    else:
-        return msg
+    @property
+    def deadline(self):
+        return self.validator.deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        self.validator.deadline = deadline
+
+    def check_deadline(self):
+        """
+        :raises ValidationTimeout: when the validation has a deadline and it has passed
+        """
+        if self.validator.deadline is not None:
+            self.validator.deadline.check()
+
+    @property
+    def val_level(self):
+        """hl7apy validation level constant for the requested level"""
+        if self.validation_level and self.validation_level.lower() == "strict":
+            return VALIDATION_LEVEL.STRICT
+        return VALIDATION_LEVEL.TOLERANT
+
+    def parse(self):
+        """
+        Parse the message with the requested validation level.
+        :return: parsed message, errors are raised to the caller
+        """
+        if self._parsed_msg is None:
+            with stage("parse"):
+                self._parsed_msg = parse_message(self.setmsg, validation_level=self.val_level)
+            self.hl7version = self._parsed_msg.version
+        return self._parsed_msg
+
+    def tolerant_message(self):
+        """
+        Parsed message with tolerant validation level, used to walk segments.
+        Shares the tree built by parse() when the request is already tolerant.
+        """
+        if self.val_level == VALIDATION_LEVEL.TOLERANT:
+            return self.parse()
+        if self._tolerant_msg is None:
+            with stage("parse"):
+                self._tolerant_msg = parse_message(self.setmsg)
+        return self._tolerant_msg
+
+    def reference_message(self, hl7version):
+        """
+        Parsed message with MSH-9.3 filled in by set_reference, used for structure validation.
+        Only parsed again when set_reference actually changed the message.
+        """
+        refmsg = set_reference(self.setmsg, hl7version, self.tokens)
+        if refmsg == self.setmsg:
+            return self.tolerant_message()
+        if refmsg not in self._reference_msgs:
+            with stage("parse"):
+                self._reference_msgs[refmsg] = parse_message(refmsg)
+        return self._reference_msgs[refmsg]
+
+    def validate(self, element):
+        """
+        Validate a parsed element like element.validate(report_file=self.report), without raising
+        :return: the first error, or the exception that stopped the validation; None when valid
+        """
+        with stage("validate"):
+            outcome = self.validator.collect(element)
+            if outcome.failure is not None:
+                return outcome.failure
+            self.validator.write(outcome, self.report)
+        return outcome.errors[0] if outcome.errors else None
+
+    def parsed_segment(self, index, hl7version):
+        """
+        Parse a single segment line, caching both the result and any parsing error
+        :param index: position of the segment in self.segments
+        :param hl7version: version used to parse the segment
+        :return: parsed segment
+        """
+        key = (index, hl7version)
+        if key not in self._parsed_segments:
+            try:
+                self._parsed_segments[key] = parse_segment(self.segments[index], version=hl7version)
+            except Exception as e:
+                self._parsed_segments[key] = e
+        result = self._parsed_segments[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def segment_part(self, index, hl7version, part, build):
+        """
+        Part of the rendering of a segment line, taken from the segment cache when another
+        message had the same segment, so the segment is only parsed when it is new
+        :param part: name of the part in the cache
+        :param build: function of the parsed segment returning the part
+        :raises InvalidSegment: with the message of the error parsing the segment raised
+        """
+        # the delimiters change how the same text splits into fields and repetitions
+        key = (hl7version, self.tokens.delimiters, self.segments[index])
+        value = segment_cache.get(key, part)
+        if value is None:
+            try:
+                parsed = self.parsed_segment(index, hl7version)
+            except Exception as e:
+                value = Unparsable(str(e))
+                segment_cache.set(key, part, value)
+            else:
+                value = build(parsed)
+                segment_cache.set(key, part, value)
+        if isinstance(value, Unparsable):
+            raise InvalidSegment(value.message) from None
+        return value
 
 
 def read_report(report, details, error):
-    with open(report, "r") as file:
-        for line in file:
+    """
+    Move the lines of a validation report into details
+    :param report: ValidationReport filled by the last validate() call
+    :param details: DetailSet to add the lines to
+    :param error: current error flag, set when the report has an error
+    :return: details and error flag
+    """
+    debug = app.logger.isEnabledFor(logging.DEBUG)
+    with stage("read_report"):
+        for line in report.consume():
             level, message_level = line.split(":", 1)
             if level == "Error":
                 error = True
-            app.logger.debug(f"Validation {level}: {message_level.strip()}")
-            if {
-                "level": level,
-                "message": message_level,
-            } not in details:
-                details.append(
-                    {
-                        "level": level,
-                        "message": message_level,
-                    }
-                )
-    os.remove(report)
+            if debug:
+                app.logger.debug("Validation %s: %s", level, message_level.strip())
+            details.add(level, message_level)
 
     return details, error
 
 
-def hl7validatorapi(msg, validation_level='tolerant'):
+def hl7validatorapi(msg, validation_level='tolerant', context=None):
     """
     Validate an HL7 v2 message.
 
     :param msg: The HL7 message to validate
     :param validation_level: Validation level - 'strict' or 'tolerant' (default)
+    :param context: ValidationContext to reuse across stages, created when not given
     :return: Dictionary with validation results
     """
-    app.logger.info("message received in hl7validatorapi: {}".format(msg))
-    app.logger.info(f"validation level: {validation_level}")
+    log_message("message received in hl7validatorapi", msg)
+    app.logger.debug("validation level: %s", validation_level)
 
-    # Convert validation level string to hl7apy constant
-    if validation_level and validation_level.lower() == 'strict':
-        val_level = VALIDATION_LEVEL.STRICT
+    if not msg:
+        abort(404)
+    # abusive inputs are turned away before the message is tokenized or parsed
+    problem = check_size(msg)
+    if context is None and problem is None:
+        context = ValidationContext(msg, validation_level)
+    if problem is None:
+        problem = check_segment_count(context.tokens)
+    if problem is not None:
+        app.logger.warning("Message rejected: %s", problem)
+        return rejected_result(problem)
+
+    if not result_cache.enabled:
+        result = validate_with_deadline(context)
     else:
-        val_level = VALIDATION_LEVEL.TOLERANT
+        cache_key = result_cache.key(context.setmsg, context.val_level)
+        result = result_cache.get(cache_key)
+        if result is not None:
+            context.hl7version = result["hl7version"]
+        else:
+            result = validate_with_deadline(context)
+            if not result.get("timedOut"):
+                result_cache.set(cache_key, result)
+    metrics.label(result["hl7version"], message_type(context))
+    metrics.record_validation(result)
+    return result
 
+
+def check_size(msg):
+    """
+    :return: why the message is too large to validate (MAX_MESSAGE_SIZE), None when it is not
+    """
+    limit = app.config["MAX_MESSAGE_SIZE"]
+    if limit and len(msg) > limit:
+        return f"Message has {len(msg)} characters, the limit is {limit}"
+    return None
+
+
+def check_segment_count(tokens):
+    """
+    :return: why the message has too many segments to validate (MAX_SEGMENTS), None when it has not
+    """
+    limit = app.config["MAX_SEGMENTS"]
+    if limit and len(tokens) > limit:
+        return f"Message has {len(tokens)} segments, the limit is {limit}"
+    return None
+
+
+def rejected_result(problem):
     resultmessage = resultMessage()
-    custom_chars = define_custom_chars(msg)
-    details = []
-    warnings = []  # Collect validation warnings
+    resultmessage.statusCode = "Failed"
+    resultmessage.hl7version = None
+    resultmessage.message = "[Message rejected] " + problem
+    return resultmessage.__dict__
+
+
+def validate_with_deadline(context):
+    """
+    validate_message within VALIDATION_TIMEOUT seconds. When the time is up the validation
+    stops at its next check, and the details and warnings found so far are returned with
+    timedOut set.
+    :return: Dictionary with validation results
+    """
+    seconds = app.config["VALIDATION_TIMEOUT"]
+    if not seconds:
+        return validate_message(context)
+    context.deadline = Deadline(seconds)
+    try:
+        return validate_message(context)
+    except ValidationTimeout as timeout:
+        app.logger.warning("Validation stopped: %s", timeout)
+        resultmessage = resultMessage()
+        resultmessage.statusCode = "Failed"
+        resultmessage.hl7version = context.hl7version
+        resultmessage.message = "[Validation timed out] " + str(timeout)
+        resultmessage.details = context.details.to_list() if context.details is not None else ""
+        resultmessage.warnings = list(context.warnings)
+        resultmessage.timedOut = True
+        return resultmessage.__dict__
+    finally:
+        # rendering the message afterwards is not part of the budget
+        context.deadline = None
+
+
+def message_type(context):
+    """
+    Message code and trigger event of a message from MSH-9, e.g. ADT^A01
+    """
+    if context.tokens is None:
+        return None
+    return "^".join(context.tokens.components(0, 9)[:2])
+
+
+def validate_message(context):
+    """
+    Run every validation stage on a message
+    :param context: ValidationContext of the message
+    :return: Dictionary with validation results
+    """
+    msg = context.msg
+    resultmessage = resultMessage()
+    details = context.details = DetailSet(context.segments)
+    warnings = context.warnings = []  # Collect validation warnings
     status = "Success"
     msh_18 = "ASCII"
     hl7version = None
-    if not msg:
-        abort(404)
     error = False
-    setmsg = set_message_to_validate(msg)
+    setmsg = context.setmsg
     try:
-        parsed_msg = parse_message(setmsg, validation_level=val_level)
+        parsed_msg = context.parse()
         hl7version = parsed_msg.version
         msh_9 = parsed_msg.msh.msh_9
 
         message = "Valid"
     except Exception as err:
-        app.logger.error(
-            "Not able to parse message: {} ----> ERROR {}".format(msg, err)
-        )
+        app.logger.error("Not able to parse message: %s ----> ERROR %s", truncate(msg), err)
         resultmessage.statusCode = "Failed"
         resultmessage.hl7version = hl7version
         resultmessage.message = "[Error parsing message] " + str(err)
@@ -311,62 +509,86 @@ def hl7validatorapi(msg, validation_level='tolerant'):
 
     if msh_18 == "ASCII":
         if not setmsg.isascii():
-            details.append(
-                {
-                    "level": "Error",
-                    "message": "Message is not ASCII encoded",
-                }
-            )
+            details.add("Error", "Message is not ASCII encoded")
 
+    reference = None
     try:
         ### if i used parsed_msg returns error on report creation for some messages....dont know why
-        parse_message(set_reference(setmsg, hl7version)).validate(
-            report_file="report.txt"
-        )
-
+        reference = context.reference_message(hl7version)
+        problem = context.validate(reference)
     except Exception as err:
-        app.logger.error("Error Creating Report: {}".format(err))
-        if "reference" in str(err):
-            # For v2.3 and earlier, skip structure validation if reference error
+        problem = err
+    structure_checked = True
+    if problem is not None:
+        app.logger.error("Error Creating Report: %s", problem)
+        if "reference" in str(problem):
+            # For v2.3 and earlier, skip hl7apy structure validation if reference error,
+            # the structure automaton checks the segments below
             if hl7version in ["2.1", "2.2", "2.3"]:
-                app.logger.info("Skipping structure validation for v2.3 message due to reference error")
-                # Create empty report file so the rest of the code works
-                with open("report.txt", "w") as f:
-                    pass
+                app.logger.info("Skipping hl7apy structure validation for v2.3 message due to reference error")
+                structure_checked = False
+                # Start from an empty report so the rest of the code works
+                context.report.consume()
             else:
                 resultmessage.statusCode = "Failed"
                 resultmessage.hl7version = hl7version
                 resultmessage.message = "[Error parsing message] Error on detecting message structure. Try changing MSH-9.3"
                 return resultmessage.__dict__
 
-    details, error = read_report("report.txt", details, error)
-
-    for seg in parse_message(setmsg).children:
-        try:
-            seg.validate(report_file="report.txt")
+    details, error = read_report(context.report, details, error)
+
+    # hl7apy checks how often segments occur, the structure automaton checks their order.
+    # When hl7apy could not check the structure, the automaton reports missing segments too
+    with stage("structure"):
+        segment_ids = context.tokens.segment_ids()
+        structure = reference.name if reference is not None else None
+        if structure is None:
+            code, event = (context.tokens.components(0, 9) + [""])[:2]
+            structure = find_structure(hl7version, code, event, segment_ids)
+        misplaced, missing = check_structure(hl7version, structure, segment_ids)
+    for index, segment_id in misplaced:
+        error = True
+        details.add(
+            "Error",
+            f"Segment {segment_id} at position {index + 1} is out of place in message structure {structure}",
+            make_location(segment_id, index),
+        )
+    if not structure_checked:
+        for index, segment_id in missing:
+            error = True
+            where = f"before position {index + 1}" if index < len(segment_ids) else "at the end"
+            details.add(
+                "Error",
+                f"Missing required segment {segment_id} {where} of message structure {structure}",
+                make_location(segment_id),
+            )
 
-        except Exception as e:
-            details, error = read_report("report.txt", details, error)
+    # Segments and their children were walked with the message already, unless the
+    # reference message differs, so these are lookups of the problems found then
+    for seg in context.tolerant_message().children:
+        context.check_deadline()
+        if context.validate(seg) is not None:
+            details, error = read_report(context.report, details, error)
         for child in seg.children:
-            try:
-                child.validate(report_file="report.txt")
-            except Exception as e:
-                error_msg = str(e)
-                # Log more descriptive error messages
-                if "reference" in error_msg:
-                    warning_msg = f"Validation skipped for segment {seg.name} child: missing reference structure"
-                    app.logger.warning(warning_msg)
-                    warnings.append(warning_msg)
-                else:
-                    warning_msg = f"Error validating segment {seg.name} child: {error_msg}"
-                    app.logger.warning(warning_msg)
-                    warnings.append(warning_msg)
-                    details, error = read_report("report.txt", details, error)
+            problem = context.validate(child)
+            if problem is None:
+                continue
+            error_msg = str(problem)
+            # Log more descriptive error messages
+            if "reference" in error_msg:
+                warning_msg = f"Validation skipped for segment {seg.name} child: missing reference structure"
+                app.logger.warning(warning_msg)
+                warnings.append(warning_msg)
+            else:
+                warning_msg = f"Error validating segment {seg.name} child: {error_msg}"
+                app.logger.warning(warning_msg)
+                warnings.append(warning_msg)
+                details, error = read_report(context.report, details, error)
     if error:
         status = "Failed"
         message = "Not valid"
     resultmessage.statusCode = status
-    resultmessage.details = details
+    resultmessage.details = details.to_list()
     resultmessage.warnings = warnings
     resultmessage.hl7version = hl7version
     resultmessage.message = message
@@ -375,6 +597,13 @@ def hl7validatorapi(msg, validation_level='tolerant'):
 
 
 def from_hl7_to_df(msg):
+    """
+    Flatten a message into a one column DataFrame with one row per field
+    :param msg: HL7 message
+    :return: the DataFrame, indexed by "<segment index>_<FIELD> (LONG_NAME)", and MSH-10
+    """
+    import pandas as pd  # only the converter needs pandas, import it on first use
+
     result2 = {}
 
     def get_field(hl7, num):
@@ -393,65 +622,193 @@ def from_hl7_to_df(msg):
     except UnsupportedVersion:
         m = parser.parse_message(msg)
 
-    file = m.msh.msh_10.value + ".csv"
     for index, child in enumerate(m.children):
         get_field(child, index)
 
-    df = pd.DataFrame.from_dict(result2, orient="index")
-    df.to_csv(file)
-    return file
+    return pd.DataFrame.from_dict(result2, orient="index"), m.msh.msh_10.value
+
 
+# Converter output formats by media type, in order of preference
+CONVERTER_FORMATS = {
+    "text/csv": "csv",
+    "application/json": "json",
+    "application/vnd.apache.parquet": "parquet",
+}
 
-def build_tree_structure(msg, validation):
+
+def serialize_df(df, fmt="csv"):
     """
-    Build a hierarchical tree structure of the HL7 message with segments, fields, components, and subcomponents.
-    Returns HTML for a collapsible tree view.
+    Serialize a from_hl7_to_df DataFrame in memory
+    :param fmt: "csv", "json" or "parquet"
+    :return: BytesIO positioned at the start
     """
-    hl7version = validation["hl7version"]
-    setmsg = set_message_to_validate(msg)
-
-    # Extract field locations with errors from validation details
-    error_fields = set()
-    if "details" in validation and validation["details"]:
-        for detail in validation["details"]:
-            if detail.get("level") in ["Error", "Warning"]:
-                message = detail.get("message", "")
-                # Parse error messages to extract field locations
-                # Examples: "Invalid datetime format on field PID.PID_7"
-                #           "PID.PID_5.2: max_length is 50 and length is 51"
-                import re
-                # Pattern 1: "on field SEG.SEG_N" or "field SEG.SEG_N"
-                match = re.search(r'field\s+([A-Z]{3})\.([A-Z]{3}_\d+)', message)
-                if match:
-                    segment = match.group(1)
-                    field_name = match.group(2)
-                    # Extract field number from field name (e.g., PID_7 -> 7)
-                    field_num = field_name.split('_')[1]
-                    error_fields.add(f"{segment}-{field_num}")
-                else:
-                    # Pattern 2: "SEG.SEG_N.C" or "SEG.SEG_N.C.S"
-                    match = re.search(r'^([A-Z]{3})\.([A-Z]{3}_\d+)(\.(\d+))?(\.(\d+))?:', message)
-                    if match:
-                        segment = match.group(1)
-                        field_name = match.group(2)
-                        component = match.group(4)
-                        subcomponent = match.group(6)
-                        field_num = field_name.split('_')[1]
-
-                        location = f"{segment}-{field_num}"
-                        if component:
-                            location += f".{component}"
-                        if subcomponent:
-                            location += f".{subcomponent}"
-                        error_fields.add(location)
-
-    def process_segment(segment, segment_id, hl7version):
-        """Process a single segment and return HTML"""
-        segment_html = ''
-
-        # This is an actual segment - render it
-        segment_html += f'''
-        <div class="tree-node segment-node">
+    buffer = io.BytesIO()
+    if fmt == "csv":
+        df.to_csv(buffer)
+    elif fmt == "json":
+        buffer.write(json.dumps(dict(zip(df.index, df[0] if len(df.columns) else []))).encode("utf-8"))
+    elif fmt == "parquet":
+        df.rename(columns={0: "value"}).rename_axis("field").to_parquet(buffer)
+    else:
+        raise ValueError(f"Unknown format {fmt}, expected one of csv, json, parquet")
+    buffer.seek(0)
+    return buffer
+
+
+def describe_element(index, element, segment_id, *parents):
+    """
+    Long name and datatype of a parsed element, from the metadata index when it knows it
+    :param index: MetadataIndex of the message version
+    :param parents: positions of the field (and component) the element belongs to
+    """
+    try:
+        position = int(element.name.rsplit("_", 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        position = None
+    if position is not None:
+        meta = index.lookup(segment_id, *parents, position)
+        # values with more parts than the reference allows were parsed without a datatype
+        if (meta is not None and meta.name == element.name
+                and (meta.children or not getattr(element, 'children', None))):
+            return meta.long_name, meta.datatype
+    return getattr(element, 'long_name', None), getattr(element, 'datatype', None)
+
+
+def tree_error_locations(validation):
+    """
+    Locations (e.g. PID-7, PID-5.2) of the errors and warnings of a validation, by segment
+    :return: dict of segment index to set of locations; details that do not tell which
+             segment they are about are keyed by segment id instead and apply to all of them
+    """
+    error_fields = {}
+    for detail in validation.get("details") or ():
+        if detail.get("level") not in ("Error", "Warning"):
+            continue
+        location = detail.get("location")
+        path = location_path(location)
+        if path is None:
+            continue
+        key = location["index"] if location["index"] is not None else location["segment"]
+        error_fields.setdefault(key, set()).add(path)
+    return error_fields
+
+
+def node_name(long_name, datatype, default):
+    name = long_name.replace("_", " ").title() if long_name else default
+    if datatype:
+        name = f"{name} ({datatype})"
+    return name
+
+
+# Stands for an element value hl7apy could not read
+MISSING = object()
+
+
+def segment_tree(segment, segment_id, hl7version, error_fields=()):
+    """
+    Fields, components and subcomponents of a parsed segment that have a value
+    :param segment: segment parsed by hl7apy
+    :param error_fields: locations in the segment to flag as errors, e.g. PID-7 (see tree_error_locations)
+    :return: list of nodes {"location", "name", "value", "error", "children"}, where
+             children is None for leaves and a list of nodes otherwise
+    """
+    index = get_index(hl7version)
+    fields = []
+    for field_idx, field in enumerate(segment.children, 1):
+        # Extract the actual field number from the field name (e.g., ORC_14 -> 14)
+        actual_field_num = field_idx
+        if hasattr(field, 'name') and '_' in field.name:
+            try:
+                actual_field_num = int(field.name.split('_')[1])
+            except (ValueError, IndexError):
+                actual_field_num = field_idx
+
+        # hl7apy serializes an element every time its value is read, so each value is read once
+        field_value = getattr(field, 'value', MISSING)
+        components = getattr(field, 'children', ())
+        component_values = [getattr(c, 'value', MISSING) for c in components]
+
+        # Skip only if field has no value AND no children with values
+        has_value = field_value is not MISSING and field_value is not None and field_value != ''
+        has_children_with_values = (len(components) > 0
+                                    and any(v is not MISSING and v is not None and v != '' for v in component_values))
+
+        if not has_value and not has_children_with_values:
+            continue
+
+        field_long_name, field_datatype = describe_element(index, field, segment_id)
+        field_name = node_name(field_long_name, field_datatype, 'Unknown Field')
+
+        field_location = f"{segment_id}-{actual_field_num}"
+        field_node = {
+            "location": field_location,
+            "name": field_name,
+            "value": str(field_value) if field_value is not MISSING else '',
+            "error": field_location in error_fields,
+            "children": None,
+        }
+        fields.append(field_node)
+
+        # Check if field has components
+        if not has_children_with_values:
+            continue
+
+        field_node["children"] = []
+        for comp_idx, (component, comp_value) in enumerate(zip(components, component_values), 1):
+            if comp_value is MISSING or comp_value is None:
+                continue
+
+            comp_long_name, comp_datatype = describe_element(index, component, segment_id, actual_field_num)
+            comp_location = f"{field_location}.{comp_idx}"
+            comp_node = {
+                "location": comp_location,
+                "name": node_name(comp_long_name, comp_datatype, f'Component {comp_idx}'),
+                "value": str(comp_value) if comp_value else '',
+                "error": comp_location in error_fields,
+                "children": None,
+            }
+            field_node["children"].append(comp_node)
+
+            # Check if component has subcomponents
+            subcomponents = getattr(component, 'children', ())
+            subcomponent_values = [getattr(sc, 'value', MISSING) for sc in subcomponents]
+            if not any(v is not MISSING and v for v in subcomponent_values):
+                continue
+
+            comp_node["children"] = []
+            for subcomp_idx, (subcomponent, subcomp_value) in enumerate(zip(subcomponents, subcomponent_values), 1):
+                if subcomp_value is MISSING or subcomp_value is None:
+                    continue
+
+                subcomp_long_name, subcomp_datatype = describe_element(
+                    index, subcomponent, segment_id, actual_field_num, comp_idx
+                )
+                subcomp_location = f"{comp_location}.{subcomp_idx}"
+                comp_node["children"].append({
+                    "location": subcomp_location,
+                    "name": node_name(subcomp_long_name, subcomp_datatype, f'Subcomponent {subcomp_idx}'),
+                    # subcomponent values are hl7apy datatype objects, not text
+                    "value": subcomponent.to_er7() if subcomp_value else '',
+                    "error": subcomp_location in error_fields,
+                    "children": None,
+                })
+    return fields
+
+
+def render_segment_header(segment_id, hl7version, index=None, errors=(), text=None):
+    """
+    Opening HTML of a segment node, up to its (collapsed) children container.
+    With an index the children are left to be loaded on demand by the tree view script,
+    which sends the segment line (text) on its own to /api/hl7/v1/tree/segment.
+    """
+    lazy = ''
+    if index is not None:
+        lazy = (
+            f' data-segment="{index}" data-errors="{html.escape(json.dumps(sorted(errors)))}"'
+            f' data-text="{html.escape(text or "")}"'
+        )
+    return f'''
+        <div class="tree-node segment-node"{lazy}>
             <div class="tree-toggle" onclick="toggleNode(this)">
                 <span class="toggle-icon">▶</span>
                 <span class="node-id">{segment_id}</span>
@@ -461,48 +818,23 @@ def build_tree_structure(msg, validation):
             <div class="tree-children" style="display: none;">
         '''
 
-        # Process fields
-        for field_idx, field in enumerate(segment.children, 1):
-            # Extract the actual field number from the field name (e.g., ORC_14 -> 14)
-            actual_field_num = field_idx
-            if hasattr(field, 'name') and '_' in field.name:
-                try:
-                    actual_field_num = int(field.name.split('_')[1])
-                except (ValueError, IndexError):
-                    actual_field_num = field_idx
-
-            # Skip only if field has no value AND no children with values
-            has_value = hasattr(field, 'value') and field.value is not None and field.value != ''
-            has_children_with_values = (hasattr(field, 'children') and len(field.children) > 0
-                                       and any(hasattr(c, 'value') and c.value is not None and c.value != '' for c in field.children))
-
-            if not has_value and not has_children_with_values:
-                continue
-
-            field_long_name = getattr(field, 'long_name', None)
-            # Get datatype directly from the field object
-            field_datatype = getattr(field, 'datatype', None)
-            field_name = (field_long_name.replace("_", " ").title() if field_long_name else 'Unknown Field')
-            if field_datatype:
-                field_name = f"{field_name} ({field_datatype})"
-
-            # Debug logging for first few fields
-            if segment_id == 'PID' and actual_field_num <= 5:
-                app.logger.info(f"PID-{actual_field_num}: datatype={field_datatype}, field_name={field_name}")
 
-            field_location = f"{segment_id}-{actual_field_num}"
-            field_value = str(getattr(field, 'value', '')) if hasattr(field, 'value') else ''
-
-            # Check if this field has an error
-            field_has_error = field_location in error_fields
-            error_class = ' error' if field_has_error else ''
+def render_segment_tree(fields, segment_id, hl7version, out):
+    """
+    HTML of a segment node and all of its descendants, from segment_tree
+    :param out: list the HTML fragments are appended to
+    """
+    out.append(render_segment_header(segment_id, hl7version))
 
-            # Check if field has components
-            has_components = hasattr(field, 'children') and len(field.children) > 0
+    for field in fields:
+        field_location = field["location"]
+        field_name = field["name"]
+        field_value = field["value"]
+        error_class = ' error' if field["error"] else ''
 
-            if has_components and has_children_with_values:
-                # Field with components
-                segment_html += f'''
+        if field["children"] is not None:
+            # Field with components
+            out.append(f'''
                 <div class="tree-node field-node">
                     <div class="tree-toggle" onclick="toggleNode(this)">
                         <span class="toggle-icon">▶</span>
@@ -511,32 +843,17 @@ def build_tree_structure(msg, validation):
                         <span class="node-value{error_class}">{field_value[:50]}{'...' if len(field_value) > 50 else ''}</span>
                     </div>
                     <div class="tree-children" style="display: none;">
-                '''
-
-                # Process components
-                for comp_idx, component in enumerate(field.children, 1):
-                    if not hasattr(component, 'value') or component.value is None:
-                        continue
-
-                    comp_long_name = getattr(component, 'long_name', None)
-                    # Get datatype directly from the component object
-                    comp_datatype = getattr(component, 'datatype', None)
-                    comp_name = (comp_long_name.replace("_", " ").title() if comp_long_name else f'Component {comp_idx}')
-                    if comp_datatype:
-                        comp_name = f"{comp_name} ({comp_datatype})"
-                    comp_location = f"{field_location}.{comp_idx}"
-                    comp_value = str(component.value) if component.value else ''
-
-                    # Check if this component has an error
-                    comp_has_error = comp_location in error_fields
-                    comp_error_class = ' error' if comp_has_error else ''
-
-                    # Check if component has subcomponents
-                    has_subcomponents = hasattr(component, 'children') and len(component.children) > 0
-
-                    if has_subcomponents and any(hasattr(sc, 'value') and sc.value for sc in component.children):
-                        # Component with subcomponents
-                        segment_html += f'''
+                ''')
+
+            for component in field["children"]:
+                comp_location = component["location"]
+                comp_name = component["name"]
+                comp_value = component["value"]
+                comp_error_class = ' error' if component["error"] else ''
+
+                if component["children"] is not None:
+                    # Component with subcomponents
+                    out.append(f'''
                         <div class="tree-node component-node">
                             <div class="tree-toggle" onclick="toggleNode(this)">
                                 <span class="toggle-icon">▶</span>
@@ -545,43 +862,27 @@ def build_tree_structure(msg, validation):
                                 <span class="node-value{comp_error_class}">{comp_value[:50]}{'...' if len(comp_value) > 50 else ''}</span>
                             </div>
                             <div class="tree-children" style="display: none;">
-                        '''
-
-                        # Process subcomponents
-                        for subcomp_idx, subcomponent in enumerate(component.children, 1):
-                            if not hasattr(subcomponent, 'value') or subcomponent.value is None:
-                                continue
-
-                            subcomp_long_name = getattr(subcomponent, 'long_name', None)
-                            # Get datatype directly from the subcomponent object
-                            subcomp_datatype = getattr(subcomponent, 'datatype', None)
-                            subcomp_name = (subcomp_long_name.replace("_", " ").title() if subcomp_long_name else f'Subcomponent {subcomp_idx}')
-                            if subcomp_datatype:
-                                subcomp_name = f"{subcomp_name} ({subcomp_datatype})"
-                            subcomp_location = f"{comp_location}.{subcomp_idx}"
-                            subcomp_value = str(subcomponent.value) if subcomponent.value else ''
-
-                            # Check if this subcomponent has an error
-                            subcomp_has_error = subcomp_location in error_fields
-                            subcomp_error_class = ' error' if subcomp_has_error else ''
-
-                            segment_html += f'''
+                        ''')
+
+                    for subcomponent in component["children"]:
+                        subcomp_error_class = ' error' if subcomponent["error"] else ''
+                        out.append(f'''
                             <div class="tree-node subcomponent-node">
                                 <div class="tree-item">
-                                    <span class="node-id{subcomp_error_class}">{subcomp_location}</span>
-                                    <span class="node-name{subcomp_error_class}">{subcomp_name}</span>
-                                    <span class="node-value{subcomp_error_class}">{subcomp_value}</span>
+                                    <span class="node-id{subcomp_error_class}">{subcomponent["location"]}</span>
+                                    <span class="node-name{subcomp_error_class}">{subcomponent["name"]}</span>
+                                    <span class="node-value{subcomp_error_class}">{subcomponent["value"]}</span>
                                 </div>
                             </div>
-                            '''
+                            ''')
 
-                        segment_html += '''
+                    out.append('''
                             </div>
                         </div>
-                        '''
-                    else:
-                        # Component without subcomponents (leaf node)
-                        segment_html += f'''
+                        ''')
+                else:
+                    # Component without subcomponents (leaf node)
+                    out.append(f'''
                         <div class="tree-node component-node">
                             <div class="tree-item">
                                 <span class="node-id{comp_error_class}">{comp_location}</span>
@@ -589,15 +890,15 @@ def build_tree_structure(msg, validation):
                                 <span class="node-value{comp_error_class}">{comp_value}</span>
                             </div>
                         </div>
-                        '''
+                        ''')
 
-                segment_html += '''
+            out.append('''
                     </div>
                 </div>
-                '''
-            else:
-                # Field without components (leaf node)
-                segment_html += f'''
+                ''')
+        else:
+            # Field without components (leaf node)
+            out.append(f'''
                 <div class="tree-node field-node">
                     <div class="tree-item">
                         <span class="node-id{error_class}">{field_location}</span>
@@ -605,164 +906,364 @@ def build_tree_structure(msg, validation):
                         <span class="node-value{error_class}">{field_value}</span>
                     </div>
                 </div>
-                '''
+                ''')
 
-        segment_html += '''
+    out.append('''
             </div>
         </div>
-        '''
+        ''')
 
-        return segment_html
+    return out
 
-    tree_html = '<div class="hl7-tree">'
 
-    # Parse segments directly from raw message like highlight_message does
-    for seg_line in setmsg.split("\r"):
-        segment_id = seg_line[0:3]
-        if len(segment_id) < 3:
-            continue
-        try:
-            parsed_segment = parse_segment(seg_line, version=hl7version)
-            tree_html += process_segment(parsed_segment, segment_id, hl7version)
-        except Exception as e:
-            app.logger.error(f"Error parsing segment {segment_id}: {e}")
-            continue
+def flag_errors(nodes, error_fields):
+    """
+    Copy of segment_tree nodes with the error flag set on those whose location is in
+    error_fields; the nodes themselves are left as they are, they may be cached
+    """
+    return [
+        dict(node, error=node["location"] in error_fields,
+             children=flag_errors(node["children"], error_fields) if node["children"] else node["children"])
+        for node in nodes
+    ]
 
-    tree_html += '</div>'
 
-    return tree_html, validation
+def render_tree(segments, validation, hl7version, lazy=False):
+    """
+    Tree view HTML
+    :param segments: list of (segment index, segment id, segment_tree nodes or the segment line when lazy)
+    :param validation: validation result, its details flag the nodes in error
+    :param lazy: render segment headers only
+    """
+    error_fields = tree_error_locations(validation)
+    out = ['<div class="hl7-tree">']
+    for seg_idx, segment_id, fields in segments:
+        errors = error_fields.get(seg_idx, set()) | error_fields.get(segment_id, set())
+        if lazy:
+            out.append(render_segment_header(segment_id, hl7version, seg_idx, errors, text=fields))
+            out.append('''
+            </div>
+        </div>
+        ''')
+        else:
+            render_segment_tree(flag_errors(fields, errors), segment_id, hl7version, out)
+    out.append('</div>')
+    return "".join(out)
 
 
-def highlight_message(msg, validation):
+def build_tree_structure(msg, validation, context=None, lazy=False):
+    """
+    Build a hierarchical tree structure of the HL7 message with segments, fields, components, and subcomponents.
+    Returns HTML for a collapsible tree view.
+    :param lazy: render segment headers only, their children are fetched from
+                 /api/hl7/v1/tree/segment when expanded (see segment_subtree)
+    """
     hl7version = validation["hl7version"]
+    if context is None:
+        context = ValidationContext(msg)
+
+    segments = []
+    with stage("tree"):
+        # Parse segments directly from raw message like highlight_message does
+        for seg_idx in range(len(context.segments)):
+            segment_id = context.tokens.segment_id(seg_idx)
+            if len(segment_id) < 3:
+                continue
+            if lazy:
+                segments.append((seg_idx, segment_id, context.segments[seg_idx]))
+                continue
+            try:
+                segments.append((seg_idx, segment_id, tree_nodes(context, seg_idx, segment_id, hl7version)))
+            except Exception as e:
+                app.logger.error("Error parsing segment %s: %s", segment_id, e)
+                continue
 
-    setmsg = set_message_to_validate(msg)
-    highligmsg = ""
-    for seg in setmsg.split("\r"):
-        segment_id = seg[0:3]
-        if len(segment_id) < 3:
-            continue
+        return render_tree(segments, validation, hl7version, lazy), validation
+
+
+def segment_subtree(msg, index, hl7version=None, errors=(), text=None):
+    """
+    Tree of one segment of a message, for the lazy tree view
+    :param msg: the message, only tokenized when the segment line is not given
+    :param index: position of the segment in the message
+    :param hl7version: version to parse the segment with, read from the message when not given
+    :param errors: locations to flag as errors
+    :param text: the segment line, parsed on its own; the tree view sends it instead of the
+                 message so expanding a segment costs the size of the segment
+    :return: dictionary with the segment id, version and fields (see segment_tree)
+    :raises IndexError: when the message has no segment at index
+    :raises ValueError: when the segment line is given without a version
+    """
+    if text is not None:
+        if not hl7version:
+            raise ValueError("hl7version is required with the segment text")
+        context = ValidationContext(text)
+        position = 0
+    else:
+        context = ValidationContext(msg)
+        if not 0 <= index < len(context.segments):
+            raise IndexError(f"No segment at index {index}")
+        if not hl7version:
+            hl7version = context.parse().version
+        position = index
+    # a segment on its own has no MSH-9 to read the message type from
+    metrics.label(hl7version, message_type(context) if text is None else None)
+    segment_id = context.tokens.segment_id(position)
+    with stage("tree"):
+        fields = flag_errors(tree_nodes(context, position, segment_id, hl7version), set(errors))
+    return {
+        "segment": segment_id,
+        "index": index,
+        "hl7version": hl7version,
+        "fields": fields,
+    }
+
+
+@lru_cache(maxsize=4096)
+def validate_detached_field(hl7version, name, value):
+    """
+    Validate a field value on its own, outside of its segment.
+    Memoized because the same values repeat across segments and messages.
+    :return: the field value as hl7apy reads it back and the type and arguments of the
+             validation error, if any
+    """
+    f = Field(name, version=hl7version)
+    f.value = value
+    try:
+        f.validate()
+    except Exception as e:
+        # not the exception itself, it would keep the frames of every request raising it again
+        return f.value, (type(e), e.args)
+    return f.value, None
+
+
+def highlight_segment(
+    fields,
+    segment_id,
+    parsed,
+    hl7version,
+    validation,
+    out,
+    position=None,
+    repetition=datatypes.REPETITION_SEPARATOR,
+):
+    """
+    Highlighted HTML of one segment line, with a tooltip and error marker per field
+    :param fields: fields of the segment line, the segment id first (see Tokens.fields)
+    :param parsed: the segment parsed by hl7apy
+    :param validation: validation result, date format errors and field warnings are added to it
+    :param out: list the HTML fragments are appended to
+    :param position: index of the segment in the message, for the location of the errors
+    :param repetition: repetition separator of the message (MSH-2)
+    """
+    index = get_index(hl7version)
+    max_field = 0
+    list_of_segments = set()
+    for s in parsed.children:
+        s = str(s)
+        if "Field of type None" not in s and s not in list_of_segments:
+            max_field += 1
+            list_of_segments.add(s)
+    out.append('<p class="segment ' + segment_id + '">')
+    out.append(
+        '<span style="margin-right: 5px;"><b>'
+        + '<a href="https://hl7-definition.caristix.com/v2/HL7v'
+        + hl7version
+        + "/Segments/"
+        + segment_id
+        + '" target="_blank">'
+        + segment_id
+        + "</a></b></span>"
+    )
+    counter = 0
+    for idx, field in enumerate(fields[1:]):
+        warningfield = False
+        field_name = "Unknown field"
+        if segment_id == "MSH":
+            add = 2
+        else:
+            add = 1
         try:
-            p = parse_segment(seg, version=hl7version)
+            field_identifier = segment_id + "_" + str(idx + add)
+            meta = index.field(segment_id, idx + add)
+            value, field_error = validate_detached_field(hl7version, field_identifier, field)
 
-        except Exception as e:
-            return "<p> [Error parsing message] </p>" + str(e), validation
-        max_field = 0
-        list_of_segments = []
-        for s in p.children:
-            if "Field of type None" not in str(s) and str(s) not in list_of_segments:
-                max_field += 1
-                list_of_segments.append(str(s))
-        newseg = (
-            '<span style="margin-right: 5px;"><b>'
-            + '<a href="https://hl7-definition.caristix.com/v2/HL7v'
-            + hl7version
-            + "/Segments/"
-            + segment_id
-            + '" target="_blank">'
-            + segment_id
-            + "</a></b></span>"
-        )
-        counter = 0
-        for idx, field in enumerate(seg.split("|")[1:]):
-            warningfield = False
-            field_name = "Unknown field"
-            if segment_id == "MSH":
-                add = 2
-            else:
-                add = 1
-            try:
-                field_identifier = segment_id + "_" + str(idx + add)
-                f = Field(field_identifier, version=hl7version)
-                f.value = field
-
-                if (
-                    f.datatype == "DTM" or f.datatype == "TS"
-                ) and f.value != "":  # check date format
-                    chk, _ = check_format(f.value)
-                    if not chk:
-                        warningfield = True
-
-                        validation["details"].append(
-                            {
-                                "level": "Error",
-                                "message": "Invalid datetime format on field "
-                                + segment_id
-                                + "."
-                                + f.name,
-                            }
-                        )
-
-                if f.datatype == "DT" and f.value != "":  # check date format
-                    chk, _ = check_simple_format(f.value)
-                    if not chk:
-                        warningfield = True
-                        validation["details"].append(
-                            {
-                                "level": "Error",
-                                "message": "Invalid date format on field "
-                                + segment_id
-                                + "."
-                                + f.name,
-                            }
-                        )
-                field_name = f.long_name.replace("_", " ").lower().title()
-                f.validate()
-            except AttributeError as e:
-                # Field object is None or doesn't have expected attributes
-                warning_msg = f"Could not validate field {segment_id}-{idx + add}: field may not be defined in HL7 v{hl7version} specification or has unexpected structure"
-                app.logger.warning(warning_msg)
-                if "warnings" not in validation:
-                    validation["warnings"] = []
-                validation["warnings"].append(warning_msg)
+            spec = datatypes.DATATYPES.get(meta.datatype)
+            if spec is not None and not datatypes.is_valid(meta.datatype, value, separator=repetition):
                 warningfield = True
-                counter -= 1
-            except Exception as e:
-                # Other validation errors (invalid field name, etc.)
-                error_msg = str(e)
-                if "Invalid name" in error_msg or "not found" in error_msg.lower():
-                    warning_msg = f"Field {segment_id}-{idx + add} not found in HL7 v{hl7version} specification: {error_msg}"
-                else:
-                    warning_msg = f"Error validating field {segment_id}-{idx + add}: {error_msg}"
-                app.logger.warning(warning_msg)
-                if "warnings" not in validation:
-                    validation["warnings"] = []
-                validation["warnings"].append(warning_msg)
-                warningfield = True
-                counter -= 1
-
-            class_ = "note"
-            if field != "":
-                counter += 1
-
-                if counter > max_field or warningfield:
-                    class_ = "note error"
-            if segment_id == "MSH" and idx == 0:
-                newseg += (
-                    '<span class="span-group"><span class="tooltiptext">'
-                    + "Field Separator"
-                    + '</span><span  class="'
-                    + class_
-                    + '">'
-                    + segment_id
-                    + "-"
-                    + "1"
-                    + '</span><span class="field main-content">'
-                    + "|"
-                    + "</span></span>"
+                validation["details"].append(
+                    make_detail(
+                        "Error",
+                        spec.label + " on field " + segment_id + "." + meta.name,
+                        make_location(segment_id, position, idx + add),
+                    )
                 )
-            newseg += (
+            field_name = meta.long_name.replace("_", " ").lower().title()
+            if field_error:
+                error, args = field_error
+                raise error(*args) from None
+        except AttributeError as e:
+            # Field object is None or doesn't have expected attributes
+            warning_msg = f"Could not validate field {segment_id}-{idx + add}: field may not be defined in HL7 v{hl7version} specification or has unexpected structure"
+            app.logger.warning(warning_msg)
+            if "warnings" not in validation:
+                validation["warnings"] = []
+            validation["warnings"].append(warning_msg)
+            warningfield = True
+            counter -= 1
+        except Exception as e:
+            # Other validation errors (invalid field name, etc.)
+            error_msg = str(e)
+            if "Invalid name" in error_msg or "not found" in error_msg.lower():
+                warning_msg = f"Field {segment_id}-{idx + add} not found in HL7 v{hl7version} specification: {error_msg}"
+            else:
+                warning_msg = f"Error validating field {segment_id}-{idx + add}: {error_msg}"
+            app.logger.warning(warning_msg)
+            if "warnings" not in validation:
+                validation["warnings"] = []
+            validation["warnings"].append(warning_msg)
+            warningfield = True
+            counter -= 1
+
+        class_ = "note"
+        if field != "":
+            counter += 1
+
+            if counter > max_field or warningfield:
+                class_ = "note error"
+        if segment_id == "MSH" and idx == 0:
+            out.append(
                 '<span class="span-group"><span class="tooltiptext">'
-                + field_name
-                + '</span><span class="'
+                + "Field Separator"
+                + '</span><span  class="'
                 + class_
                 + '">'
                 + segment_id
                 + "-"
-                + str(idx + add)
+                + "1"
                 + '</span><span class="field main-content">'
-                + field
+                + "|"
                 + "</span></span>"
             )
-        highligmsg += '<p class="segment ' + segment_id + '">' + newseg + "</p>"
-    return highligmsg, validation
+        out.append(
+            '<span class="span-group"><span class="tooltiptext">'
+            + field_name
+            + '</span><span class="'
+            + class_
+            + '">'
+            + segment_id
+            + "-"
+            + str(idx + add)
+            + '</span><span class="field main-content">'
+            + field
+            + "</span></span>"
+        )
+    out.append("</p>")
+    return out
+
+
+def highlight_line(context, index, segment_id, hl7version, validation, out):
+    """
+    highlight_segment for the segment at index, with the fragments and problems of
+    segments seen before taken from the segment cache
+    :raises: the error parsing the segment raised
+    """
+    # results of messages that failed before validation have no details list,
+    # highlight_segment reports their problems as warnings then
+    collect_details = isinstance(validation["details"], list)
+
+    def build(parsed):
+        fragments, found = [], {"details": [] if collect_details else "", "warnings": []}
+        highlight_segment(
+            context.tokens.fields(index),
+            segment_id,
+            parsed,
+            hl7version,
+            found,
+            fragments,
+            repetition=context.tokens.delimiters.repetition,
+        )
+        return fragments, found["details"], found["warnings"]
+
+    part = "highlight" if collect_details else "highlight_without_details"
+    fragments, details, warnings = context.segment_part(index, hl7version, part, build)
+    out.extend(fragments)
+    for detail in details:
+        validation["details"].append(dict(detail, location=dict(detail["location"], index=index)))
+    if warnings:
+        if "warnings" not in validation:
+            validation["warnings"] = []
+        validation["warnings"].extend(warnings)
+    return out
+
+
+def tree_nodes(context, index, segment_id, hl7version):
+    """
+    segment_tree nodes of the segment at index, shared with other messages through the
+    segment cache; flag_errors copies them before flagging
+    :raises: the error parsing the segment raised
+    """
+    return context.segment_part(
+        index, hl7version, "tree", lambda parsed: segment_tree(parsed, segment_id, hl7version)
+    )
+
+
+def highlight_message(msg, validation, context=None):
+    hl7version = validation["hl7version"]
+    if context is None:
+        context = ValidationContext(msg)
+
+    out = []
+    tokens = context.tokens
+    with stage("highlight"):
+        for seg_idx in range(len(context.segments)):
+            segment_id = tokens.segment_id(seg_idx)
+            if len(segment_id) < 3:
+                continue
+            try:
+                highlight_line(context, seg_idx, segment_id, hl7version, validation, out)
+            except Exception as e:
+                return "<p> [Error parsing message] </p>" + str(e), validation
+    return "".join(out), validation
+
+
+def render_message(msg, validation, context=None, lazy_tree=False):
+    """
+    Highlighted message and tree view in a single pass over the segments.
+    Same output as highlight_message followed by build_tree_structure, with
+    every segment parsed and walked once and the HTML buffered in lists.
+    :param lazy_tree: render the tree's segment headers only
+    :return: highlighted HTML, tree HTML and the validation result
+    """
+    hl7version = validation["hl7version"]
+    if context is None:
+        context = ValidationContext(msg)
+
+    highlighted = []
+    highlight_error = None
+    segments = []
+    tokens = context.tokens
+    for seg_idx in range(len(context.segments)):
+        segment_id = tokens.segment_id(seg_idx)
+        if len(segment_id) < 3:
+            continue
+        if lazy_tree:
+            segments.append((seg_idx, segment_id, context.segments[seg_idx]))
+        if highlight_error is None:
+            try:
+                with stage("highlight"):
+                    highlight_line(context, seg_idx, segment_id, hl7version, validation, highlighted)
+            except Exception as e:
+                # the highlight view stops at the first segment it cannot parse, the tree skips it
+                highlight_error = "<p> [Error parsing message] </p>" + str(e)
+        if not lazy_tree:
+            try:
+                with stage("tree"):
+                    segments.append((seg_idx, segment_id, tree_nodes(context, seg_idx, segment_id, hl7version)))
+            except Exception as e:
+                app.logger.error("Error parsing segment %s: %s", segment_id, e)
+
+    # the tree flags the errors found while highlighting too
+    with stage("tree"):
+        tree = render_tree(segments, validation, hl7version, lazy_tree)
+    return highlight_error or "".join(highlighted), tree, validation
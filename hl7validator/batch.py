@@ -0,0 +1,135 @@
+"""Batch validation of many HL7 v2 messages across a pool of worker processes."""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from hl7validator import app
+from hl7validator.api import hl7validatorapi, resultMessage
+
+_pool = None
+_pool_pid = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers=None):
+    """
+    Process pool shared by the batch endpoints of this process.
+    Created on first use, and again after a fork (e.g. in each gunicorn worker)
+    or when more workers are asked for than the current pool has.
+    :param workers: minimum number of worker processes, defaults to BATCH_WORKERS
+    """
+    global _pool, _pool_pid, _pool_size
+    workers = workers or app.config["BATCH_WORKERS"]
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid() or _pool_size < workers:
+            if _pool is not None and _pool_pid == os.getpid():
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers)
+            _pool_pid = os.getpid()
+            _pool_size = workers
+        return _pool
+
+
+def validate_item(item, validation_level="tolerant"):
+    """
+    Validate one batch entry
+    :param item: message string or dict with "data" and optional "validation_level"
+    :param validation_level: level used when the entry does not set its own
+    :return: Dictionary with validation results
+    """
+    if isinstance(item, dict):
+        msg = item.get("data")
+        validation_level = item.get("validation_level", validation_level)
+    else:
+        msg = item
+    if not msg or not isinstance(msg, str):
+        resultmessage = resultMessage()
+        resultmessage.statusCode = "Failed"
+        resultmessage.hl7version = None
+        resultmessage.message = "[Error parsing message] No message"
+        return resultmessage.__dict__
+    return hl7validatorapi(msg, validation_level=validation_level)
+
+
+def iter_ndjson(lines):
+    """
+    Read batch entries from NDJSON, one JSON string or object per line.
+    Lines that are not valid JSON become empty entries and fail validation on their own.
+    :param lines: iterable of text or bytes lines, e.g. the request stream
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            app.logger.warning("Invalid NDJSON line in batch")
+            yield None
+
+
+def _validate_chunk(items, validation_level="tolerant", timed=False):
+    if not timed:
+        return [validate_item(item, validation_level) for item in items]
+    results = []
+    for item in items:
+        start = time.perf_counter()
+        result = validate_item(item, validation_level)
+        results.append((result, time.perf_counter() - start))
+    return results
+
+
+def iter_validate(items, validation_level="tolerant", workers=None, chunksize=None, timed=False):
+    """
+    Validate messages in parallel, yielding results in input order.
+
+    Items are consumed lazily and only a bounded number of chunks is in flight at
+    once, so any iterable (including a stream) can be validated with flat memory.
+    :param items: iterable of batch entries (see validate_item)
+    :param validation_level: default validation level for entries without one
+    :param workers: workers to keep busy (1 validates in-process), defaults to BATCH_WORKERS
+    :param chunksize: messages sent to a worker per task, defaults to BATCH_CHUNKSIZE
+    :param timed: yield (result, seconds spent validating) tuples instead of results
+    """
+    workers = workers or app.config["BATCH_WORKERS"]
+    work = partial(_validate_chunk, validation_level=validation_level, timed=timed)
+    items = iter(items)
+    chunksize = chunksize or app.config["BATCH_CHUNKSIZE"]
+    chunks = iter(lambda: list(islice(items, chunksize)), [])
+
+    if workers <= 1:
+        for chunk in chunks:
+            yield from work(chunk)
+        return
+
+    pool = get_pool(workers)
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.submit(work, chunk))
+        if len(pending) >= workers * 2:
+            yield from pending.popleft().result()
+    while pending:
+        yield from pending.popleft().result()
+
+
+def validate_batch(items, validation_level="tolerant", workers=None):
+    """
+    Validate a list of messages in parallel
+    :param items: list of batch entries (see validate_item)
+    :param validation_level: default validation level for entries without one
+    :param workers: workers to keep busy (1 validates in-process), defaults to BATCH_WORKERS
+    :return: list of validation results, in input order
+    """
+    workers = workers or app.config["BATCH_WORKERS"]
+    if len(items) <= 1:
+        return [validate_item(item, validation_level) for item in items]
+    # Small batches get smaller chunks so every worker has something to do
+    chunksize = max(1, min(app.config["BATCH_CHUNKSIZE"], -(-len(items) // (workers * 4))))
+    return list(iter_validate(items, validation_level, workers, chunksize))
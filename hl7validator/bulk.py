@@ -0,0 +1,222 @@
+"""
+Offline bulk validation of HL7 v2 files, directories and globs.
+
+Files are split into messages (batch envelopes FHS/BHS/BTS/FTS are dropped),
+validated across the batch worker processes and written as one JSON line per
+message, followed by a throughput summary. The field formats the web form
+checks while highlighting (dates, times, numbers, coded value lengths) are
+checked a chunk of messages at a time, column by column (see
+datatypes.check_table), and added to the details of the results.
+"""
+
+import glob
+import json
+import math
+import os
+import sys
+import time
+from collections import deque
+
+from hl7validator import app
+from hl7validator.batch import iter_validate
+from hl7validator.datatypes import COLUMN_PATH, DATATYPES, check_table
+from hl7validator.details import make_detail, make_location
+from hl7validator.metadata import get_index
+
+ENVELOPE_SEGMENTS = ("FHS", "BHS", "BTS", "FTS")
+FRAMING_CHARS = "\x0b\x1c"
+
+# messages whose field formats are checked together
+FORMAT_CHECK_CHUNK = 1000
+
+
+def iter_files(paths):
+    """
+    Expand files, directories (recursively) and glob patterns into file paths
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        elif os.path.isfile(path):
+            yield path
+        else:
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                app.logger.warning("No files match %s", path)
+            yield from iter_files(matches)
+
+
+def report_missing(paths):
+    """
+    Print the paths that are no file or directory and match no file as a glob pattern to stderr
+    :return: whether any path is missing
+    """
+    missing = [path for path in paths if not os.path.exists(path) and not glob.glob(path, recursive=True)]
+    for path in missing:
+        print(f"No files match {path}", file=sys.stderr)
+    return bool(missing)
+
+
+def split_messages(lines):
+    """
+    Split the lines of a file into messages, one per MSH segment
+    :param lines: iterable of segment lines, with any line terminator
+    :return: generator of messages with segments separated by carriage returns
+    """
+    segments = []
+    for line in lines:
+        line = line.strip("\r\n").strip(FRAMING_CHARS)
+        if not line.strip():
+            continue
+        if line.startswith("MSH"):
+            if segments:
+                yield "\r".join(segments)
+            segments = [line]
+        elif line.startswith(ENVELOPE_SEGMENTS):
+            if segments:
+                yield "\r".join(segments)
+            segments = []
+        elif segments:
+            segments.append(line)
+    if segments:
+        yield "\r".join(segments)
+
+
+def iter_messages(paths, encoding="utf-8"):
+    """
+    Yield (file, index in file, message) for every message in the given paths
+    """
+    for path in iter_files(paths):
+        # universal newlines split segments on \r, \n and \r\n alike
+        with open(path, encoding=encoding, errors="replace") as file:
+            for index, msg in enumerate(split_messages(file)):
+                yield path, index, msg
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile: the smallest value with at least fraction of the values at or below it
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def add_format_details(messages, results):
+    """
+    Add the field format problems of messages to their results, checked column by column
+    for all the messages of a version at once. A valid message with a format problem is
+    not valid anymore, as its details now have an error.
+    :param messages: list of messages
+    :param results: their validation results, the details of those with a version are extended
+    """
+    from hl7validator.columnar import convert_messages
+
+    by_version = {}
+    for position, result in enumerate(results):
+        if result.get("hl7version") and isinstance(result.get("details"), list):
+            by_version.setdefault(result["hl7version"], []).append(position)
+    for version, positions in by_version.items():
+        frame = convert_messages(messages[position] for position in positions).to_dataframe()
+        invalid = ~check_table(frame, version)
+        index = get_index(version)
+        for column in invalid.columns:
+            rows = invalid[column].to_numpy().nonzero()[0]
+            if not len(rows):
+                continue
+            path = COLUMN_PATH.fullmatch(column)
+            segment_id, field = path.group("segment"), int(path.group("field"))
+            meta = index.field(segment_id, field)
+            spec = DATATYPES.get(meta.datatype)
+            problem = spec.label if spec is not None else "Value over max length"
+            detail = make_detail(
+                "Error", problem + " on field " + segment_id + "." + meta.name, make_location(segment_id, None, field)
+            )
+            for row in rows:
+                result = results[positions[row]]
+                # a repeated segment (OBX[2]) has the same problem as the first one
+                if detail not in result["details"]:
+                    result["details"].append(dict(detail))
+                if result["statusCode"] == "Success":
+                    result["statusCode"], result["message"] = "Failed", "Not valid"
+
+
+def validate_paths(paths, output, validation_level="tolerant", workers=None, encoding="utf-8", check_formats=True):
+    """
+    Validate every message found in paths and write one JSON line per message
+    :param paths: files, directories or glob patterns
+    :param output: text stream the JSON lines are written to
+    :param validation_level: validation level used for every message
+    :param workers: worker processes, defaults to BATCH_WORKERS
+    :param encoding: encoding of the input files
+    :param check_formats: add the field format problems to the details, see add_format_details
+    :return: summary dictionary
+    """
+    sources = deque()
+
+    def messages():
+        for path, index, msg in iter_messages(paths, encoding):
+            sources.append((path, index, msg))
+            yield msg
+
+    def write(chunk):
+        nonlocal failed
+        if check_formats:
+            add_format_details([msg for _, _, msg, _, _ in chunk], [result for _, _, _, result, _ in chunk])
+        # counted once the format problems are in
+        failed += sum(result["statusCode"] != "Success" for _, _, _, result, _ in chunk)
+        for path, index, _, result, elapsed in chunk:
+            output.write(
+                json.dumps({"file": path, "index": index, "latency_ms": round(elapsed * 1000, 3), **result})
+                + "\n"
+            )
+
+    latencies = []
+    failed = 0
+    chunk = []
+    start = time.perf_counter()
+    for result, elapsed in iter_validate(messages(), validation_level, workers, timed=True):
+        path, index, msg = sources.popleft()
+        latencies.append(elapsed)
+        chunk.append((path, index, msg, result, elapsed))
+        if len(chunk) >= FORMAT_CHECK_CHUNK:
+            write(chunk)
+            chunk = []
+    write(chunk)
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "messages": len(latencies),
+        "failed": failed,
+        "seconds": round(wall, 3),
+        "messages_per_second": round(len(latencies) / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run(args):
+    """
+    Entry point of the validate command
+    :return: process exit code, 1 when any message is not valid, 2 when a path matches no file
+    """
+    if report_missing(args.paths):
+        return 2
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        summary = validate_paths(
+            args.paths, output, args.validation_level, args.workers, args.encoding, not args.no_format_checks
+        )
+    finally:
+        if args.output:
+            output.close()
+    print(
+        "{messages} messages ({failed} not valid) in {seconds}s: "
+        "{messages_per_second} msg/s, p50 {p50_ms} ms, p99 {p99_ms} ms".format(**summary),
+        file=sys.stderr,
+    )
+    return 1 if summary["failed"] else 0
@@ -0,0 +1,167 @@
+"""In-process caches of validation results keyed by message content, and of rendered segments."""
+
+import copy
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from importlib.metadata import version, PackageNotFoundError
+
+from hl7validator import app
+from hl7validator.__version__ import __version__
+
+try:
+    HL7APY_VERSION = version("hl7apy")
+except PackageNotFoundError:
+    HL7APY_VERSION = "unknown"
+
+
+class LRUCache:
+    """
+    Bounded LRU store with hit, miss and eviction counters, shared by the threads of a worker.
+    Subclasses decide what goes into an entry and call _lookup and _store with the lock held.
+    :param maxsize: maximum number of entries kept, 0 disables the cache
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def _lookup(self, key, read):
+        """
+        Value read from the entry of key by read, a miss when there is no entry or read returns None
+        """
+        entry = self._data.get(key)
+        value = read(entry) if entry is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _store(self, key, entry):
+        """
+        Put an entry as the most recently used one, evicting the least recently used ones over maxsize
+        """
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def after_fork(self):
+        """
+        Count from zero in a forked worker, keeping the entries it inherits (e.g. from the warm-up)
+        """
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class ResultCache(LRUCache):
+    """
+    Bounded LRU cache of validation results with a time to live.
+
+    Keys are content hashes of the normalized message, the validation level and
+    the validator/hl7apy versions, so a retransmitted message is answered without
+    being parsed again. Results are copied in and out because callers extend them.
+    :param maxsize: maximum number of results kept, 0 disables the cache
+    :param ttl: seconds a result stays valid, 0 keeps results until evicted
+    """
+
+    def __init__(self, maxsize=0, ttl=0):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    @staticmethod
+    def key(setmsg, validation_level):
+        """
+        Cache key for a normalized message (see set_message_to_validate)
+        """
+        digest = hashlib.sha256(setmsg.encode("utf-8", "surrogatepass"))
+        digest.update(f"\0{validation_level}\0{__version__}\0{HL7APY_VERSION}".encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        :return: a copy of the cached result, None on a miss or when expired
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[0] > self.ttl:
+                del self._data[key]
+            result = self._lookup(key, lambda entry: entry[1])
+        return copy.deepcopy(result)
+
+    def set(self, key, result):
+        result = copy.deepcopy(result)
+        with self._lock:
+            self._store(key, (time.monotonic(), result))
+
+    def stats(self):
+        return dict(super().stats(), ttl=self.ttl)
+
+
+result_cache = ResultCache(app.config["RESULT_CACHE_SIZE"], app.config["RESULT_CACHE_TTL"])
+os.register_at_fork(after_in_child=result_cache.after_fork)
+
+
+class SegmentCache(LRUCache):
+    """
+    Bounded LRU cache of what rendering works out for a segment line, shared by every message.
+
+    Feeds repeat the same segments (MSH templates, EVN, standard PV1s, OBX lines)
+    across many messages, and the highlighted fields, their datatype problems and
+    the tree nodes of a segment only depend on its text, HL7 version and delimiters.
+    Entries are keyed by (version, delimiters, segment text) and hold one value per part ("highlight",
+    "tree"), or the message of the error parsing the segment raised. Values are shared, callers
+    copy what they change.
+    :param maxsize: maximum number of segments kept, 0 disables the cache
+    """
+
+    def get(self, key, part):
+        """
+        :return: the cached part of a segment, None on a miss
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            return self._lookup(key, lambda entry: entry.get(part))
+
+    def set(self, key, part, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._data.get(key, {})
+            entry[part] = value
+            self._store(key, entry)
+
+
+segment_cache = SegmentCache(app.config["SEGMENT_CACHE_SIZE"])
+os.register_at_fork(after_in_child=segment_cache.after_fork)
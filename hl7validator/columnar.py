@@ -0,0 +1,170 @@
+"""
+Columnar converter: many HL7 v2 messages flattened into one wide table.
+
+Every message is one row and every field path one column, e.g. ``MSH-10``,
+``PID-5`` or ``OBX[2]-5`` for the fifth field of the second OBX segment. Values
+are the ER7 text of the field, components and repetitions included. Fields are
+read straight from the message text and appended to per-column lists, so time
+and memory grow linearly with the number of messages; the table is then written
+as CSV, Parquet or Arrow in one go.
+"""
+
+import re
+import sys
+
+FORMATS = {".csv": "csv", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+
+SEGMENT_SEPARATOR = re.compile(r"\r\n|\r|\n")
+
+
+def import_pyarrow():
+    """
+    pyarrow, needed for Parquet and Arrow output only
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError(
+            "Parquet and Arrow output need pyarrow: pip install hl7validator-hl7pt[parquet]"
+        ) from None
+    return pyarrow
+
+
+def message_fields(msg):
+    """
+    Non-empty fields of a message by path, in message order
+    :param msg: ER7 message, segments separated by any line terminator
+    :return: generator of (path, value)
+    """
+    msg = msg.strip()
+    separator = msg[3] if msg.startswith("MSH") and len(msg) > 3 else "|"
+    occurrences = {}
+    for segment in SEGMENT_SEPARATOR.split(msg):
+        fields = segment.split(separator)
+        segment_id = fields[0].strip()
+        if not segment_id:
+            continue
+        occurrence = occurrences[segment_id] = occurrences.get(segment_id, 0) + 1
+        prefix = segment_id if occurrence == 1 else f"{segment_id}[{occurrence}]"
+        if segment_id == "MSH":
+            # MSH-1 is the field separator itself, so MSH-2 is the first split field
+            yield f"{prefix}-1", separator
+            start = 2
+        else:
+            start = 1
+        for position, value in enumerate(fields[1:], start):
+            if value:
+                yield f"{prefix}-{position}", value
+
+
+class ColumnarTable:
+    """
+    Table with one row per message and one column per field path, built column by column
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+
+    def append(self, msg):
+        """
+        Add a message as the next row
+        """
+        row = self.rows
+        columns = self.columns
+        for path, value in message_fields(msg):
+            column = columns.get(path)
+            if column is None:
+                column = columns[path] = [None] * row
+            elif len(column) < row:
+                # the column was missing from the previous rows
+                column.extend([None] * (row - len(column)))
+            elif len(column) > row:
+                continue  # same path twice in one message, keep the first
+            column.append(value)
+        self.rows += 1
+
+    def extend(self, messages):
+        for msg in messages:
+            self.append(msg)
+        return self
+
+    def finish(self):
+        """
+        Pad every column to the number of rows
+        :return: dict of column name to list of values
+        """
+        for column in self.columns.values():
+            if len(column) < self.rows:
+                column.extend([None] * (self.rows - len(column)))
+        return self.columns
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.finish(), dtype="string")
+
+    def to_arrow(self):
+        pa = import_pyarrow()
+        return pa.table({name: pa.array(values, type=pa.string()) for name, values in self.finish().items()})
+
+    def write(self, output, fmt="csv"):
+        """
+        Write the table
+        :param output: path or file object (text for CSV, binary for Parquet and Arrow)
+        :param fmt: "csv", "parquet" or "arrow" (Arrow IPC file, readable as Feather)
+        """
+        if fmt == "csv":
+            self.to_dataframe().to_csv(output, index=False)
+        elif fmt == "parquet":
+            import_pyarrow()
+            import pyarrow.parquet as pq
+
+            pq.write_table(self.to_arrow(), output)
+        elif fmt == "arrow":
+            pa = import_pyarrow()
+            table = self.to_arrow()
+            with pa.ipc.new_file(output, table.schema) as writer:
+                writer.write_table(table)
+        else:
+            raise ValueError(f"Unknown format {fmt}, expected one of csv, parquet, arrow")
+
+
+def convert_messages(messages):
+    """
+    Flatten messages into a ColumnarTable, one row per message
+    """
+    return ColumnarTable().extend(messages)
+
+
+def output_format(path, fmt=None):
+    """
+    Output format from an explicit choice or the file extension, CSV otherwise
+    """
+    if fmt:
+        return fmt
+    for extension, name in FORMATS.items():
+        if path and path.lower().endswith(extension):
+            return name
+    return "csv"
+
+
+def run(args):
+    """
+    Convert the messages of files, directories or globs into one table (command line entry point)
+    :return: process exit code, 2 when a path matches no file
+    """
+    from hl7validator.bulk import iter_messages, report_missing
+
+    if report_missing(args.paths):
+        return 2
+    table = convert_messages(msg for _, _, msg in iter_messages(args.paths, args.encoding))
+    fmt = output_format(args.output, args.format)
+    if args.output:
+        table.write(args.output, fmt)
+    elif fmt == "csv":
+        table.write(sys.stdout, fmt)
+    else:
+        table.write(sys.stdout.buffer, fmt)
+    print(f"{table.rows} messages, {len(table.columns)} columns", file=sys.stderr)
+    return 0
@@ -0,0 +1,175 @@
+"""
+Format checks for the common HL7 v2 primitive datatypes.
+
+Each datatype has one precompiled pattern in DATATYPES, used by both the
+single value check (is_valid) and the column check (check_column), which
+validates a whole column of values, e.g. one field across thousands of
+messages, with pandas string operations instead of a Python loop.
+
+Date parts are checked against the calendar (no 2023-02-29), times against
+the clock, and ID/IS only against a maximum length since their values come
+from tables.
+"""
+
+import calendar
+import re
+from collections import namedtuple
+
+Datatype = namedtuple("Datatype", ["pattern", "label"])
+
+_DATE = r"(?P<year>\d{4})(?:(?P<month>0[1-9]|1[0-2])(?P<day>0[1-9]|[12]\d|3[01])?)?"
+_TIME = r"(?:[01]\d|2[0-3])(?:[0-5]\d(?:[0-5]\d(?:\.\d{1,4})?)?)?"
+_ZONE = r"(?:[+-](?:[01]\d|2[0-3])[0-5]\d)?"
+_DATETIME = (
+    r"(?P<year>\d{4})(?:(?P<month>0[1-9]|1[0-2])(?:(?P<day>0[1-9]|[12]\d|3[01])"
+    r"(?:" + _TIME + r")?)?)?" + _ZONE
+)
+
+DATATYPES = {
+    "DTM": Datatype(re.compile(_DATETIME), "Invalid datetime format"),
+    # TS is a DTM with an optional degree of precision component
+    "TS": Datatype(re.compile(_DATETIME + r"(?:\^[A-Z]?)?"), "Invalid datetime format"),
+    "DT": Datatype(re.compile(_DATE), "Invalid date format"),
+    "TM": Datatype(re.compile(_TIME + _ZONE), "Invalid time format"),
+    "NM": Datatype(re.compile(r"[+-]?(?:\d+(?:\.\d*)?|\.\d+)"), "Invalid numeric format"),
+    "SI": Datatype(re.compile(r"\d{1,4}"), "Invalid numeric format"),
+}
+
+# Coded values, only their length can be checked without the tables
+LENGTH_ONLY = ("ID", "IS")
+
+# HL7's default, messages set their own in MSH-2
+REPETITION_SEPARATOR = "~"
+
+DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _valid_day(match):
+    day = match.group("day")
+    if day is None:
+        return True
+    year, month = int(match.group("year")), int(match.group("month"))
+    return int(day) <= DAYS_IN_MONTH[month - 1] + (month == 2 and calendar.isleap(year))
+
+
+def is_valid(datatype, value, max_length=None, separator=REPETITION_SEPARATOR):
+    """
+    Check one value, each repetition on its own
+    :param datatype: HL7 datatype, e.g. "DTM"
+    :param value: ER7 value, empty values are valid
+    :param max_length: maximum length, only checked when given
+    :param separator: repetition separator of the message
+    :return: False when any repetition does not match the datatype
+    """
+    if not value:
+        return True
+    spec = DATATYPES.get(datatype)
+    for repetition in value.split(separator):
+        if not repetition:
+            continue
+        if max_length and max_length > 0 and len(repetition) > max_length:
+            return False
+        if spec is not None:
+            match = spec.pattern.fullmatch(repetition)
+            if match is None or ("day" in spec.pattern.groupindex and not _valid_day(match)):
+                return False
+    return True
+
+
+def check_column(datatype, values, max_length=None, separator=REPETITION_SEPARATOR):
+    """
+    Check a whole column of values at once
+    :param datatype: HL7 datatype, e.g. "DTM"
+    :param values: iterable or pandas Series of ER7 values, None and "" are valid
+    :param max_length: maximum length, only checked when given
+    :param separator: repetition separator of the messages
+    :return: boolean pandas Series, aligned with values
+    """
+    import numpy as np
+    import pandas as pd
+
+    values = pd.Series(values, dtype="string")
+    repeated = values.str.contains(separator, regex=False).fillna(False).any()
+    # one row per repetition, folded back per value at the end
+    column = values.str.split(separator, regex=False).explode() if repeated else values
+    empty = (column.isna() | (column == "")).to_numpy(dtype=bool)
+    ok = np.ones(len(column), dtype=bool)
+
+    if max_length and max_length > 0:
+        ok &= column.str.len().le(max_length).fillna(True).to_numpy(dtype=bool)
+
+    spec = DATATYPES.get(datatype)
+    if spec is not None:
+        ok &= column.str.fullmatch(spec.pattern).fillna(False).to_numpy(dtype=bool)
+        if "day" in spec.pattern.groupindex:
+            # dates are fixed width at the start of the value: YYYYMMDD
+            with_day = ok & column.str.len().ge(8).fillna(False).to_numpy(dtype=bool)
+            dates = column[with_day]
+            year = dates.str.slice(0, 4).astype(int).to_numpy()
+            month = dates.str.slice(4, 6).astype(int).to_numpy()
+            day = dates.str.slice(6, 8).astype(int).to_numpy()
+            leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+            days_in_month = np.array(DAYS_IN_MONTH)[month - 1] + ((month == 2) & leap)
+            ok[with_day] = day <= days_in_month
+
+    ok |= empty
+    if repeated:
+        return pd.Series(ok, index=column.index).groupby(level=0).all().reindex(values.index, fill_value=True)
+    return pd.Series(ok, index=values.index)
+
+
+COLUMN_PATH = re.compile(r"(?P<segment>[A-Z][A-Z0-9]{2})(?:\[\d+\])?-(?P<field>\d+)")
+
+
+def repetition_separators(frame):
+    """
+    Repetition separator of each row of a columnar table, the second encoding character (MSH-2)
+    """
+    import pandas as pd
+
+    if "MSH-2" not in frame.columns:
+        return pd.Series(REPETITION_SEPARATOR, index=frame.index, dtype="string")
+    separators = frame["MSH-2"].astype("string").str.slice(1, 2)
+    return separators.where(separators.str.len().fillna(0) == 1, REPETITION_SEPARATOR)
+
+
+def check_table(frame, version, separator=None):
+    """
+    Check the columns of a columnar table (see columnar.ColumnarTable) against their field datatypes
+    :param frame: DataFrame with field path columns, e.g. "PID-7" or "OBX[2]-14"
+    :param version: HL7 version of the messages
+    :param separator: repetition separator of the messages, read from the MSH-2 of each row when not given
+    :return: boolean DataFrame with the checked columns only, False marks an invalid value
+    """
+    import pandas as pd
+
+    from hl7validator.metadata import get_index
+
+    if separator is None:
+        separators = repetition_separators(frame)
+        # rows are checked together for each separator, nearly always a single one
+        groups = [(value, separators == value) for value in separators.unique()]
+    else:
+        groups = [(separator, None)]
+    index = get_index(version)
+    checked = {}
+    for column in frame.columns:
+        path = COLUMN_PATH.fullmatch(column)
+        if path is None:
+            continue
+        try:
+            meta = index.field(path.group("segment"), int(path.group("field")))
+        except Exception:
+            continue
+        if meta.datatype in DATATYPES or meta.datatype in LENGTH_ONLY:
+            parts = [
+                check_column(
+                    meta.datatype,
+                    frame[column] if rows is None else frame.loc[rows, column],
+                    max_length=meta.max_length,
+                    separator=value,
+                )
+                for value, rows in groups
+            ]
+            checked[column] = parts[0] if len(parts) == 1 else pd.concat(parts).reindex(frame.index)
+    return pd.DataFrame(checked, index=frame.index)
@@ -0,0 +1,40 @@
+"""
+Time budget of a validation, checked cooperatively.
+
+hl7apy parsing cannot be interrupted, so the size and segment limits keep what
+one parse can cost in check. The validation stages after it (the tree walk of
+TreeValidator, the per-segment checks of validate_message) check the deadline
+as they go and stop with ValidationTimeout once it has passed, leaving the
+worker free for the next request instead of being killed by gunicorn.
+"""
+
+import time
+
+
+class ValidationTimeout(BaseException):
+    """
+    Raised where a validation checks its deadline after the time budget is spent.
+
+    Like asyncio.CancelledError it is a BaseException, so the ``except Exception``
+    blocks that let a validation go on past a bad element do not swallow it.
+    """
+
+
+class Deadline:
+    """
+    :param seconds: time budget from now
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def check(self):
+        """
+        :raises ValidationTimeout: when the budget is spent
+        """
+        if time.monotonic() > self.expires:
+            raise ValidationTimeout(f"Validation took longer than {self.seconds:g} seconds")
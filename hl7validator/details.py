@@ -0,0 +1,171 @@
+"""
+Validation details with a machine-readable location and error code.
+
+Every detail is a dict with the human readable ``level`` and ``message`` plus
+``code``, the HL7 table 0357 error code, and ``location``, the element the
+detail is about::
+
+    {"level": "Error", "message": "Invalid date format on field PID.PID_7", "code": "102",
+     "location": {"segment": "PID", "index": 2, "field": 7, "component": None, "subcomponent": None}}
+
+``index`` is the position of the segment in the message, None when the report
+does not tell which of several segments with that id it is about. Locations are
+worked out when the detail is created, so clients and the tree view read them
+instead of parsing messages.
+"""
+
+import re
+from functools import lru_cache
+
+from hl7apy import SUPPORTED_LIBRARIES, load_library
+
+# HL7 table 0357 codes, matched against the validation detail messages
+ERROR_CODES = [
+    ("Missing required child", "101", "Required field missing"),
+    ("not in table", "103", "Table value not found"),
+    ("Datatype", "102", "Data type error"),
+    ("format", "102", "Data type error"),
+    ("max length", "102", "Data type error"),
+    ("Child limit exceeded", "100", "Segment sequence error"),
+    ("Invalid children", "100", "Segment sequence error"),
+    ("out of place", "100", "Segment sequence error"),
+    ("Missing required segment", "100", "Segment sequence error"),
+    ("Unknown element", "100", "Segment sequence error"),
+]
+INTERNAL_ERROR = ("207", "Application internal error")
+ERROR_TEXTS = dict([(code, text) for _, code, text in ERROR_CODES] + [INTERNAL_ERROR])
+
+# hl7apy names elements like PID, PID_7, CX_4 or ADT_A01 (a message, not a segment)
+POSITION_NAME = re.compile(r"([A-Z][A-Z0-9]*)_(\d+)")
+ELEMENT_PATH = re.compile(r"[A-Z][A-Z0-9]*(?:_[A-Z0-9]+)*(?:\.[A-Z][A-Z0-9]*(?:_[A-Z0-9]+)*)*")
+ELEMENT_REPR = re.compile(r"<(?:Field|Segment) ([A-Z0-9_]+)")
+
+
+@lru_cache(maxsize=None)
+def segment_ids():
+    """
+    Segment ids of every supported HL7 version. Datatype components (XAD_1, CWE_1) are named
+    like segment fields in report lines, only names in these ids are taken for segments.
+    """
+    ids = set()
+    for version in SUPPORTED_LIBRARIES:
+        ids.update(load_library(version).SEGMENTS)
+    return frozenset(ids)
+
+
+def error_code(message):
+    """
+    HL7 error code (table 0357) for a validation detail message
+    :return: code and its text
+    """
+    for needle, code, text in ERROR_CODES:
+        if needle in message:
+            return code, text
+    return INTERNAL_ERROR
+
+
+def make_location(segment, index=None, field=None, component=None, subcomponent=None):
+    return {
+        "segment": segment,
+        "index": index,
+        "field": field,
+        "component": component,
+        "subcomponent": subcomponent,
+    }
+
+
+def parse_location(message):
+    """
+    Location of the element an hl7apy report line is about, e.g. PID_13.XTN_1 in
+    "Missing required child PID_13.XTN_1"
+    :return: location without index, None when the line names no segment
+    """
+    match = ELEMENT_REPR.search(message)
+    if match:
+        path = match.group(1)
+    else:
+        paths = [token for token in message.split() if ELEMENT_PATH.fullmatch(token)]
+        if not paths:
+            return None
+        path = paths[-1]
+    segment = None
+    positions = []
+    for name in path.split("."):
+        numbered = POSITION_NAME.fullmatch(name)
+        if numbered:
+            if segment is None:
+                if numbered.group(1) not in segment_ids():
+                    continue
+                segment = numbered.group(1)
+            positions.append(int(numbered.group(2)))
+        elif name in segment_ids() and not positions:
+            segment = name
+    if segment is None:
+        return None
+    return make_location(segment, None, *positions[:3])
+
+
+def location_path(location):
+    """
+    Short form of a location, e.g. PID-5.2, None for a whole segment
+    """
+    if not location or location["field"] is None:
+        return None
+    path = f"{location['segment']}-{location['field']}"
+    for part in (location["component"], location["subcomponent"]):
+        if part is None:
+            break
+        path += f".{part}"
+    return path
+
+
+def make_detail(level, message, location=None, code=None):
+    return {
+        "level": level,
+        "message": message,
+        "code": code or error_code(message)[0],
+        "location": location,
+    }
+
+
+class DetailSet:
+    """
+    Details of one validation, in the order they were found, without duplicates.
+
+    Details are keyed by level and message, so adding one is a dict lookup
+    however many there already are.
+    :param segments: segment lines of the message, to locate the segment of a
+                     report line when its id occurs only once
+    """
+
+    def __init__(self, segments=()):
+        self._details = {}
+        positions = {}
+        for index, line in enumerate(segments):
+            positions.setdefault(line[0:3], []).append(index)
+        self._positions = {segment: found[0] for segment, found in positions.items() if len(found) == 1}
+
+    def add(self, level, message, location=None, code=None):
+        """
+        Add a detail unless one with the same level and message exists
+        :param location: location of the element, worked out from the message when not given
+        :return: True when the detail was added
+        """
+        key = (level, message)
+        if key in self._details:
+            return False
+        if location is None:
+            location = parse_location(message)
+            if location is not None:
+                location["index"] = self._positions.get(location["segment"])
+        self._details[key] = make_detail(level, message, location, code)
+        return True
+
+    def __contains__(self, key):
+        return key in self._details
+
+    def __len__(self):
+        return len(self._details)
+
+    def to_list(self):
+        return list(self._details.values())
@@ -0,0 +1,183 @@
+"""
+Single-traversal validation of parsed hl7apy trees.
+
+hl7apy's ``element.validate()`` walks the whole subtree of the element, writes
+a report and raises its first error, so validating a message, then each of its
+segments, then each of their fields walks every field two or three times and
+pays for an exception per call. TreeValidator runs the same checks as hl7apy
+(cardinality, allowed children, datatypes, table values and lengths), with the
+same messages in the same order, but keeps the problems of every element it
+visits. Validating a segment or field of a message that was already validated
+is then a lookup, and problems are returned rather than raised.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+
+from hl7apy import load_reference
+from hl7apy.core import is_base_datatype as _is_base_datatype
+from hl7apy.exceptions import ChildNotFound
+
+# Problems of an element: error and warning messages, in the order hl7apy reports them,
+# and the exception that stopped the walk when hl7apy itself would have failed
+Outcome = namedtuple("Outcome", ["errors", "warnings", "failure"])
+
+
+@lru_cache(maxsize=None)
+def is_base_datatype(datatype, version):
+    # hl7apy looks the version library up again on every call
+    return _is_base_datatype(datatype, version)
+
+
+def child_occurrences(el, name):
+    """
+    Children of el named name, the list el.children.get(name) proxies when el has any
+    """
+    indexes = el.children.indexes
+    if name in indexes and name.isupper():
+        return indexes[name]
+    return el.children.get(name)
+
+
+class TreeValidator:
+    """
+    Validator of the elements of parsed trees, remembering the problems of every element.
+    Meant to live as long as the trees it validates, e.g. one ValidationContext.
+    :param deadline: Deadline checked before each element is walked, None for no time budget
+    """
+
+    def __init__(self, deadline=None):
+        self._results = {}
+        self.deadline = deadline
+
+    def collect(self, element):
+        """
+        Problems of an element and its descendants, like element.validate() would report them
+        :return: Outcome
+        """
+        try:
+            errors, warnings = self._is_valid(element, element.reference)
+        except Exception as e:
+            return Outcome((), (), e)
+        return Outcome(errors, warnings, None)
+
+    @staticmethod
+    def write(outcome, report):
+        """
+        Replace the lines of a ValidationReport with the problems of an outcome,
+        as hl7apy writes its report file
+        """
+        with report:
+            for error in outcome.errors:
+                report.write(f"Error: {error}\n")
+            for warning in outcome.warnings:
+                report.write(f"Warning: {warning}\n")
+
+    def _is_valid(self, el, ref):
+        key = (id(el), id(ref))
+        result = self._results.get(key)
+        if result is None:
+            if self.deadline is not None:
+                # raised past the except below, and nothing is cached for the element
+                self.deadline.check()
+            try:
+                if el.is_unknown():
+                    problems = ["Unknown element found: {}.{}".format(el.parent, el)], []
+                elif el.is_z_element():
+                    problems = self._check_z_element(el)
+                else:
+                    problems = self._check_known_element(el, ref)
+            except Exception as e:
+                problems = e
+            # the element and reference are kept so their ids are not reused
+            result = self._results[key] = (el, ref, problems)
+        problems = result[2]
+        if isinstance(problems, Exception):
+            raise problems
+        return problems
+
+    def _check_z_element(self, el):
+        errs, warns = [], []
+        if el.classname == "Field":
+            if is_base_datatype(el.datatype, el.version) or el.datatype == "varies":
+                return errs, warns
+            elif el.datatype is not None:
+                # a z field of a complex datatype must follow the structure of that datatype
+                dt_struct = load_reference(el.datatype, "Datatypes_Structs", el.version)
+                ref = ("sequence", dt_struct, el.datatype, None, None, -1)
+                self._extend(errs, warns, self._check_known_element(el, ref))
+        for c in el.children:
+            self._extend(errs, warns, self._is_valid(c, None))
+        return errs, warns
+
+    def _check_known_element(self, el, ref):
+        errs, warns = [], []
+        if ref is None:
+            try:
+                ref = load_reference(el.name, el.classname, el.version)
+            except ChildNotFound:
+                errs.append("Invalid element found: {}".format(el))
+
+        if ref[0] in ("sequence", "choice"):
+            element_children = {c.name for c in el.children if not c.is_z_element()}
+            valid_children = {c[0] for c in ref[1]}
+            if not element_children <= valid_children:
+                errs.append(
+                    "Invalid children detected for {}: {}".format(el, list(element_children - valid_children))
+                )
+
+            for child_ref in ref[1]:
+                child_name = child_ref[0]
+                try:
+                    children = child_occurrences(el, child_name)
+                except Exception:
+                    # missing from the reference files
+                    continue
+                min_repetitions, max_repetitions = child_ref[2]
+                if len(children) < min_repetitions:
+                    errs.append("Missing required child {}.{}".format(el.name, child_name))
+                elif max_repetitions != -1 and len(children) > max_repetitions:
+                    errs.append("Child limit exceeded {}.{}".format(el.name, child_name))
+                for c in children:
+                    self._extend(errs, warns, self._is_valid(c, child_ref[1]))
+
+            for c in el.children:
+                if c.is_z_element():
+                    self._extend(errs, warns, self._is_valid(c, None))
+            return errs, warns
+
+        # the value is serialized at most once, and only when a check needs it
+        table, value = ref[4], None
+        if table is not None:
+            try:
+                table_ref = load_reference(table, "Table", el.version)
+            except ChildNotFound:
+                pass
+            else:
+                value = el.to_er7()
+                if value not in table_ref[1]:
+                    warns.append(
+                        "Value {} not in table {} in element {}.{}".format(value, table, el.parent.name, el.name)
+                    )
+        max_length = ref[5]
+        if -1 < max_length < len(el.to_er7() if value is None else value):
+            warns.append("Exceeded max length ({}) of {}.{}".format(max_length, el.parent.name, el.name))
+
+        if el.datatype == "varies":
+            return errs, warns
+        if el.datatype != ref[2]:
+            errs.append(
+                "Datatype {} is not correct for {}.{} (it must be {})".format(
+                    el.datatype, el.parent.name, el.name, ref[1]
+                )
+            )
+        # the components of a complex datatype are checked against the datatype structure
+        if not is_base_datatype(el.datatype, el.version) and el.datatype is not None:
+            ref = load_reference(el.datatype, "Datatypes_Structs", el.version)
+            self._extend(errs, warns, self._is_valid(el, ref))
+        return errs, warns
+
+    @staticmethod
+    def _extend(errs, warns, problems):
+        errs.extend(problems[0])
+        warns.extend(problems[1])
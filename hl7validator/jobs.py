@@ -0,0 +1,382 @@
+"""
+Asynchronous validation jobs, queued in a local SQLite file.
+
+A job is a list of messages submitted in one request. Its messages are written
+to SQLite in short transactions while the job is uploading, which runners leave
+alone, and the job is queued once they are all in, when the request returns
+its id. A JobRunner (``python -m hl7validator jobs``, started next to
+gunicorn by ``docker/gunicorn.sh``) claims queued jobs and validates their
+messages on the batch worker processes, saving results as they come in.
+
+A runner holds a lease on the job it runs and renews it with every save. A
+runner that stops gracefully puts its job back in the queue; one that is killed
+leaves its lease to expire, and the next runner to claim the job goes on from
+the messages without a result, so jobs survive restarts without being
+validated twice.
+"""
+
+import json
+import os
+import signal
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+
+from hl7validator import app
+from hl7validator.batch import iter_validate
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    validation_level TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS messages (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    result TEXT,
+    PRIMARY KEY (job_id, seq)
+) WITHOUT ROWID;
+"""
+
+UPLOADING, QUEUED, RUNNING, DONE, FAILED = "uploading", "queued", "running", "done", "failed"
+
+# messages written per transaction while a job is uploading
+INSERT_CHUNK = 1000
+
+
+def timestamp(seconds):
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+class JobStore:
+    """
+    Jobs and their messages in a SQLite file, shared by the web workers and the job runners.
+    Every call opens its own connection, so a store can be used from any thread or process.
+    :param path: SQLite file, created with its directory when missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._ready:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    # readers (progress, downloads) do not block the runner's writes
+                    connection.execute("PRAGMA journal_mode=WAL")
+                    connection.executescript(SCHEMA)
+                    self._ready = True
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Connection in a write transaction, committed when the block ends without an error
+        """
+        with closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def create(self, items, validation_level="tolerant"):
+        """
+        Queue a job. Its messages are written INSERT_CHUNK at a time, each chunk in its own
+        transaction, so reading a large upload does not hold the write lock the runners need.
+        :param items: iterable of batch entries (see batch.validate_item), read once
+        :return: the job, see get
+        """
+        job_id = uuid.uuid4().hex
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, status, validation_level, created) VALUES (?, ?, ?, ?)",
+                (job_id, UPLOADING, validation_level, time.time()),
+            )
+        total = 0
+        chunk = []
+        try:
+            for item in items:
+                chunk.append((job_id, total, json.dumps(item)))
+                total += 1
+                if len(chunk) >= INSERT_CHUNK:
+                    self._insert(chunk)
+                    chunk = []
+            self._insert(chunk)
+        except BaseException:
+            # an upload that breaks off leaves no job behind
+            with self.transaction() as connection:
+                connection.execute("DELETE FROM messages WHERE job_id = ?", (job_id,))
+                connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            raise
+        # an empty job has nothing to wait for
+        status, finished = (QUEUED, None) if total else (DONE, time.time())
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET total = ?, status = ?, finished = ? WHERE id = ?", (total, status, finished, job_id)
+            )
+        return self.get(job_id)
+
+    def _insert(self, chunk):
+        with self.transaction() as connection:
+            connection.executemany("INSERT INTO messages (job_id, seq, item) VALUES (?, ?, ?)", chunk)
+
+    def get(self, job_id):
+        """
+        :return: status and progress of a job, None when there is no such job
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT id, status, validation_level, total, done, failed, created, started, finished, error "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job_id, status, validation_level, total, done, failed, created, started, finished, error = row
+        return {
+            "id": job_id,
+            "status": status,
+            "validation_level": validation_level,
+            "total": total,
+            "done": done,
+            "failed": failed,
+            "progress": done / total if total else 1.0,
+            "created": timestamp(created),
+            "started": timestamp(started),
+            "finished": timestamp(finished),
+            "error": error,
+        }
+
+    def claim(self, worker, lease):
+        """
+        Take the oldest queued job, or a running one whose runner's lease expired
+        :param worker: id of the runner
+        :param lease: seconds the job is the runner's without a renewal
+        :return: job id and validation level, None when there is nothing to run
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT id, validation_level FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) "
+                "ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, started = COALESCE(started, ?) WHERE id = ?",
+                (RUNNING, worker, now + lease, now, row[0]),
+            )
+        return row
+
+    def pending(self, job_id, after=-1, limit=500):
+        """
+        Messages of a job without a result, in order
+        :param after: only messages after this position
+        :return: list of (position, batch entry)
+        """
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                "SELECT seq, item FROM messages WHERE job_id = ? AND seq > ? AND result IS NULL ORDER BY seq LIMIT ?",
+                (job_id, after, limit),
+            ).fetchall()
+        return [(seq, json.loads(item)) for seq, item in rows]
+
+    def save(self, job_id, worker, lease, results):
+        """
+        Save results of a job and renew the runner's lease on it
+        :param results: list of (position, validation result)
+        :return: False when the job is no longer the runner's, nothing is saved then
+        """
+        with self.transaction() as connection:
+            owned = connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + lease, job_id, worker, RUNNING),
+            ).rowcount
+            if not owned:
+                return False
+            done = failed = 0
+            for seq, result in results:
+                # a result saved by a runner that lost the job counts once
+                saved = connection.execute(
+                    "UPDATE messages SET result = ? WHERE job_id = ? AND seq = ? AND result IS NULL",
+                    (json.dumps(result), job_id, seq),
+                ).rowcount
+                done += saved
+                if saved and result.get("statusCode") != "Success":
+                    failed += 1
+            connection.execute(
+                "UPDATE jobs SET done = done + ?, failed = failed + ? WHERE id = ?", (done, failed, job_id)
+            )
+        return True
+
+    def finish(self, job_id, worker, error=None):
+        """
+        Mark a job done, or failed with an error, unless it is no longer the runner's
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, error = ?, lease_until = NULL "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (FAILED if error else DONE, time.time(), error, job_id, worker, RUNNING),
+            )
+
+    def release(self, job_id, worker):
+        """
+        Put a job back in the queue, for a runner that is stopping
+        """
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL WHERE id = ? AND worker = ? AND status = ?",
+                (QUEUED, job_id, worker, RUNNING),
+            )
+
+    def results(self, job_id, page=500):
+        """
+        Results of a job in message order, read a page at a time
+        :return: generator of (position, validation result), None for messages without a result yet
+        """
+        after = -1
+        while True:
+            with closing(self._connect()) as connection:
+                rows = connection.execute(
+                    "SELECT seq, result FROM messages WHERE job_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (job_id, after, page),
+                ).fetchall()
+            for seq, result in rows:
+                yield seq, json.loads(result) if result is not None else None
+            if len(rows) < page:
+                return
+            after = rows[-1][0]
+
+
+class JobRunner:
+    """
+    Runs queued jobs one after the other, each on the batch worker processes
+    :param store: JobStore
+    :param workers: worker processes, defaults to BATCH_WORKERS
+    :param lease: seconds a job stays the runner's between saves, JOBS_LEASE by default
+    :param save_every: results saved together, fewer when they take longer than a second
+    """
+
+    def __init__(self, store, workers=None, lease=None, save_every=100):
+        self.store = store
+        self.workers = workers
+        self.lease = lease or app.config["JOBS_LEASE"]
+        self.save_every = save_every
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stopping = threading.Event()
+
+    def run_once(self):
+        """
+        Claim a job and run it
+        :return: whether there was a job to run
+        """
+        claimed = self.store.claim(self.worker, self.lease)
+        if claimed is None:
+            return False
+        job_id, validation_level = claimed
+        app.logger.info("Job %s claimed by %s", job_id, self.worker)
+        try:
+            complete = self.process(job_id, validation_level)
+        except Exception as err:
+            app.logger.error("Job %s failed: %s", job_id, err)
+            self.store.finish(job_id, self.worker, error=str(err))
+            return True
+        if complete:
+            self.store.finish(job_id, self.worker)
+            app.logger.info("Job %s done", job_id)
+        elif self.stopping.is_set():
+            self.store.release(job_id, self.worker)
+        return True
+
+    def process(self, job_id, validation_level):
+        """
+        Validate the messages of a job that have no result yet, saving results as they come
+        :return: True when every message has a result, False when the runner stopped or lost the job
+        """
+        positions = deque()
+
+        def items():
+            after = -1
+            while not self.stopping.is_set():
+                page = self.store.pending(job_id, after)
+                if not page:
+                    return
+                for seq, item in page:
+                    positions.append(seq)
+                    yield item
+                after = page[-1][0]
+
+        results = []
+        last_save = time.monotonic()
+        for result in iter_validate(items(), validation_level, self.workers):
+            results.append((positions.popleft(), result))
+            if len(results) >= self.save_every or time.monotonic() - last_save > 1:
+                if not self.store.save(job_id, self.worker, self.lease, results):
+                    app.logger.warning("Job %s was taken over by another runner", job_id)
+                    return False
+                results = []
+                last_save = time.monotonic()
+        if not self.store.save(job_id, self.worker, self.lease, results):
+            return False
+        return not self.stopping.is_set()
+
+    def run(self, poll_interval=None):
+        """
+        Run jobs until stop is called, polling the queue when it is empty
+        """
+        poll_interval = poll_interval or app.config["JOBS_POLL_INTERVAL"]
+        app.logger.info("Job runner %s on %s", self.worker, self.store.path)
+        while not self.stopping.is_set():
+            if not self.run_once():
+                self.stopping.wait(poll_interval)
+
+    def stop(self, *args):
+        """
+        Stop after the results being validated are saved, usable as a signal handler
+        """
+        self.stopping.set()
+
+
+job_store = JobStore(app.config["JOBS_DB"])
+
+
+def run(args):
+    """
+    Entry point of the jobs command
+    """
+    runner = JobRunner(job_store, args.workers)
+    signal.signal(signal.SIGTERM, runner.stop)
+    signal.signal(signal.SIGINT, runner.stop)
+    runner.run()
+    return 0
@@ -0,0 +1,110 @@
+"""
+Logging off the request thread.
+
+The handlers of the app logger (the stderr handler, and the rotating log file of
+``python -m hl7validator``) are moved behind a bounded queue that a background
+thread writes out, so a request only pays for putting a record on the queue.
+When the queue is full, records are dropped and counted instead of blocking.
+
+Message bodies are logged for a sample of the messages (``LOG_MESSAGE_SAMPLE_RATE``)
+and cut to ``LOG_MESSAGE_MAX_LENGTH`` characters.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+from hl7validator import app
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that drops records when the queue is full, never blocking the caller
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.listener = None
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def listen(self, handlers):
+        """
+        Start a background thread writing the queued records to handlers, in place of the current one
+        """
+        if self.listener is not None:
+            self.listener.stop()
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def after_fork(self):
+        # the writer thread does not survive a fork (gunicorn workers), and the queue's lock may be held
+        if self.listener is not None:
+            handlers = self.listener.handlers
+            self.listener = None
+            self.queue = queue.Queue(self.maxsize)
+            self.listen(handlers)
+
+
+def queue_logging(logger, maxsize=None):
+    """
+    Move the handlers of a logger behind a queue written by a background thread.
+    Handlers added afterwards are moved behind the same queue by calling it again.
+    :param maxsize: records kept waiting before new ones are dropped, LOG_QUEUE_SIZE by default
+    :return: the DroppingQueueHandler of the logger
+    """
+    handler = next((h for h in logger.handlers if isinstance(h, DroppingQueueHandler)), None)
+    handlers = [h for h in logger.handlers if not isinstance(h, DroppingQueueHandler)]
+    if handler is None:
+        handler = DroppingQueueHandler(maxsize or app.config["LOG_QUEUE_SIZE"])
+        os.register_at_fork(after_in_child=handler.after_fork)
+        # stop flushes the records still queued
+        atexit.register(handler.stop)
+        logger.addHandler(handler)
+    elif handler.listener is not None:
+        handlers = list(handler.listener.handlers) + handlers
+    for h in handlers:
+        logger.removeHandler(h)
+    handler.listen(handlers)
+    return handler
+
+
+def sampled():
+    """
+    Whether to log the body of this message, for LOG_MESSAGE_SAMPLE_RATE of the messages
+    """
+    rate = app.config["LOG_MESSAGE_SAMPLE_RATE"]
+    return rate >= 1 or random.random() < rate
+
+
+def truncate(msg):
+    """
+    Message body cut to LOG_MESSAGE_MAX_LENGTH characters for the logs (0 keeps all of it)
+    """
+    limit = app.config["LOG_MESSAGE_MAX_LENGTH"]
+    if not isinstance(msg, str) or not limit or len(msg) <= limit:
+        return msg
+    return f"{msg[:limit]}... [{len(msg) - limit} more characters]"
+
+
+def log_message(text, msg, level=logging.INFO):
+    """
+    Log text followed by a sampled, truncated message body, without formatting anything when
+    the level is disabled
+    """
+    if app.logger.isEnabledFor(level) and sampled():
+        app.logger.log(level, "%s: %s", text, truncate(msg))
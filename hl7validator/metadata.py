@@ -0,0 +1,112 @@
+"""
+Per-version index of HL7 element metadata (long name, datatype, max length, table).
+
+Entries are built lazily from the hl7apy reference structures the first time a
+segment field is asked for, and then shared by every request, so rendering and
+date checks no longer construct an hl7apy Field per field of every message.
+"""
+
+import threading
+from collections import namedtuple
+
+from hl7apy.core import Field
+
+ElementMeta = namedtuple("ElementMeta", ["name", "long_name", "datatype", "max_length", "table", "children"])
+
+# Invalid names come from the messages themselves, so only a bounded number is remembered
+MAX_INVALID_NAMES = 10_000
+
+
+def _children_meta(reference):
+    """
+    Metadata of the components (or subcomponents) of a reference, by position
+    """
+    if not reference or reference[0] != "sequence":
+        return ()
+    return tuple(
+        ElementMeta(name, ref[3], ref[2], ref[5], ref[4], _children_meta(ref))
+        for name, ref, _, _ in reference[1]
+    )
+
+
+class MetadataIndex:
+    """
+    Metadata of the fields of every segment, and of their components and
+    subcomponents, for one HL7 version
+    :param version: HL7 version of the index
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self._fields = {}
+        self._invalid = {}
+        self._lock = threading.Lock()
+
+    def field(self, segment, position):
+        """
+        Metadata of a segment field, e.g. ("PID", 7)
+        :return: ElementMeta
+        :raises: the error hl7apy raises for a Field with that name (e.g. InvalidName)
+        """
+        name = f"{segment}_{position}"
+        meta = self._fields.get(name) or self._invalid.get(name)
+        if meta is None:
+            try:
+                f = Field(name, version=self.version)
+            except Exception as e:
+                # the type and arguments only, a cached exception would keep the frames of every
+                # request raising it
+                meta = (type(e), e.args)
+                with self._lock:
+                    if len(self._invalid) < MAX_INVALID_NAMES:
+                        self._invalid[name] = meta
+            else:
+                reference = getattr(f, "reference", None)
+                meta = ElementMeta(
+                    f.name,
+                    f.long_name,
+                    f.datatype,
+                    reference[5] if reference else -1,
+                    f.table,
+                    _children_meta(reference),
+                )
+                with self._lock:
+                    self._fields[name] = meta
+        if not isinstance(meta, ElementMeta):
+            error, args = meta
+            raise error(*args) from None
+        return meta
+
+    def lookup(self, segment, field, component=None, subcomponent=None):
+        """
+        Metadata of an element by position, e.g. ("PID", 5, 1) for PID-5.1
+        :return: ElementMeta, None when the element is unknown or the field datatype varies
+        """
+        try:
+            meta = self.field(segment, field)
+        except Exception:
+            return None
+        if meta.datatype == "varies":
+            return None
+        for position in (component, subcomponent):
+            if position is None:
+                break
+            if not 0 < position <= len(meta.children):
+                return None
+            meta = meta.children[position - 1]
+        return meta
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(version):
+    """
+    MetadataIndex of a version, created on first use
+    """
+    index = _indexes.get(version)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.setdefault(version, MetadataIndex(version))
+    return index
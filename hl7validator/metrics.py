@@ -0,0 +1,343 @@
+"""
+Per-stage timings of requests, for the Server-Timing header and the /metrics endpoint.
+
+Stages (tokenize, parse, validate, read_report, structure, highlight, tree, ...)
+are timed with ``stage``, which only costs a context variable lookup when no
+request is being timed (CLI, MLLP, batch pool processes). At the end of a request
+the stage times go into latency histograms labelled with the stage, the HL7
+version and the message type (MSH-9), next to request and validation counters,
+and are sent back in a ``Server-Timing`` header.
+
+Each gunicorn worker keeps its metrics in memory. With ``METRICS_DIR`` set,
+workers write a snapshot of them to ``<METRICS_DIR>/metrics_<pid>_<id>.json``
+shortly after each request, and ``/metrics`` sums the snapshots of every worker,
+the ones of workers that have exited included, so counters never go backwards.
+The id is drawn anew in every process, so a worker reusing the pid of one that
+exited does not replace its snapshot. Without it,
+``/metrics`` only shows the worker that answers the scrape.
+"""
+
+import atexit
+import glob
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+from hl7validator import app
+from hl7validator.admission import admission
+from hl7validator.cache import result_cache, segment_cache
+
+# seconds, the Prometheus client defaults
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    "hl7validator_stage_duration_seconds": (
+        "histogram", "Time spent in each stage of a request, by HL7 version and message type"),
+    "hl7validator_request_duration_seconds": ("histogram", "Request latency by endpoint and status"),
+    "hl7validator_requests_total": ("counter", "Requests by endpoint and status"),
+    "hl7validator_validations_total": ("counter", "Messages validated, by HL7 version, message type and status"),
+    "hl7validator_validation_errors_total": (
+        "counter", "Error details found, by HL7 version, message type and HL7 error code"),
+    "hl7validator_cache_hits_total": ("counter", "Cache hits by cache"),
+    "hl7validator_cache_misses_total": ("counter", "Cache misses by cache"),
+    "hl7validator_cache_evictions_total": ("counter", "Cache evictions by cache"),
+    "hl7validator_admission_rejected_total": ("counter", "Requests turned away with 429 by admission lane"),
+}
+
+# label values come from messages, anything else is counted as "other" to bound the series
+LABEL_VALUE = re.compile(r"[A-Za-z0-9_^.]{1,20}")
+
+_timings = ContextVar("timings", default=None)
+
+
+def label_value(value):
+    if not value:
+        return "none"
+    return value if LABEL_VALUE.fullmatch(value) else "other"
+
+
+class Timings:
+    """
+    Stage times of one request, a stage timed more than once adds up
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.version = None
+        self.message_type = None
+        self.status = None
+        self.error_codes = []
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing(self, total):
+        """
+        Server-Timing header value, durations in milliseconds
+        """
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+class stage:
+    """
+    Time a block as a stage of the current request, does nothing outside a timed request::
+
+        with stage("parse"):
+            parsed = parse_message(msg)
+    """
+
+    __slots__ = ("name", "timings", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _timings.get()
+        if self.timings is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.timings is not None:
+            self.timings.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def label(version, message_type):
+    """
+    Label the stages of the current request with the HL7 version and message type (e.g. ADT^A01)
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.version = version
+        timings.message_type = message_type
+
+
+def record_validation(result):
+    """
+    Count a validation result of the current request, by status and error codes
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.status = result.get("statusCode")
+        details = result.get("details")
+        if isinstance(details, list):
+            timings.error_codes.extend(d.get("code") for d in details if d.get("level") == "Error")
+
+
+class Registry:
+    """
+    Counters and histograms of this process, and the snapshots of the other workers
+    :param directory: directory shared by the workers for their snapshots, None for this process only
+    :param flush_interval: seconds a snapshot may lag behind the metrics of its worker
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.reset()
+
+    def reset(self):
+        """
+        Start from zero, e.g. in a worker forked from a process that already counted
+        """
+        self.counters = {}
+        self.histograms = {}
+        self.instance = uuid.uuid4().hex[:12]
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        position = 0
+        while position < len(BUCKETS) and value > BUCKETS[position]:
+            position += 1
+        histogram[0][position] += 1
+        histogram[1] += value
+
+    def record(self, timings, endpoint, status):
+        """
+        Add the stage times and counts of a finished request
+        """
+        total = time.perf_counter() - timings.start
+        endpoint, status = label_value(endpoint), str(status)
+        version, message_type = label_value(timings.version), label_value(timings.message_type)
+        with self._lock:
+            for name, seconds in timings.stages.items():
+                self.observe(
+                    "hl7validator_stage_duration_seconds",
+                    (("stage", name), ("version", version), ("message_type", message_type)),
+                    seconds,
+                )
+            self.observe(
+                "hl7validator_request_duration_seconds", (("endpoint", endpoint), ("status", status)), total
+            )
+            self.inc("hl7validator_requests_total", (("endpoint", endpoint), ("status", status)))
+            if timings.status:
+                self.inc(
+                    "hl7validator_validations_total",
+                    (("version", version), ("message_type", message_type), ("status", label_value(timings.status))),
+                )
+            for code in timings.error_codes:
+                self.inc(
+                    "hl7validator_validation_errors_total",
+                    (("version", version), ("message_type", message_type), ("code", label_value(code))),
+                )
+        self.schedule_flush()
+        return total
+
+    def snapshot(self):
+        """
+        Metrics of this process as JSON-able lists, cache counters read from the caches
+        """
+        with self._lock:
+            counters = [[name, labels, value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, labels, counts[:], total] for (name, labels), (counts, total) in self.histograms.items()]
+        for cache_name, cache in (("result", result_cache), ("segment", segment_cache)):
+            stats = cache.stats()
+            for field in ("hits", "misses", "evictions"):
+                counters.append([f"hl7validator_cache_{field}_total", (("cache", cache_name),), stats[field]])
+        for lane, stats in admission.stats().items():
+            counters.append(["hl7validator_admission_rejected_total", (("lane", lane),), stats["rejected"]])
+        return {"counters": counters, "histograms": histograms}
+
+    def path(self):
+        return os.path.join(self.directory, f"metrics_{os.getpid()}_{self.instance}.json")
+
+    def flush(self):
+        """
+        Write the snapshot of this process for the other workers to read
+        """
+        with self._lock:
+            self._timer = None
+            # a process that answered no request (the gunicorn master) has nothing of its own to add
+            recorded = bool(self.counters or self.histograms)
+        if not self.directory or not recorded:
+            return
+        path = self.path()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            app.logger.warning("Could not write metrics snapshot %s: %s", path, err)
+
+    def schedule_flush(self):
+        """
+        Flush in the background once flush_interval has passed, so requests never wait for it
+        """
+        if not self.directory:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+        self._timer.start()
+
+    def collect(self):
+        """
+        Metrics of every worker added up, this one from memory and the others from their snapshots
+        :return: counters and histograms keyed by (name, labels)
+        """
+        snapshots = [self.snapshot()]
+        if self.directory:
+            own = self.path()
+            for path in glob.glob(os.path.join(self.directory, "metrics_*.json")):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # being replaced, or not one of ours
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+        return counters, histograms
+
+    def render(self):
+        """
+        Metrics of every worker in the Prometheus text exposition format
+        """
+        counters, histograms = self.collect()
+        out = []
+        for name, (kind, help_text) in METRICS.items():
+            series = counters if kind == "counter" else histograms
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == "counter":
+                    out.append(f"{name}{format_labels(labels)} {format_value(series[key])}")
+                    continue
+                counts, total = series[key]
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    out.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                out.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                out.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(out) + "\n"
+
+
+def format_labels(labels):
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+registry = Registry(app.config["METRICS_DIR"] or None, app.config["METRICS_FLUSH_INTERVAL"])
+# gunicorn forks workers from the preloaded app: each worker counts on its own
+os.register_at_fork(after_in_child=registry.reset)
+atexit.register(registry.flush)
+
+
+def start_request():
+    """
+    Start timing the stages of the current request
+    """
+    _timings.set(Timings())
+
+
+def finish_request(endpoint, status):
+    """
+    Stop timing the current request and record it
+    :return: the request's Timings and total seconds, None when it was not timed
+    """
+    timings = _timings.get()
+    if timings is None:
+        return None
+    _timings.set(None)
+    return timings, registry.record(timings, endpoint, status)
@@ -0,0 +1,221 @@
+"""
+MLLP listener that validates every framed message and answers with an HL7 ACK.
+
+Each connection may pipeline many messages: frames are validated concurrently on
+the batch process pool and the ACKs are written back in the order the messages
+arrived, so the event loop only does framing and I/O.
+"""
+
+import asyncio
+from datetime import datetime
+
+from hl7validator import app
+from hl7validator.batch import get_pool, validate_item
+from hl7validator.details import ERROR_TEXTS, error_code
+from hl7validator.structure import has_structure_component
+from hl7validator.tokenizer import Tokens
+
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\r"
+
+# Versions whose ERR segment only has ERR-1 (error code and location)
+ELD_VERSIONS = ["2.1", "2.2", "2.3", "2.3.1", "2.4"]
+
+
+def escape(value):
+    """
+    Escape HL7 delimiters in free text with the default encoding characters
+    """
+    value = value.replace("\\", "\\E\\")
+    for char, sequence in (("|", "\\F\\"), ("^", "\\S\\"), ("~", "\\R\\"), ("&", "\\T\\")):
+        value = value.replace(char, sequence)
+    return value.replace("\r", " ").replace("\n", " ").strip()
+
+
+def build_err(detail, hl7version):
+    """
+    ERR segment for a validation detail
+    :param detail: dict with "level", "message" and optionally "code" (see hl7validator.details)
+    :param hl7version: version of the ACK, which decides the ERR layout
+    """
+    if detail.get("code"):
+        code, text = detail["code"], ERROR_TEXTS[detail["code"]]
+    else:
+        code, text = error_code(detail["message"])
+    message = escape(detail["message"])
+    if hl7version in ELD_VERSIONS:
+        return f"ERR|^^^{code}&{message}&HL70357"
+    severity = "E" if detail["level"] == "Error" else "W"
+    return f"ERR|||{code}^{text}^HL70357|{severity}||||{message}"
+
+
+def build_ack(msg, validation):
+    """
+    Build the ACK for a message from its validation result
+    :param msg: the message that was validated
+    :param validation: result of hl7validatorapi
+    :return: ER7 encoded ACK, segments separated by carriage returns
+    """
+    tokens = Tokens(msg)
+    msh = tokens.fields(0)
+    msh += [""] * (12 - len(msh))
+    message_type = tokens.components(0, 9)
+    trigger = message_type[1] if len(message_type) > 1 else ""
+    hl7version = validation.get("hl7version") or (tokens.components(0, 12) or [""])[0] or "2.5"
+
+    if validation["statusCode"] == "Success":
+        ack_code = "AA"
+    elif validation["message"].startswith("[Error parsing message]"):
+        ack_code = "AR"
+    else:
+        ack_code = "AE"
+    ack_type = f"ACK^{trigger}" if trigger else "ACK"
+    if trigger and has_structure_component(hl7version):
+        ack_type += "^ACK"
+
+    details = validation["details"] or []
+    errors = [d for d in details if d["level"] == "Error"]
+    text = validation["message"] if ack_code != "AA" else ""
+    segments = [
+        "|".join(
+            [
+                "MSH",
+                "^~\\&",
+                msh[4],
+                msh[5],
+                msh[2],
+                msh[3],
+                datetime.now().strftime("%Y%m%d%H%M%S"),
+                "",
+                ack_type,
+                f"ACK{msh[9]}",
+                msh[10] or "P",
+                hl7version,
+            ]
+        ),
+        f"MSA|{ack_code}|{msh[9]}|{escape(text)}",
+    ]
+    if ack_code == "AR" and not details:
+        details = [{"level": "Error", "message": validation["message"]}]
+    segments += [build_err(d, hl7version) for d in (errors if ack_code == "AE" else details)]
+    return "\r".join(segments) + "\r"
+
+
+def handle_message(msg, validation_level="tolerant"):
+    """
+    Validate one framed message and build its ACK, run in a pool worker
+    """
+    return build_ack(msg, validate_item(msg, validation_level))
+
+
+def internal_error_ack(msg, err):
+    """
+    AR ACK for a message whose validation could not complete
+    """
+    validation = {
+        "statusCode": "Failed",
+        "message": "[Error parsing message] Application internal error",
+        "details": [{"level": "Error", "message": str(err)}],
+        "hl7version": None,
+    }
+    return build_ack(msg, validation)
+
+
+def decode(frame):
+    try:
+        return frame.decode("utf-8")
+    except UnicodeDecodeError:
+        return frame.decode("latin-1")
+
+
+class MLLPServer:
+    """
+    asyncio MLLP server answering every message with a validation ACK
+    :param host: address to bind
+    :param port: port to bind, 0 picks a free one
+    :param validation_level: validation level used for every message
+    :param max_pending: ACKs a single connection may have in flight before reading pauses
+    """
+
+    def __init__(self, host="0.0.0.0", port=2575, validation_level="tolerant", max_pending=64):
+        self.host = host
+        self.port = port
+        self.validation_level = validation_level
+        self.max_pending = max_pending
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            limit=app.config["MAX_CONTENT_LENGTH"],
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        app.logger.info("MLLP listener on %s:%s", self.host, self.port)
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue(maxsize=self.max_pending)
+        sender = asyncio.create_task(self.send_acks(pending, writer))
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    await reader.readuntil(START_BLOCK)
+                    frame = await reader.readuntil(END_BLOCK)
+                except asyncio.IncompleteReadError:
+                    break
+                msg = decode(frame[: -len(END_BLOCK)])
+                future = loop.run_in_executor(
+                    get_pool(), handle_message, msg, self.validation_level
+                )
+                await pending.put((msg, future))
+        except (ConnectionError, asyncio.LimitOverrunError) as e:
+            app.logger.warning("MLLP connection %s closed: %s", peer, e)
+        finally:
+            await pending.put(None)
+            await sender
+            writer.close()
+
+    async def send_acks(self, pending, writer):
+        """
+        Write ACKs in the order their messages were received.
+        Keeps draining the queue after the peer goes away so the reader never blocks.
+        """
+        connected = True
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            msg, future = item
+            try:
+                ack = await future
+            except Exception as e:
+                app.logger.error("MLLP validation failed: %s", e)
+                ack = internal_error_ack(msg, e)
+            if not connected:
+                continue
+            try:
+                writer.write(START_BLOCK + ack.encode("utf-8") + END_BLOCK)
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+
+def serve(host="0.0.0.0", port=2575, validation_level="tolerant"):
+    """
+    Run the MLLP listener until interrupted
+    """
+    asyncio.run(MLLPServer(host, port, validation_level).serve_forever())
@@ -0,0 +1,313 @@
+"""
+Message structures compiled into automata over segment ids.
+
+hl7apy checks how many times each segment or group occurs in a message, but not
+the order the segments come in, and it needs MSH-9.3 (or a structure named after
+the trigger event) to check anything at all. Each message structure of a version
+is compiled once, from the hl7apy reference, into an automaton that reads the
+segment ids of a message in order and tells which segments are out of place,
+without parsing the message or raising.
+
+The automaton is built as an NFA (segments and groups are sequences, choices
+and optional or repeating parts) and read as a DFA whose states are made as
+they are first reached, so only the paths real messages take are ever built.
+"""
+
+from collections import deque
+from functools import lru_cache
+
+from hl7apy import load_library, load_reference
+from hl7apy.exceptions import ChildNotFound, UnsupportedVersion
+
+# hl7apy names the segment of a choice that can be any segment
+ANY_SEGMENT = "ANYHL7SEGMENT"
+
+# HL7 table 0354: trigger events sharing a message structure. Versions without the
+# first structure define the others for those events, e.g. v2.3 has no ADT_A05
+SHARED_STRUCTURES = [
+    (("ADT_A01",), "ADT", "A01 A04 A08 A13"),
+    (("ADT_A05", "ADT_A01"), "ADT", "A05 A14 A28 A31"),
+    (("ADT_A06",), "ADT", "A06 A07"),
+    (("ADT_A09",), "ADT", "A09 A10 A11 A12"),
+    (("ADT_A21",), "ADT", "A21 A22 A23 A25 A26 A27 A29 A32 A33"),
+    (("ADT_A30",), "ADT", "A30 A34 A35 A36 A46 A47 A48 A49"),
+    (("ADT_A39",), "ADT", "A39 A40 A41 A42"),
+    (("ADT_A43",), "ADT", "A43 A44"),
+    (("ADT_A50",), "ADT", "A50 A51"),
+    (("ADT_A52",), "ADT", "A52 A53 A55"),
+    (("ADT_A54",), "ADT", "A54 A56"),
+    (("ADT_A61",), "ADT", "A61 A62"),
+    (("BAR_P01",), "BAR", "P01 P05"),
+    (("MDM_T01",), "MDM", "T01 T03 T05 T07 T09 T11"),
+    (("MDM_T02",), "MDM", "T02 T04 T06 T08 T10"),
+    (("ORU_R30",), "ORU", "R30 R31 R32"),
+    (("RDE_O11",), "RDE", "O11 O25"),
+    (("SIU_S12",), "SIU", "S12 S13 S14 S15 S16 S17 S18 S19 S20 S21 S22 S23 S24 S26"),
+    (("SRM_S01",), "SRM", "S01 S02 S03 S04 S05 S06 S07 S08 S09 S10 S11"),
+    (("SRR_S01",), "SRR", "S01 S02 S03 S04 S05 S06 S07 S08 S09 S10 S11"),
+]
+EVENT_STRUCTURES = {
+    (code, event): structures for structures, code, events in SHARED_STRUCTURES for event in events.split()
+}
+
+
+class Automaton:
+    """
+    Segment order of one message structure
+    :param reference: hl7apy reference of the message structure
+    """
+
+    def __init__(self, reference):
+        # NFA: per state, a list of (segment id or None for an empty move, next state)
+        self._edges = []
+        start, self._end = self._fragment(reference)
+        self.alphabet = frozenset(symbol for edges in self._edges for symbol, _ in edges if symbol is not None)
+        # DFA states, made as they are reached: sets of NFA states and the moves out of them
+        self._states = []
+        self._ids = {}
+        self._moves = {}
+        self.start = self._state(self._closure([start]))
+
+    def _new(self):
+        self._edges.append([])
+        return len(self._edges) - 1
+
+    def _fragment(self, reference):
+        """
+        NFA part of a sequence or choice reference
+        :return: first and last state
+        """
+        kind, children = reference[0], reference[1]
+        start = end = self._new()
+        if kind == "choice":
+            end = self._new()
+        for name, child_reference, (min_repetitions, max_repetitions), classname in children:
+            if classname == "GRP":
+                first, last = self._fragment(child_reference)
+            else:
+                first, last = self._new(), self._new()
+                self._edges[first].append((name, last))
+            if max_repetitions == -1:
+                self._edges[last].append((None, first))
+            if min_repetitions == 0:
+                self._edges[first].append((None, last))
+            if kind == "choice":
+                self._edges[start].append((None, first))
+                self._edges[last].append((None, end))
+            else:
+                self._edges[end].append((None, first))
+                end = last
+        return start, end
+
+    def _closure(self, states):
+        """
+        States reached from states by empty moves
+        """
+        reached = set(states)
+        pending = list(states)
+        while pending:
+            for symbol, target in self._edges[pending.pop()]:
+                if symbol is None and target not in reached:
+                    reached.add(target)
+                    pending.append(target)
+        return frozenset(reached)
+
+    def _state(self, states):
+        state = self._ids.get(states)
+        if state is None:
+            state = self._ids[states] = len(self._states)
+            self._states.append(states)
+        return state
+
+    def _targets(self, states, segment):
+        return [
+            target
+            for state in states
+            for symbol, target in self._edges[state]
+            if symbol == segment or symbol == ANY_SEGMENT
+        ]
+
+    def _ahead(self, state):
+        """
+        NFA states reachable from a DFA state by any moves, i.e. skipping required segments
+        """
+        key = (state, None)
+        if key not in self._moves:
+            reached = set(self._states[state])
+            pending = list(reached)
+            while pending:
+                for _, target in self._edges[pending.pop()]:
+                    if target not in reached:
+                        reached.add(target)
+                        pending.append(target)
+            self._moves[key] = reached
+        return self._moves[key]
+
+    def move(self, state, segment, skip=False):
+        """
+        State after reading a segment id, None when the segment cannot come next
+        :param skip: allow skipping segments, required or not, before this one
+        """
+        key = (state, segment, skip)
+        if key not in self._moves:
+            states = self._ahead(state) if skip else self._states[state]
+            targets = self._targets(states, segment)
+            self._moves[key] = self._state(self._closure(targets)) if targets else None
+        return self._moves[key]
+
+    def accepting(self, state):
+        return self._end in self._states[state]
+
+    def checked(self, segment):
+        """
+        Whether the order of a segment is checked: Z segments can go anywhere, and
+        segments the structure does not know are reported by hl7apy
+        """
+        return segment in self.alphabet or (ANY_SEGMENT in self.alphabet and not segment.startswith("Z"))
+
+    def _skipped(self, state, segment):
+        """
+        Fewest segments to skip from a DFA state before segment can come, or before
+        the message can end when segment is None
+        :return: skipped segment ids, None when segment cannot come at all
+        """
+        key = (state, segment, None)
+        if key not in self._moves:
+            self._moves[key] = None
+            # 0-1 breadth first search: empty moves are free, segment moves cost one
+            costs = dict.fromkeys(self._states[state], 0)
+            previous = dict.fromkeys(self._states[state])
+            pending = deque(costs)
+            while pending:
+                current = pending.popleft()
+                if current == self._end if segment is None else self._targets([current], segment):
+                    skipped = []
+                    while previous[current] is not None:
+                        current, symbol = previous[current]
+                        if symbol is not None and symbol != ANY_SEGMENT:
+                            skipped.append(symbol)
+                    self._moves[key] = skipped[::-1]
+                    break
+                for symbol, target in self._edges[current]:
+                    cost = costs[current] + (symbol is not None)
+                    if cost < costs.get(target, cost + 1):
+                        costs[target] = cost
+                        previous[target] = (current, symbol)
+                        if symbol is None:
+                            pending.appendleft(target)
+                        else:
+                            pending.append(target)
+        return self._moves[key]
+
+    def accepts(self, segments):
+        """
+        Whether the segment ids are in an order the structure allows, from MSH to the end
+        """
+        state = self.start
+        for segment in segments:
+            if not self.checked(segment):
+                continue
+            state = self.move(state, segment)
+            if state is None:
+                return False
+        return self.accepting(state)
+
+    def check(self, segments):
+        """
+        Segments that come where the structure does not allow them, and required
+        segments missing. The reading goes on after a segment out of place, and skips
+        over missing segments to the first place the next segment can come.
+        :param segments: segment ids of the message, in order
+        :return: lists of (position, segment id) out of place, and of (position, segment id)
+                 missing before that position
+        """
+        misplaced, missing = [], []
+        state = self.start
+        for index, segment in enumerate(segments):
+            if not self.checked(segment):
+                continue
+            following = self.move(state, segment)
+            if following is None:
+                skipped = self._skipped(state, segment)
+                if skipped is None:
+                    misplaced.append((index, segment))
+                    continue
+                missing.extend((index, required) for required in skipped)
+                following = self.move(state, segment, skip=True)
+            state = following
+        if not self.accepting(state):
+            missing.extend((len(segments), required) for required in self._skipped(state, None))
+        # a segment that is there, only out of place, is not missing too
+        found = {segment for _, segment in misplaced}
+        return misplaced, [(index, segment) for index, segment in missing if segment not in found]
+
+
+def message_references(version):
+    """
+    hl7apy message structure references of a version, empty when the version is not supported
+    """
+    try:
+        return load_library(version).MESSAGES
+    except UnsupportedVersion:
+        return {}
+
+
+@lru_cache(maxsize=None)
+def compile_structure(version, structure):
+    """
+    Automaton of a message structure, compiled once per version
+    :return: Automaton, None when the version has no such structure
+    """
+    reference = message_references(version).get(structure)
+    if reference is None:
+        return None
+    return Automaton(reference)
+
+
+@lru_cache(maxsize=None)
+def has_structure_component(version):
+    """
+    Whether MSH-9 has a message structure component (MSH-9.3) in a version, from v2.3.1 on
+    """
+    try:
+        reference = load_reference("MSH_9", "Field", version)
+    except (ChildNotFound, UnsupportedVersion):
+        return False
+    return reference[0] == "sequence" and len(reference[1]) >= 3
+
+
+def find_structure(version, code, event, segments=()):
+    """
+    Message structure of a message type, e.g. ADT_A01 for ADT^A04.
+
+    Shared structures come first, then CODE_EVENT and CODE. When the version defines
+    none of them, the first structure of the message code whose order the segments
+    follow is taken.
+    :param segments: segment ids of the message, to pick a structure when none is defined
+    :return: structure name, None when not found
+    """
+    references = message_references(version)
+    if not code or not references:
+        return None
+    candidates = EVENT_STRUCTURES.get((code, event), ()) + (f"{code}_{event}", code)
+    for structure in candidates:
+        if structure in references:
+            return structure
+    if segments:
+        for structure in sorted(references):
+            if structure.split("_")[0] == code and compile_structure(version, structure).accepts(segments):
+                return structure
+    return None
+
+
+def check_structure(version, structure, segments):
+    """
+    Check the segment order of a message against a message structure, see Automaton.check
+    :param segments: segment lines or ids of the message, in order
+    :return: segments out of place and required segments missing, both empty when the
+             structure is not known
+    """
+    automaton = compile_structure(version, structure) if structure else None
+    if automaton is None:
+        return [], []
+    return automaton.check([segment[0:3] for segment in segments if segment])
@@ -0,0 +1,184 @@
+"""
+One-pass tokenizer of ER7 messages.
+
+The message is scanned once for segment terminators and its delimiters are read
+from MSH-1 and MSH-2. Segments, and the fields, repetitions and components of a
+segment, are kept as offsets into the original text in compact arrays, and a
+value is only sliced out when a stage asks for it. Stages share one Tokens per
+message instead of each copying the message to split it again.
+
+Segments are split the way ``set_message_to_validate`` normalizes a message:
+on CRLF and CR when the message has any CRLF, on CR and LF otherwise.
+"""
+
+import re
+from array import array
+from collections import namedtuple
+
+Delimiters = namedtuple("Delimiters", ["field", "component", "repetition", "escape", "subcomponent"])
+DEFAULT_DELIMITERS = Delimiters("|", "^", "~", "\\", "&")
+
+CRLF_TERMINATORS = re.compile(r"\r\n|\r")
+TERMINATORS = re.compile(r"[\r\n]")
+
+
+def read_delimiters(msg, end=None):
+    """
+    Delimiters of a message from MSH-1 and MSH-2, the defaults for those it does not set
+    :param end: end of the MSH segment
+    """
+    if not msg.startswith("MSH") or len(msg) < 4:
+        return DEFAULT_DELIMITERS
+    field = msg[3]
+    end = len(msg) if end is None else end
+    encoding = msg[4:end].split(field, 1)[0]
+    return Delimiters(field, *(encoding[i] if i < len(encoding) else DEFAULT_DELIMITERS[i + 1] for i in range(4)))
+
+
+def spans(text, start, end, separator):
+    """
+    Boundaries of the parts of text[start:end] split on separator: part k is
+    text[bounds[k] + 1:bounds[k + 1]]
+    :return: array of len(parts) + 1 offsets
+    """
+    bounds = array("l", [start - 1])
+    position = text.find(separator, start, end)
+    while position != -1:
+        bounds.append(position)
+        position = text.find(separator, position + 1, end)
+    bounds.append(end)
+    return bounds
+
+
+class SegmentLines:
+    """
+    Segment lines of a tokenized message, sliced from the message when read
+    """
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+
+    def __len__(self):
+        return len(self._tokens.starts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._tokens.segment(index)
+
+    def __iter__(self):
+        msg, starts, ends = self._tokens.msg, self._tokens.starts, self._tokens.ends
+        for i in range(len(starts)):
+            yield msg[starts[i]:ends[i]]
+
+
+class Tokens:
+    """
+    Offsets of the segments of a message, and of the fields of each segment once asked for
+    :param msg: ER7 message, segments separated by any line terminator
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.starts = array("l")
+        self.ends = array("l")
+        # whether every terminator is a single CR, so the message needs no normalized copy
+        self._normalized = True
+        position = 0
+        for match in (CRLF_TERMINATORS if "\r\n" in msg else TERMINATORS).finditer(msg):
+            self.starts.append(position)
+            self.ends.append(match.start())
+            if match.end() - match.start() != 1 or msg[match.start()] != "\r":
+                self._normalized = False
+            position = match.end()
+        self.starts.append(position)
+        self.ends.append(len(msg))
+        if len(self.starts) == 1:
+            # a message without terminators is normalized with a trailing CR
+            self.starts.append(len(msg))
+            self.ends.append(len(msg))
+            self._normalized = False
+        self.delimiters = read_delimiters(msg, self.ends[0])
+        self._fields = [None] * len(self.starts)
+        self.lines = SegmentLines(self)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def normalized(self):
+        """
+        The message with CR segment terminators, the message itself when it already has them
+        """
+        if self._normalized:
+            return self.msg
+        return "\r".join(self.lines)
+
+    def segment(self, index):
+        return self.msg[self.starts[index]:self.ends[index]]
+
+    def segment_id(self, index):
+        start = self.starts[index]
+        return self.msg[start:min(start + 3, self.ends[index])]
+
+    def segment_ids(self):
+        return [self.segment_id(i) for i in range(len(self.starts))]
+
+    def field_bounds(self, index):
+        """
+        Boundaries of the fields of a segment, the segment id being field 0, see spans
+        """
+        bounds = self._fields[index]
+        if bounds is None:
+            bounds = self._fields[index] = spans(self.msg, self.starts[index], self.ends[index], self.delimiters.field)
+        return bounds
+
+    def fields(self, index):
+        """
+        Fields of a segment, like its line split on the field separator
+        """
+        msg, bounds = self.msg, self.field_bounds(index)
+        return [msg[bounds[k] + 1:bounds[k + 1]] for k in range(len(bounds) - 1)]
+
+    def field_span(self, index, position):
+        """
+        Offsets of a field of a segment by HL7 position, MSH-1 being the field separator itself
+        :return: start and end, None when the segment has no such field
+        """
+        if self.segment_id(index) == "MSH":
+            if position == 1:
+                start = self.starts[index] + 3
+                return start, start + 1
+            position -= 1
+        bounds = self.field_bounds(index)
+        if not 0 <= position < len(bounds) - 1:
+            return None
+        return bounds[position] + 1, bounds[position + 1]
+
+    def field(self, index, position):
+        """
+        Value of a field by HL7 position, empty when the segment has no such field
+        """
+        span = self.field_span(index, position)
+        return self.msg[span[0]:span[1]] if span else ""
+
+    def components(self, index, position, repetition=0):
+        """
+        Components of a field repetition
+        """
+        span = self.field_span(index, position)
+        if span is None:
+            return []
+        if repetition or self.delimiters.repetition in self.msg[span[0]:span[1]]:
+            bounds = spans(self.msg, span[0], span[1], self.delimiters.repetition)
+            if repetition >= len(bounds) - 1:
+                return []
+            span = bounds[repetition] + 1, bounds[repetition + 1]
+        bounds = spans(self.msg, span[0], span[1], self.delimiters.component)
+        return [self.msg[bounds[k] + 1:bounds[k + 1]] for k in range(len(bounds) - 1)]
+
+    def repetitions(self, index, position):
+        span = self.field_span(index, position)
+        if span is None:
+            return []
+        bounds = spans(self.msg, span[0], span[1], self.delimiters.repetition)
+        return [self.msg[bounds[k] + 1:bounds[k + 1]] for k in range(len(bounds) - 1)]
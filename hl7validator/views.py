@@ -1,27 +1,87 @@
 from flask import (
+    Response,
+    stream_with_context,
     render_template,
     redirect,
     request,
     jsonify,
-    send_from_directory,
+    send_file,
     abort,
     session,
     g,
 )
-from flask_babel import gettext, get_locale
-import os
-from hl7validator.api import hl7validatorapi, from_hl7_to_df, highlight_message, build_tree_structure
-from hl7validator import app
+import codecs
+import io
+import json
+from hl7validator.api import (
+    check_size,
+    hl7validatorapi,
+    from_hl7_to_df,
+    serialize_df,
+    CONVERTER_FORMATS,
+    render_message,
+    segment_subtree,
+    ValidationContext,
+)
+from hl7validator.batch import validate_batch, iter_validate, iter_ndjson
+from hl7validator.bulk import split_messages
+from hl7validator.jobs import job_store, DONE, FAILED
+from hl7validator import app, metrics
+from hl7validator.admission import admission, Overloaded
+from hl7validator.metrics import stage
 from hl7validator.__version__ import __version__
 
 # Version is now managed centrally in __version__.py and pyproject.toml
 VERSION = __version__
 
+# Admission lanes of the endpoints doing validation or conversion work, see hl7validator.admission
+LANES = {
+    "home": "interactive",
+    "tree_segment": "interactive",
+    "hl7v2validatorapi": "bulk",
+    "hl7v2validatorbatchapi": "bulk",
+    "from_hl7_to_df_converter": "bulk",
+}
+
 
 @app.before_request
 def before_request():
     """Store current language in g for templates"""
+    from flask_babel import get_locale  # loaded with Babel, on the first request
+
     g.current_lang = str(get_locale())
+    metrics.start_request()
+
+    lane = LANES.get(request.endpoint) if request.method == "POST" else None
+    if lane is not None:
+        with stage("admission"):
+            try:
+                g.admitted = (lane, admission.acquire(lane))
+            except Overloaded as overloaded:
+                app.logger.warning("Request rejected: %s", overloaded)
+                response = jsonify({"error": str(overloaded)})
+                response.status_code = 429
+                response.headers["Retry-After"] = str(overloaded.retry_after)
+                return response
+
+
+@app.after_request
+def server_timing(response):
+    """Record the stage times of the request and send them in a Server-Timing header"""
+    finished = metrics.finish_request(request.endpoint, response.status_code)
+    if finished is not None:
+        timings, total = finished
+        response.headers["Server-Timing"] = timings.server_timing(total)
+    return response
+
+
+@app.teardown_request
+def record_failed_request(error=None):
+    """Record requests whose view raised, after_request is skipped for them"""
+    metrics.finish_request(request.endpoint, 500)
+    admitted = g.pop("admitted", None)
+    if admitted is not None:
+        admission.release(*admitted)
 
 
 @app.route("/set_language/<language>")
@@ -56,33 +116,40 @@ def home(lang=None):
         if not msg:
             return render_template("hl7validatorhome.html", version=VERSION)
         elif req == "hl7v2":
-            validation = hl7validatorapi(request.form.get("msg"), validation_level=validation_level)
-            print(validation)
-            if validation["hl7version"]:
-                parsed_message, validation = highlight_message(msg, validation)
-                tree_structure, validation = build_tree_structure(msg, validation)
+            # Parse once and share the parsed trees between validation and rendering; an oversized
+            # message is rejected by hl7validatorapi before it is tokenized
+            context = ValidationContext(msg, validation_level) if check_size(msg) is None else None
+            validation = hl7validatorapi(msg, validation_level=validation_level, context=context)
+            # a validation that ran out of time is not rendered, that would take as long
+            if validation["hl7version"] and not validation.get("timedOut"):
+                # One pass for both views; the tree has segment headers only and the page
+                # fetches a segment's fields when it is expanded
+                parsed_message, tree_structure, validation = render_message(
+                    msg, validation, context=context, lazy_tree=True
+                )
             details = sorted(validation["details"], key=lambda d: list(d.values())[0])
             warnings = validation.get("warnings", [])
 
             # Translate validation message
+            from flask_babel import gettext
+
             status_message = gettext(validation["message"])
 
-            return render_template(
-                "hl7validatorhome.html",
-                title=status_message,
-                msg=msg,
-                result=details,
-                warnings=warnings,
-                version=VERSION,
-                hl7version=validation["hl7version"],
-                parsed=parsed_message,
-                tree=tree_structure,
-            )
+            with stage("template"):
+                return render_template(
+                    "hl7validatorhome.html",
+                    title=status_message,
+                    msg=msg,
+                    result=details,
+                    warnings=warnings,
+                    version=VERSION,
+                    hl7version=validation["hl7version"],
+                    parsed=parsed_message,
+                    tree=tree_structure,
+                )
 
         elif req == "converter":
-            return send_from_directory(
-                os.getcwd(), from_hl7_to_df(request.form.get("msg")), as_attachment=True
-            )
+            return converted_response(msg)
     else:
         return render_template("hl7validatorhome.html", version=VERSION)
 
@@ -99,15 +166,159 @@ def hl7v2validatorapi():
     return jsonify(hl7validatorapi(data, validation_level=validation_level))
 
 
-@app.route("/api/hl7/v1/convert/", methods=["POST"])
-def from_hl7_to_df_converter():
+@app.route("/api/hl7/v1/validate/batch", methods=["POST"])
+def hl7v2validatorbatchapi():
     """
-    file: docs/converter.yml
+    file: docs/batch.yml
     """
+
+    if request.mimetype == "application/x-ndjson":
+        # Stream: read one message per line and write each result as soon as it is ready
+        request.max_content_length = app.config["STREAM_MAX_CONTENT_LENGTH"]
+        validation_level = request.args.get("validation_level", "tolerant")
+        results = iter_validate(iter_ndjson(request.stream), validation_level=validation_level)
+        chunks = stream_with_context(json.dumps(result) + "\n" for result in results)
+        # the request is torn down before the stream is sent, the stream holds the admission slot
+        admitted = g.pop("admitted", None)
+        if admitted is not None:
+            chunks = admission.released_after(chunks, *admitted)
+        return Response(chunks, mimetype="application/x-ndjson")
+
     data = request.json["data"]
+    if not isinstance(data, list):
+        abort(400)
+    validation_level = request.json.get("validation_level", "tolerant")
+
+    return jsonify(validate_batch(data, validation_level=validation_level))
+
+
+@app.route("/api/hl7/v1/tree/segment", methods=["POST"])
+def tree_segment():
+    """
+    file: docs/tree.yml
+    """
+    data = request.json.get("data")
+    text = request.json.get("text")
+    index = request.json.get("segment")
+    if not (data or text) or not isinstance(index, int):
+        abort(400)
+    if text and not request.json.get("hl7version"):
+        abort(400)
     try:
-        return send_from_directory(
-            os.getcwd(), from_hl7_to_df(data), as_attachment=True
+        subtree = segment_subtree(
+            data,
+            index,
+            hl7version=request.json.get("hl7version"),
+            errors=request.json.get("errors") or [],
+            text=text or None,
         )
-    except FileNotFoundError:
+    except IndexError:
+        abort(404)
+    except Exception as err:
+        return jsonify({"error": str(err)}), 422
+    return jsonify(subtree)
+
+
+def converted_response(msg):
+    """
+    Converted message as a download, serialized in memory in the format the client accepts
+    """
+    if request.accept_mimetypes:
+        mimetype = request.accept_mimetypes.best_match(list(CONVERTER_FORMATS))
+    else:
+        mimetype = "text/csv"  # no Accept header
+    if mimetype is None:
+        abort(406)
+    fmt = CONVERTER_FORMATS[mimetype]
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            abort(406)
+    with stage("convert"):
+        df, control_id = from_hl7_to_df(msg)
+        data = serialize_df(df, fmt)
+    return send_file(
+        data,
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f"{control_id}.{fmt}",
+    )
+
+
+@app.route("/api/hl7/v1/convert/", methods=["POST"])
+def from_hl7_to_df_converter():
+    """
+    file: docs/converter.yml
+    """
+    return converted_response(request.json["data"])
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """
+    file: docs/metrics.yml
+    """
+    return Response(metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/api/hl7/v1/jobs", methods=["POST"])
+def create_job():
+    """
+    file: docs/jobs.yml
+    """
+    if request.mimetype == "multipart/form-data":
+        # uploads can be as large as a streamed batch, they are split and queued without being held in memory
+        request.max_content_length = app.config["STREAM_MAX_CONTENT_LENGTH"]
+    if "file" in request.files:
+        validation_level = request.form.get("validation_level", "tolerant")
+        encoding = request.form.get("encoding", "utf-8")
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            abort(400)
+        # universal newlines split segments on \r, \n and \r\n alike, like the validate command
+        lines = io.TextIOWrapper(request.files["file"].stream, encoding=encoding, errors="replace")
+        items = split_messages(lines)
+    else:
+        body = request.get_json(silent=True) or {}
+        items = body.get("data")
+        if not isinstance(items, list):
+            abort(400)
+        validation_level = body.get("validation_level", "tolerant")
+    job = job_store.create(items, validation_level)
+    response = jsonify(job)
+    response.status_code = 202
+    response.headers["Location"] = f"/api/hl7/v1/jobs/{job['id']}"
+    return response
+
+
+@app.route("/api/hl7/v1/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    """
+    file: docs/job.yml
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
+@app.route("/api/hl7/v1/jobs/<job_id>/results", methods=["GET"])
+def job_results(job_id):
+    """
+    file: docs/job_results.yml
+    """
+    job = job_store.get(job_id)
+    if job is None:
         abort(404)
+    if job["status"] not in (DONE, FAILED):
+        return jsonify({"error": f"Job is {job['status']}", "job": job}), 409
+    lines = (
+        json.dumps({"index": index, **result}) + "\n"
+        for index, result in job_store.results(job_id)
+        if result is not None
+    )
+    response = Response(lines, mimetype="application/x-ndjson")
+    response.headers["Content-Disposition"] = f"attachment; filename={job_id}.ndjson"
+    return response
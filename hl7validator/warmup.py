@@ -0,0 +1,65 @@
+"""
+Warm-up that loads everything a first request would otherwise load lazily.
+
+hl7apy imports the reference modules of a version the first time a message of
+that version is parsed, which makes the first request of every gunicorn worker
+much slower than the rest. Running the warm-up in the gunicorn master before it
+forks (``--preload``) loads the references of every supported version once and
+freezes the heap, so workers start warm and share those pages copy-on-write.
+"""
+
+import gc
+import logging
+import time
+
+from hl7apy import SUPPORTED_LIBRARIES, load_library
+
+from hl7validator import app, init_extensions
+from hl7validator.api import ValidationContext, validate_message, render_message
+
+# Supported versions, 2.1 to 2.8.2
+VERSIONS = sorted(SUPPORTED_LIBRARIES, key=lambda v: tuple(int(p) for p in v.split(".")))
+
+WARMUP_MESSAGE = (
+    "MSH|^~\\&|WARMUP|HL7PT|WARMUP|HL7PT|20240101000000||ADT^A01|1|P|{version}\r"
+    "EVN|A01|20240101000000\r"
+    "PID|||1^^^HL7PT||DOE^JOHN||19700101|M\r"
+    "PV1||I"
+)
+
+
+def warm_up(versions=None, freeze=True):
+    """
+    Load the hl7apy references of each version and run one validation per version
+    :param versions: versions to warm up, defaults to every supported version
+    :param freeze: move the objects created so far to the permanent generation
+    :return: seconds spent
+    """
+    versions = versions or VERSIONS
+    start = time.perf_counter()
+    # Babel and Flasgger load on the first request, preload them too
+    init_extensions()
+    # The warm-up message is not valid in every version, keep its findings out of the logs
+    level = app.logger.level
+    app.logger.setLevel(logging.CRITICAL)
+    try:
+        for version in versions:
+            load_library(version)
+            msg = WARMUP_MESSAGE.format(version=version)
+            try:
+                context = ValidationContext(msg)
+                validation = validate_message(context)
+                # the web form's path: both views in one pass, the tree with segment headers only
+                render_message(msg, validation, context, lazy_tree=True)
+            except Exception as err:
+                app.logger.critical("Warm-up of version %s failed: %s", version, err)
+    finally:
+        app.logger.setLevel(level)
+    if freeze:
+        # Collect first so garbage is not frozen, then keep the collector from
+        # touching (and un-sharing) the warm pages in forked workers
+        gc.collect()
+        gc.freeze()
+    seconds = time.perf_counter() - start
+    app.logger.info("Warm-up of %d HL7 versions done in %.2fs", len(versions), seconds)
+    return seconds
@@ -0,0 +1,4 @@
+"""Messages shared by the tests: an ADT^A34 merge, valid, and the same message missing EVN-2."""
+
+VALID = "MSH|^~\\&|MCDTS|HCIS|PACS_HCIS|HCIS|20190520144959||ADT^A34^ADT_A30|24919117|P|2.4|||AL\rEVN|A34|20190520144959\rPID|||JMS17131790^^^JMS^NS|256886210^^^NIF^PT|THOMPSON^ELIZABETH|THOMPSON^ELIZABETH^GRACE||20060523000000|F\rMRG|JMS61226892^^^JMS^NS"
+INVALID = VALID.replace("EVN|A34|20190520144959", "EVN|A34")
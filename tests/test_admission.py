@@ -0,0 +1,70 @@
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+from hl7validator import app
+from hl7validator.admission import AdmissionController, Lane, Overloaded, admission
+
+MSG = "MSH|^~\\&|A|B|C|D|20240101||ADT^A01^ADT_A01|1|P|2.5\rEVN|A01|20240101\rPID|||1||DOE^J\rPV1||I"
+
+
+class TestAdmission(unittest.TestCase):
+    def test_full_queue_is_rejected(self):
+        controller = AdmissionController({"bulk": (1, 0)}, max_wait=0)
+        started = controller.acquire("bulk")
+        with self.assertRaises(Overloaded) as raised:
+            controller.acquire("bulk")
+        self.assertEqual(raised.exception.retry_after, 1)
+        controller.release("bulk", started)
+        controller.release("bulk", controller.acquire("bulk"))
+        self.assertEqual(controller.stats()["bulk"]["rejected"], 1)
+
+    def test_queued_request_gets_freed_slot(self):
+        controller = AdmissionController({"bulk": (1, 1)}, max_wait=5)
+        started = controller.acquire("bulk")
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(controller.acquire("bulk")))
+        waiter.start()
+        while controller.stats()["bulk"]["waiting"] == 0:
+            time.sleep(0.001)
+        # the queue is full now
+        with self.assertRaises(Overloaded):
+            controller.acquire("bulk")
+        controller.release("bulk", started)
+        waiter.join(5)
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(controller.stats()["bulk"]["in_flight"], 1)
+
+    def test_bulk_saturation_leaves_interactive_lane(self):
+        client = app.test_client()
+        with mock.patch.dict(admission.lanes, bulk=Lane("bulk", 1, 0)):
+            started = admission.acquire("bulk")
+            try:
+                response = client.post("/api/hl7/v1/validate/", json={"data": MSG})
+                self.assertEqual(response.status_code, 429)
+                self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+                response = client.post("/api/hl7/v1/tree/segment", json={"data": MSG, "segment": 2})
+                self.assertEqual(response.status_code, 200)
+            finally:
+                admission.release("bulk", started)
+            self.assertEqual(client.post("/api/hl7/v1/validate/", json={"data": MSG}).status_code, 200)
+            self.assertEqual(admission.stats()["bulk"]["in_flight"], 0)
+
+    def test_stream_holds_slot_until_sent(self):
+        client = app.test_client()
+        with mock.patch.dict(app.config, BATCH_WORKERS=1):
+            response = client.post(
+                "/api/hl7/v1/validate/batch",
+                data=json.dumps(MSG) + "\n" + json.dumps(MSG),
+                content_type="application/x-ndjson",
+                buffered=False,
+            )
+            self.assertEqual(admission.stats()["bulk"]["in_flight"], 1)
+            self.assertEqual(len(b"".join(response.response).splitlines()), 2)
+            response.close()
+        self.assertEqual(admission.stats()["bulk"]["in_flight"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
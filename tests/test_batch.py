@@ -0,0 +1,61 @@
+import json
+import unittest
+from hl7validator import app
+from hl7validator.api import hl7validatorapi
+from hl7validator.batch import validate_batch
+from messages import VALID, INVALID
+
+
+class TestBatchValidation(unittest.TestCase):
+    def test_results_in_input_order(self):
+        """
+        Results come back in input order, each with its own validation level
+        """
+        items = [VALID, {"data": INVALID}, {"data": VALID, "validation_level": "strict"}] * 4
+        results = validate_batch(items, workers=2)
+        expected = [
+            hl7validatorapi(VALID),
+            hl7validatorapi(INVALID),
+            hl7validatorapi(VALID, validation_level="strict"),
+        ] * 4
+        self.assertEqual(results, expected)
+
+    def test_empty_entry(self):
+        """
+        Empty entries fail without aborting the whole batch
+        """
+        results = validate_batch(["", VALID], workers=1)
+        self.assertEqual(results[0]["statusCode"], "Failed")
+        self.assertEqual(results[1]["statusCode"], "Success")
+
+    def test_batch_endpoint(self):
+        """
+        Tests the batch endpoint
+        """
+        client = app.test_client()
+        response = client.post("/api/hl7/v1/validate/batch", json={"data": [VALID, INVALID]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["statusCode"] for r in response.json], ["Success", "Failed"])
+
+        response = client.post("/api/hl7/v1/validate/batch", json={"data": VALID})
+        self.assertEqual(response.status_code, 400)
+
+    def test_ndjson_stream(self):
+        """
+        NDJSON bodies are answered with one NDJSON result line per input line
+        """
+        client = app.test_client()
+        lines = [json.dumps(VALID), json.dumps({"data": INVALID}), "not json", ""]
+        response = client.post(
+            "/api/hl7/v1/validate/batch",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([r["statusCode"] for r in results], ["Success", "Failed", "Failed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
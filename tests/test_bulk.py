@@ -0,0 +1,95 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from contextlib import redirect_stderr
+from hl7validator import app
+from hl7validator.__main__ import main
+from hl7validator.bulk import percentile, split_messages, iter_files, validate_paths
+from messages import VALID, INVALID
+
+
+class TestBulkValidation(unittest.TestCase):
+    def test_split_batch_envelope(self):
+        """
+        FHS/BHS envelopes are dropped and each MSH starts a new message
+        """
+        text = "FHS|^~\\&|A\nBHS|^~\\&|A\n" + VALID.replace("\r", "\n") + "\n\n" + INVALID.replace("\r", "\r\n") + "\nBTS|2\nFTS|1\n"
+        messages = list(split_messages(io.StringIO(text, newline=None)))
+        self.assertEqual(messages, [VALID, INVALID])
+
+    def test_split_mllp_frames(self):
+        text = "\x0b" + VALID + "\x1c\r" + "\x0b" + INVALID + "\x1c\r"
+        self.assertEqual(list(split_messages(io.StringIO(text, newline=None))), [VALID, INVALID])
+
+    def test_validate_paths(self):
+        """
+        Directories and globs are expanded and every message gets one JSON line
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, "sub"))
+            with open(os.path.join(tmp, "a.hl7"), "w", newline="") as f:
+                f.write(VALID + "\r" + INVALID)
+            with open(os.path.join(tmp, "sub", "b.hl7"), "w") as f:
+                f.write(VALID.replace("\r", "\n"))
+
+            self.assertEqual(len(list(iter_files([tmp]))), 2)
+            self.assertEqual(len(list(iter_files([os.path.join(tmp, "**", "*.hl7")]))), 2)
+
+            output = io.StringIO()
+            summary = validate_paths([tmp], output, workers=2)
+
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([(os.path.basename(l["file"]), l["index"], l["statusCode"]) for l in lines],
+                         [("a.hl7", 0, "Success"), ("a.hl7", 1, "Failed"), ("b.hl7", 0, "Success")])
+        self.assertEqual(summary["messages"], 3)
+        self.assertEqual(summary["failed"], 1)
+        self.assertGreater(summary["messages_per_second"], 0)
+
+    def test_format_checks(self):
+        """
+        Field formats are checked column by column, like the web form checks them while highlighting
+        """
+        bad_date = VALID.replace("20190520144959||ADT", "2019-05-20||ADT")
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "a.hl7"), "w", newline="") as f:
+                f.write(VALID + "\r" + bad_date)
+            lines, summaries = {}, {}
+            for check_formats in (True, False):
+                output = io.StringIO()
+                summaries[check_formats] = validate_paths([tmp], output, workers=1, check_formats=check_formats)
+                lines[check_formats] = [json.loads(line) for line in output.getvalue().splitlines()]
+
+        messages = [[d["message"] for d in line["details"]] for line in lines[True]]
+        self.assertNotIn("Invalid datetime format on field MSH.MSH_7", messages[0])
+        self.assertIn("Invalid datetime format on field MSH.MSH_7", messages[1])
+        # a format problem fails its message, in the output and in the summary
+        self.assertEqual([line["statusCode"] for line in lines[True]], ["Success", "Failed"])
+        self.assertEqual([line["statusCode"] for line in lines[False]], ["Success", "Success"])
+        self.assertEqual((summaries[True]["failed"], summaries[False]["failed"]), (1, 0))
+        self.assertNotIn("Invalid datetime format on field MSH.MSH_7", [d["message"] for d in lines[False][1]["details"]])
+
+    def test_percentile_nearest_rank(self):
+        self.assertEqual(percentile([1.0, 2.0], 0.50), 1.0)
+        self.assertEqual(percentile([1.0, 2.0, 3.0], 0.50), 2.0)
+        self.assertEqual(percentile([float(i) for i in range(1, 101)], 0.99), 99.0)
+        self.assertEqual(percentile([1.0], 0.99), 1.0)
+        self.assertEqual(percentile([], 0.50), 0.0)
+
+    def test_missing_path(self):
+        missing = os.path.join(tempfile.gettempdir(), "nonexistent.hl7")
+        # validate turns the app logger down for the rest of the process
+        self.addCleanup(app.logger.setLevel, app.logger.level)
+        for command in ("validate", "convert"):
+            stderr = io.StringIO()
+            # offline commands do not log to a file
+            with redirect_stderr(stderr), mock.patch("hl7validator.__main__.RotatingFileHandler") as handler:
+                self.assertEqual(main([command, missing]), 2)
+            handler.assert_not_called()
+            self.assertIn(f"No files match {missing}", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import gc
+import unittest
+import weakref
+from unittest import mock
+from hl7validator import app
+from hl7validator.api import hl7validatorapi, ValidationContext, render_message
+from hl7validator.cache import ResultCache, SegmentCache, result_cache, segment_cache
+from messages import VALID
+
+
+class TestResultCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = ResultCache(maxsize=2)
+        cache.set("a", {"n": 1})
+        cache.set("b", {"n": 2})
+        cache.get("a")
+        cache.set("c", {"n": 3})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), {"n": 1})
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        cache = ResultCache(maxsize=2, ttl=10)
+        with mock.patch("hl7validator.cache.time.monotonic", return_value=100):
+            cache.set("a", {"n": 1})
+        with mock.patch("hl7validator.cache.time.monotonic", return_value=105):
+            self.assertEqual(cache.get("a"), {"n": 1})
+        with mock.patch("hl7validator.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_key_uses_normalized_message_and_level(self):
+        self.assertEqual(ResultCache.key(VALID, 2), ResultCache.key(ValidationContext(VALID.replace("\r", "\n")).setmsg, 2))
+        self.assertNotEqual(ResultCache.key(VALID, 1), ResultCache.key(VALID, 2))
+
+    def test_hit_skips_parsing(self):
+        """
+        A retransmitted message is answered from the cache without parsing
+        """
+        with mock.patch.object(result_cache, "maxsize", 10):
+            result_cache.clear()
+            first = hl7validatorapi(VALID)
+            context = ValidationContext(VALID.replace("\r", "\n"))
+            second = hl7validatorapi(context.msg, context=context)
+            self.assertEqual(first, second)
+            self.assertIsNone(context._parsed_msg)
+            self.assertEqual(result_cache.stats()["hits"], 1)
+
+            # callers may extend results without touching the cached copy
+            second["details"].append({"level": "Error", "message": "x"})
+            self.assertEqual(hl7validatorapi(VALID), first)
+            result_cache.clear()
+
+
+class TestSegmentCache(unittest.TestCase):
+    def test_lru_and_hit_rate(self):
+        cache = SegmentCache(maxsize=2)
+        cache.set(("2.5", "PID|1"), "tree", [])
+        cache.set(("2.5", "PV1|1"), "tree", [])
+        self.assertEqual(cache.get(("2.5", "PID|1"), "tree"), [])
+        self.assertIsNone(cache.get(("2.5", "PID|1"), "highlight"))
+        cache.set(("2.5", "OBX|1"), "tree", [])
+        self.assertIsNone(cache.get(("2.5", "PV1|1"), "tree"))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 2, 1))
+        self.assertAlmostEqual(stats["hit_rate"], 1 / 3)
+
+    def test_disabled(self):
+        cache = SegmentCache()
+        cache.set(("2.5", "PID|1"), "tree", [])
+        self.assertIsNone(cache.get(("2.5", "PID|1"), "tree"))
+        self.assertEqual(cache.stats()["misses"], 0)
+
+    def test_shared_segments_are_not_parsed_again(self):
+        """
+        A message sharing segments with an earlier one renders the same, parsing only its new segments
+        """
+        other = VALID.replace("24919117", "24919118").replace("EVN|A34|20190520144959", "EVN|A34|2019052014")
+        with mock.patch.object(segment_cache, "maxsize", 100):
+            segment_cache.clear()
+            context = ValidationContext(VALID)
+            render_message(VALID, hl7validatorapi(VALID, context=context), context=context)
+
+            context = ValidationContext(other)
+            rendered = render_message(other, hl7validatorapi(other, context=context), context=context)
+            self.assertEqual(sorted(index for index, _ in context._parsed_segments), [0, 1])
+            segment_cache.clear()
+
+        uncached = ValidationContext(other)
+        self.assertEqual(rendered, render_message(other, hl7validatorapi(other, context=uncached), context=uncached))
+
+    def test_delimiters_are_part_of_the_key(self):
+        pid = "\rPID|||1||DOE^JOHN||19700101#19700102|M"
+        tilde = "MSH|^~\\&|A|B|C|D|20240101||ADT^A01|1|P|2.5" + pid
+        hash_ = "MSH|^#\\&|A|B|C|D|20240101||ADT^A01|1|P|2.5" + pid
+        with mock.patch.object(segment_cache, "maxsize", 100):
+            segment_cache.clear()
+            found = []
+            for msg in (tilde, hash_):
+                context = ValidationContext(msg)
+                _, _, validation = render_message(msg, hl7validatorapi(msg, context=context), context=context)
+                messages = [d["message"] for d in validation["details"]]
+                found.append("Invalid datetime format on field PID.PID_7" in messages)
+            segment_cache.clear()
+        self.assertEqual(found, [True, False])
+
+    def test_unparsable_segment_does_not_keep_messages_alive(self):
+        msg = VALID + "\rXYZ|1"
+        # the log capture of the test runner would keep the logged errors, and their frames
+        with mock.patch.object(segment_cache, "maxsize", 100), mock.patch.object(app.logger, "disabled", True):
+            segment_cache.clear()
+            contexts = []
+            for _ in range(3):
+                context = ValidationContext(msg)
+                rendered = render_message(msg, hl7validatorapi(msg, context=context), context=context)
+                contexts.append(weakref.ref(context))
+                del context
+            gc.collect()
+            self.assertEqual([ref() for ref in contexts], [None, None, None])
+            segment_cache.clear()
+        self.assertIn("[Error parsing message]", rendered[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import io
+import os
+import tempfile
+import unittest
+from hl7validator.__main__ import parse_args
+from hl7validator.columnar import convert_messages, message_fields, output_format, run
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+ADT = "MSH|^~\\&|MCDTS|HCIS|PACS_HCIS|HCIS|20190520144959||ADT^A34^ADT_A30|24919117|P|2.4\rEVN|A34|20190520144959\rPID|||JMS17131790^^^JMS^NS||THOMPSON^ELIZABETH"
+ORU = "MSH|^~\\&|LAB|HCIS|EHR|HCIS|20240101000000||ORU^R01^ORU_R01|42|P|2.5\nPID|||1^^^HCIS||DOE^JOHN\nOBX|1|NM|GLU||5.4\nOBX|2|NM|HGB||13.1"
+
+
+class TestColumnarConverter(unittest.TestCase):
+    def test_message_fields(self):
+        fields = dict(message_fields(ORU))
+        self.assertEqual(fields["MSH-1"], "|")
+        self.assertEqual(fields["MSH-2"], "^~\\&")
+        self.assertEqual(fields["MSH-10"], "42")
+        self.assertEqual(fields["PID-5"], "DOE^JOHN")
+        self.assertEqual(fields["OBX[2]-5"], "13.1")
+        self.assertNotIn("PID-1", fields)
+
+    def test_one_row_per_message(self):
+        df = convert_messages([ADT, ORU, ADT]).to_dataframe()
+        self.assertEqual(df.shape[0], 3)
+        self.assertEqual(list(df["MSH-10"]), ["24919117", "42", "24919117"])
+        self.assertTrue(df["EVN-1"].isna()[1])
+        self.assertTrue(df["OBX-5"].isna()[2])
+        self.assertEqual(df["OBX-5"][1], "5.4")
+
+    def test_csv(self):
+        out = io.StringIO()
+        convert_messages([ADT, ORU]).write(out, "csv")
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("MSH-1,MSH-2,MSH-3"))
+
+    @unittest.skipUnless(pyarrow, "pyarrow not installed")
+    def test_parquet_and_arrow(self):
+        import pyarrow.parquet as pq
+
+        table = convert_messages([ADT, ORU])
+        out = io.BytesIO()
+        table.write(out, "parquet")
+        out.seek(0)
+        self.assertEqual(pq.read_table(out).column("PID-5").to_pylist(), ["THOMPSON^ELIZABETH", "DOE^JOHN"])
+
+        out = io.BytesIO()
+        table.write(out, "arrow")
+        self.assertEqual(pyarrow.ipc.open_file(out.getvalue()).read_all().num_rows, 2)
+
+    def test_output_format(self):
+        self.assertEqual(output_format("out.parquet"), "parquet")
+        self.assertEqual(output_format("out.feather"), "arrow")
+        self.assertEqual(output_format(None), "csv")
+        self.assertEqual(output_format("out.txt", "arrow"), "arrow")
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "batch.hl7"), "w") as f:
+                f.write(ADT.replace("\r", "\n") + "\n" + ORU + "\n")
+            output = os.path.join(tmp, "out.csv")
+            self.assertEqual(run(parse_args(["convert", tmp, "-o", output])), 0)
+            with open(output) as f:
+                self.assertEqual(len(f.read().splitlines()), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
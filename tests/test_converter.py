@@ -0,0 +1,59 @@
+import io
+import os
+import tempfile
+import unittest
+from hl7validator import app
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+MSG = "MSH|^~\\&|SENDING_APPLICATION|SENDING_FACILITY|RECEIVING_APPLICATION|RECEIVING_FACILITY|20110613083637||ADT^A04|00000001|P|2.3.1||||||8859/1"
+
+
+class TestConverterEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = app.test_client()
+
+    def convert(self, accept=None):
+        headers = {"Accept": accept} if accept else {}
+        return self.client.post("/api/hl7/v1/convert/", json={"data": MSG}, headers=headers)
+
+    def test_csv_by_default(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                response = self.convert()
+                self.assertEqual(os.listdir(tmp), [])
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/csv")
+        self.assertIn("filename=00000001.csv", response.headers["Content-Disposition"])
+        lines = response.data.decode().splitlines()
+        self.assertEqual(lines[0], ",0")
+        self.assertEqual(lines[1], "0_MSH_1 (FIELD_SEPARATOR),|")
+
+    def test_json(self):
+        response = self.convert("application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["0_MSH_10 (MESSAGE_CONTROL_ID)"], "00000001")
+
+    def test_not_acceptable(self):
+        self.assertEqual(self.convert("application/xml").status_code, 406)
+
+    @unittest.skipUnless(pyarrow, "pyarrow not installed")
+    def test_parquet(self):
+        import pyarrow.parquet as pq
+
+        response = self.convert("application/vnd.apache.parquet")
+        self.assertEqual(response.status_code, 200)
+        table = pq.read_table(io.BytesIO(response.data))
+        self.assertIn("value", table.column_names)
+        self.assertIn("00000001", table.column("value").to_pylist())
+
+
+if __name__ == "__main__":
+    unittest.main()
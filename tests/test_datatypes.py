@@ -0,0 +1,83 @@
+import unittest
+from hl7validator.api import ValidationContext, hl7validatorapi, highlight_message
+from hl7validator.columnar import convert_messages
+from hl7validator.datatypes import is_valid, check_column, check_table
+
+CASES = {
+    "DTM": ["20240101", "20240101120000.1234+0100", "2024", "20240229", "20230229", "2024-01-01", "2024011", "20240101246000"],
+    "TS": ["20240101120000^S", "20241301"],
+    "DT": ["20240131", "20240431", "2024010112"],
+    "TM": ["1230", "123059.5-0300", "2430", "12:30"],
+    "NM": ["-1.5", "+3", ".5", "1e3", "."],
+    "SI": ["1", "9999", "10000", "-1"],
+    "ID": ["M", "MALE"],
+}
+
+
+class TestDatatypes(unittest.TestCase):
+    def test_is_valid(self):
+        self.assertTrue(is_valid("DTM", "20240101120000.1234+0100"))
+        self.assertTrue(is_valid("DTM", "20240229"))
+        self.assertFalse(is_valid("DTM", "20230229"))
+        self.assertFalse(is_valid("DT", "2024-01-01"))
+        self.assertTrue(is_valid("TS", "20240101^S"))
+        self.assertFalse(is_valid("TM", "2430"))
+        self.assertFalse(is_valid("NM", "1e3"))
+        self.assertFalse(is_valid("SI", "10000"))
+        self.assertFalse(is_valid("ID", "MALE", max_length=1))
+        self.assertTrue(is_valid("DTM", ""))
+
+    def test_repetitions(self):
+        self.assertTrue(is_valid("DT", "20240101~20240102"))
+        self.assertFalse(is_valid("DT", "20240101~20240132"))
+        self.assertTrue(is_valid("DT", "20240101#20240102", separator="#"))
+        self.assertFalse(is_valid("DT", "20240101~20240102", separator="#"))
+        self.assertEqual(check_column("DT", ["20240101#20240102", "20240101~20240102"], separator="#").tolist(), [True, False])
+
+    def test_column_matches_single_values(self):
+        for datatype, values in CASES.items():
+            values = values + ["", None, "20240101~2024-01-02"]
+            expected = [is_valid(datatype, v, max_length=2) for v in values]
+            self.assertEqual(check_column(datatype, values, max_length=2).tolist(), expected, datatype)
+
+    def test_table(self):
+        table = convert_messages(
+            [
+                "MSH|^~\\&|A|B|C|D|20240101120000.5+0100||ADT^A01|1|P|2.5\rPID|||1||DOE^JOHN||19700101|M",
+                "MSH|^~\\&|A|B|C|D|20240230||ADT^A01|2|P|2.5\rPID|||1||DOE^JOHN||1970-01-01|M",
+            ]
+        ).to_dataframe()
+        checked = check_table(table, "2.5")
+        self.assertEqual(checked["MSH-7"].tolist(), [True, False])
+        self.assertEqual(checked["PID-7"].tolist(), [True, False])
+        self.assertNotIn("PID-5", checked.columns)
+
+    def test_table_reads_repetition_separator(self):
+        table = convert_messages(
+            [
+                "MSH|^~\\&|A|B|C|D|20240101||ADT^A01|1|P|2.5\rPID|||1||DOE^JOHN||19700101~19700102|M",
+                "MSH|^#\\&|A|B|C|D|20240101||ADT^A01|2|P|2.5\rPID|||1||DOE^JOHN||19700101#19700102|M",
+                "MSH|^#\\&|A|B|C|D|20240101||ADT^A01|3|P|2.5\rPID|||1||DOE^JOHN||19700101~19700102|M",
+            ]
+        ).to_dataframe()
+        self.assertEqual(check_table(table, "2.5")["PID-7"].tolist(), [True, True, False])
+        self.assertEqual(check_table(table, "2.5", separator="~")["PID-7"].tolist(), [True, False, True])
+
+    def test_highlight_accepts_fractional_seconds(self):
+        msg = "MSH|^~\\&|A|B|C|D|20240101120000.601-0500||ADT^A01|1|P|2.5\rPID|||1||DOE^JOHN||2024-01-01|M"
+        context = ValidationContext(msg)
+        _, validation = highlight_message(msg, hl7validatorapi(msg, context=context), context=context)
+        messages = [d["message"] for d in validation["details"]]
+        self.assertNotIn("Invalid datetime format on field MSH.MSH_7", messages)
+        self.assertIn("Invalid datetime format on field PID.PID_7", messages)
+
+    def test_highlight_reads_repetition_separator(self):
+        msg = "MSH|^#\\&|A|B|C|D|20240101||ADT^A01|1|P|2.5\rPID|||1||DOE^JOHN||19700101#19700102|M"
+        context = ValidationContext(msg)
+        _, validation = highlight_message(msg, hl7validatorapi(msg, context=context), context=context)
+        messages = [d["message"] for d in validation["details"]]
+        self.assertNotIn("Invalid datetime format on field PID.PID_7", messages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from unittest import mock
+from hl7validator import app
+from hl7validator.api import hl7validatorapi, ValidationContext
+from hl7validator.deadline import Deadline, ValidationTimeout
+
+MSG = "MSH|^~\\&|A|B|C|D|20240101||ADT^A01^ADT_A01|1|P|2.5\rEVN|A01|20240101\rPID|||1||DOE^J||2024130\rPV1||I"
+
+
+class TestDeadline(unittest.TestCase):
+    def test_timed_out_validation_returns_partial_result(self):
+        with mock.patch.dict(app.config, VALIDATION_TIMEOUT=1e-9):
+            context = ValidationContext(MSG)
+            response = hl7validatorapi(MSG, context=context)
+        self.assertEqual(response["statusCode"], "Failed")
+        self.assertTrue(response["timedOut"])
+        self.assertTrue(response["message"].startswith("[Validation timed out]"))
+        self.assertEqual(response["hl7version"], "2.5")
+        self.assertIsInstance(response["details"], list)
+        # the context can still be rendered, and validated again without the budget
+        self.assertIsNone(context.deadline)
+        self.assertNotIn("timedOut", hl7validatorapi(MSG, context=context))
+
+    def test_timeout_is_not_cached_by_the_validator(self):
+        context = ValidationContext(MSG)
+        context.deadline = Deadline(-1)
+        with self.assertRaises(ValidationTimeout):
+            context.validate(context.parse())
+        context.deadline = None
+        self.assertIsNone(context.validate(context.parse().msh))
+
+    def test_limits(self):
+        with mock.patch.dict(app.config, MAX_MESSAGE_SIZE=20):
+            response = hl7validatorapi(MSG)
+        self.assertEqual(response["message"], f"[Message rejected] Message has {len(MSG)} characters, the limit is 20")
+        with mock.patch.dict(app.config, MAX_SEGMENTS=3):
+            response = hl7validatorapi(MSG)
+        self.assertEqual(response["statusCode"], "Failed")
+        self.assertEqual(response["message"], "[Message rejected] Message has 4 segments, the limit is 3")
+
+    def test_form_rejects_oversized_message_before_tokenizing(self):
+        client = app.test_client()
+        with mock.patch.dict(app.config, MAX_MESSAGE_SIZE=20), mock.patch("hl7validator.views.ValidationContext") as context:
+            response = client.post("/", data={"msg": MSG, "options": "hl7v2"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Message rejected", response.data)
+        context.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from hl7validator.api import ValidationContext, hl7validatorapi, render_message
+from hl7validator.details import DetailSet, parse_location, location_path
+from hl7validator.mllp import build_err
+
+MSG = (
+    "MSH|^~\\&|LAB|HCIS|EHR|HCIS|20240101000000||ADT^A01|42|P|2.5\r"
+    "EVN|A01\r"
+    "PID|||1^^^HCIS||DOE^JOHN||1970-01-01|M"
+)
+
+
+class TestDetails(unittest.TestCase):
+    def test_parse_location(self):
+        location = parse_location(" Value X not in table HL70396 in element OBX_17.CE_3\n")
+        self.assertEqual((location["segment"], location["field"], location["component"]), ("OBX", 17, 3))
+        self.assertEqual(location_path(parse_location(" Missing required child PID.PID_3\n")), "PID-3")
+        self.assertEqual(location_path(parse_location("Exceeded max length (50) of PID_5.XPN_1.FN_1")), "PID-5.1.1")
+        self.assertEqual(parse_location(" Invalid children detected for <Field EVN_5 (OPERATOR_ID) of type CN>: [None]")["field"], 5)
+        self.assertIsNone(location_path(parse_location(" Missing required child ADT_A01.NK1\n")))
+        self.assertIsNone(parse_location(" Child limit exceeded RDE_O01.RDE_O01_PATIENT\n"))
+        self.assertIsNone(parse_location("Message is not ASCII encoded"))
+        # datatype components are named like segment fields
+        self.assertIsNone(parse_location(" Missing required child XAD_1.SAD_1\n"))
+        self.assertIsNone(parse_location(" Child limit exceeded ORU_R01.CWE_1\n"))
+        self.assertEqual(location_path(parse_location(" Missing required child PID_11.XAD_1.SAD_1\n")), "PID-11.1.1")
+
+    def test_detail_set(self):
+        details = DetailSet(["MSH|", "OBX|1", "OBX|2", "PID|"])
+        self.assertTrue(details.add("Error", " Missing required child PID.PID_3\n"))
+        self.assertFalse(details.add("Error", " Missing required child PID.PID_3\n"))
+        details.add("Warning", " Value X not in table HL70078 in element OBX.OBX_8\n")
+        pid, obx = details.to_list()
+        self.assertEqual((pid["code"], pid["location"]["index"]), ("101", 3))
+        # two OBX segments, the report does not tell which one
+        self.assertEqual((obx["code"], obx["location"]["index"]), ("103", None))
+
+    def test_validation_details_are_located(self):
+        context = ValidationContext(MSG)
+        validation = hl7validatorapi(MSG, context=context)
+        missing = next(d for d in validation["details"] if "EVN.EVN_2" in d["message"])
+        self.assertEqual(missing["code"], "101")
+        self.assertEqual(missing["location"], {"segment": "EVN", "index": 1, "field": 2, "component": None, "subcomponent": None})
+
+        _, tree, validation = render_message(MSG, validation, context=context, lazy_tree=True)
+        invalid_date = next(d for d in validation["details"] if "PID.PID_7" in d["message"])
+        self.assertEqual((invalid_date["code"], invalid_date["location"]["index"]), ("102", 2))
+        self.assertIn('data-errors="[&quot;EVN-2&quot;]"', tree)
+        self.assertIn('data-errors="[&quot;PID-7&quot;]"', tree)
+
+    def test_err_uses_detail_code(self):
+        detail = {"level": "Error", "message": "Something else", "code": "103"}
+        self.assertEqual(build_err(detail, "2.5").split("|")[3], "103^Table value not found^HL70357")
+
+
+if __name__ == "__main__":
+    unittest.main()
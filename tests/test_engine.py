@@ -0,0 +1,70 @@
+import unittest
+from unittest import mock
+from hl7apy import validation as hl7apy_validation
+from hl7validator.api import ValidationContext, ValidationReport
+from hl7validator.engine import TreeValidator
+
+MESSAGES = [
+    # missing required fields, a value not in its table, a repeated segment and a z segment
+    "MSH|^~\\&|A|B|C|D|20240101||ADT^A01^ADT_A01|1|P|2.5\rEVN|A01\rPID|||1^^^X||DOE^J||19700101|X\r"
+    "PID|||2\rZXY|1|abc^def\rPV1||I|" + "W" * 100,
+    # z segment in an ORU with observations of a varies datatype
+    "MSH|^~\\&|LAB|HCIS|EHR|HCIS|20240101||ORU^R01^ORU_R01|2|P|2.5\rPID|||1^^^HCIS||DOE^JOHN\r"
+    "OBR|1||42|GLU^Glucose^LN\rOBX|1|NM|GLU||5.4|mg/dL\rOBX|2|CE|X||A^B^C^D^E^F^G|\rZZ1|a~b",
+    # a version without some references
+    "MSH|^~\\&|KIS||CommServer||200811111017||QRY^A19|ertyusdfg|P|2.2|\rQRD|200811111016|R|I|Q4412|||10|RD",
+]
+
+
+def hl7apy_problems(element):
+    """
+    What element.validate() reports and raises, the way validate_message used to call it
+    """
+    report = ValidationReport()
+    with mock.patch.object(hl7apy_validation, "open", lambda *args: args[0], create=True):
+        try:
+            element.validate(report_file=report)
+        except Exception as e:
+            return report.consume(), str(e)
+    return report.consume(), None
+
+
+def engine_problems(validator, element):
+    report = ValidationReport()
+    outcome = validator.collect(element)
+    if outcome.failure is not None:
+        return [], str(outcome.failure)
+    validator.write(outcome, report)
+    return report.consume(), outcome.errors[0] if outcome.errors else None
+
+
+class TestTreeValidator(unittest.TestCase):
+    def test_same_problems_as_hl7apy(self):
+        for msg in MESSAGES:
+            msg = ValidationContext(msg).parse()
+            validator = TreeValidator()
+            elements = [msg] + [el for seg in msg.children for el in [seg] + list(seg.children)]
+            for element in elements:
+                with self.subTest(element=repr(element)):
+                    self.assertEqual(engine_problems(validator, element), hl7apy_problems(element))
+
+    def test_elements_are_walked_once(self):
+        msg = ValidationContext(MESSAGES[0]).parse()
+        validator = TreeValidator()
+        validator.collect(msg)
+        walked = len(validator._results)
+        for seg in msg.children:
+            validator.collect(seg)
+            for child in seg.children:
+                validator.collect(child)
+        self.assertEqual(len(validator._results), walked)
+
+    def test_problems_are_not_raised(self):
+        outcome = TreeValidator().collect(ValidationContext(MESSAGES[0]).parse())
+        self.assertIsNone(outcome.failure)
+        self.assertIn("Missing required child EVN.EVN_2", outcome.errors)
+        self.assertIn("Value X not in table HL70001 in element PID.PID_8", outcome.warnings)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from contextlib import closing
+from unittest import mock
+from hl7validator import app
+from hl7validator.jobs import INSERT_CHUNK, JobRunner, JobStore
+from messages import VALID
+
+
+INVALID = "MSH|^~\\&|A|B|C|D|20240101||ADT^A01^ADT_A01|1|P|2.5\rPID|||1||DOE^J"
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = JobStore(os.path.join(self.tmp.name, "jobs", "jobs.sqlite3"))
+        patcher = mock.patch("hl7validator.views.job_store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_job_endpoints(self):
+        client = app.test_client()
+        response = client.post("/api/hl7/v1/jobs", json={"data": [VALID, INVALID, VALID]})
+        self.assertEqual(response.status_code, 202)
+        job = response.json
+        self.assertEqual((job["status"], job["total"], job["done"]), ("queued", 3, 0))
+        self.assertEqual(response.headers["Location"], f"/api/hl7/v1/jobs/{job['id']}")
+        self.assertEqual(client.get(f"/api/hl7/v1/jobs/{job['id']}/results").status_code, 409)
+
+        self.assertTrue(JobRunner(self.store, workers=1).run_once())
+        job = client.get(f"/api/hl7/v1/jobs/{job['id']}").json
+        self.assertEqual((job["status"], job["done"], job["failed"], job["progress"]), ("done", 3, 1, 1.0))
+
+        response = client.get(f"/api/hl7/v1/jobs/{job['id']}/results")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([(r["index"], r["statusCode"]) for r in results], [(0, "Success"), (1, "Failed"), (2, "Success")])
+
+        self.assertEqual(client.get("/api/hl7/v1/jobs/unknown").status_code, 404)
+        self.assertEqual(client.post("/api/hl7/v1/jobs", json={"data": VALID}).status_code, 400)
+
+    def test_file_upload(self):
+        client = app.test_client()
+        content = "FHS|^~\\&\nBHS|^~\\&\n" + VALID.replace("\r", "\r\n") + "\r\n" + INVALID.replace("\r", "\n") + "\nBTS|2\nFTS|1\n"
+        response = client.post(
+            "/api/hl7/v1/jobs",
+            data={"file": (io.BytesIO(content.encode()), "feed.hl7"), "validation_level": "strict"},
+            content_type="multipart/form-data",
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((response.json["total"], response.json["validation_level"]), (2, "strict"))
+
+        response = client.post(
+            "/api/hl7/v1/jobs",
+            data={"file": (io.BytesIO(content.encode()), "feed.hl7"), "encoding": "no-such-codec"},
+            content_type="multipart/form-data",
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_body_size_limits(self):
+        client = app.test_client()
+        with mock.patch.dict(app.config, {"MAX_CONTENT_LENGTH": len(VALID)}):
+            # only uploads get the stream limit
+            response = client.post(
+                "/api/hl7/v1/jobs",
+                data={"file": (io.BytesIO((VALID + "\r" + VALID).encode()), "feed.hl7")},
+                content_type="multipart/form-data",
+            )
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(client.post("/api/hl7/v1/jobs", json={"data": [VALID]}).status_code, 413)
+
+    def test_uploading_job_is_not_claimed(self):
+        claims = []
+
+        def items():
+            for _ in range(INSERT_CHUNK + 1):
+                yield VALID
+            # the messages written so far are committed, runners are not kept waiting
+            claims.append(self.store.claim("runner", lease=60))
+
+        job = self.store.create(items())
+        self.assertEqual(claims, [None])
+        self.assertEqual((job["status"], job["total"]), ("queued", INSERT_CHUNK + 1))
+        self.assertEqual(self.store.claim("runner", lease=60)[0], job["id"])
+
+        def broken():
+            yield VALID
+            raise ValueError("upload broke off")
+
+        with self.assertRaises(ValueError):
+            self.store.create(broken())
+        with closing(sqlite3.connect(self.store.path)) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM jobs").fetchone(), (1,))
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM messages").fetchone(), (INSERT_CHUNK + 1,))
+
+    def test_expired_lease_resumes_job(self):
+        job = self.store.create([VALID, INVALID, VALID])
+        # a runner that saved one result and was killed
+        self.assertEqual(self.store.claim("killed", lease=-1)[0], job["id"])
+        self.assertTrue(self.store.save(job["id"], "killed", -1, [(0, {"statusCode": "Success"})]))
+
+        runner = JobRunner(self.store, workers=1)
+        self.assertTrue(runner.run_once())
+        job = self.store.get(job["id"])
+        self.assertEqual((job["status"], job["done"], job["failed"]), ("done", 3, 1))
+        # the killed runner lost the job
+        self.assertFalse(self.store.save(job["id"], "killed", 60, [(1, {"statusCode": "Success"})]))
+        self.assertFalse(runner.run_once())
+
+    def test_stopped_runner_releases_job(self):
+        job = self.store.create([VALID, VALID])
+        runner = JobRunner(self.store, workers=1)
+        runner.stop()
+        self.assertTrue(runner.run_once())
+        self.assertEqual(self.store.get(job["id"])["status"], "queued")
+
+
+if __name__ == "__main__":
+    unittest.main()
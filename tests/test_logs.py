@@ -0,0 +1,68 @@
+import io
+import logging
+import threading
+import unittest
+from unittest import mock
+from hl7validator import app
+from hl7validator.logs import DroppingQueueHandler, log_message, queue_logging, truncate
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def emit(self, record):
+        self.threads.append((threading.current_thread(), record.getMessage()))
+
+
+class TestLogs(unittest.TestCase):
+    def test_truncate(self):
+        with mock.patch.dict(app.config, LOG_MESSAGE_MAX_LENGTH=10):
+            self.assertEqual(truncate("MSH|^~\\&|A|B|C"), "MSH|^~\\&|A... [4 more characters]")
+            self.assertEqual(truncate("MSH|^~\\&"), "MSH|^~\\&")
+        with mock.patch.dict(app.config, LOG_MESSAGE_MAX_LENGTH=0):
+            self.assertEqual(truncate("MSH|^~\\&|A|B|C"), "MSH|^~\\&|A|B|C")
+
+    def test_sampling(self):
+        with mock.patch.dict(app.config, LOG_MESSAGE_SAMPLE_RATE=0), mock.patch.object(app.logger, "log") as log:
+            log_message("message received", "MSH|^~\\&")
+        log.assert_not_called()
+
+    def test_records_written_by_background_thread(self):
+        logger = logging.getLogger("hl7validator.tests.queue")
+        logger.propagate = False
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        queued = queue_logging(logger, maxsize=10)
+        try:
+            self.assertEqual(logger.handlers, [queued])
+            logger.warning("segment %s", "PID")
+            queued.stop()
+            self.assertEqual(len(handler.threads), 1)
+            thread, message = handler.threads[0]
+            self.assertEqual(message, "segment PID")
+            self.assertIsNot(thread, threading.current_thread())
+        finally:
+            queued.stop()
+            logger.removeHandler(queued)
+
+    def test_full_queue_drops(self):
+        queued = DroppingQueueHandler(maxsize=1)
+        stream = io.StringIO()
+        logger = logging.getLogger("hl7validator.tests.dropping")
+        logger.propagate = False
+        logger.addHandler(queued)
+        try:
+            logger.warning("first")
+            logger.warning("second")
+            self.assertEqual(queued.dropped, 1)
+            queued.listen([logging.StreamHandler(stream)])
+            queued.stop()
+            self.assertEqual(stream.getvalue(), "first\n")
+        finally:
+            logger.removeHandler(queued)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+from hl7apy.exceptions import InvalidName
+from hl7validator.metadata import get_index
+
+
+class TestMetadataIndex(unittest.TestCase):
+    def test_field(self):
+        meta = get_index("2.5").field("PID", 7)
+        self.assertEqual(meta.name, "PID_7")
+        self.assertEqual(meta.long_name, "DATE_TIME_OF_BIRTH")
+        self.assertEqual(meta.datatype, "TS")
+        self.assertEqual(meta.children[0].datatype, "DTM")
+
+    def test_same_index_per_version(self):
+        self.assertIs(get_index("2.5"), get_index("2.5"))
+        self.assertIsNot(get_index("2.5"), get_index("2.4"))
+
+    def test_lookup_components(self):
+        index = get_index("2.5")
+        self.assertEqual(index.lookup("PID", 5, 1).long_name, "FAMILY_NAME")
+        self.assertEqual(index.lookup("PID", 3, 4, 1).table, "HL70300")
+        self.assertIsNone(index.lookup("PID", 8, 1))
+        self.assertIsNone(index.lookup("PID", 5, 99))
+
+    def test_invalid_name_raises_every_time(self):
+        index = get_index("2.5")
+        for _ in range(2):
+            with self.assertRaises(InvalidName):
+                index.field("PID", 999)
+        self.assertIsNone(index.lookup("PID", 999))
+
+
+if __name__ == "__main__":
+    unittest.main()
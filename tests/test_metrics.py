@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import unittest
+from hl7validator import app
+from hl7validator.cache import segment_cache
+from hl7validator import metrics
+from hl7validator.metrics import Registry, Timings, stage, start_request, finish_request
+from messages import VALID
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stage_outside_request(self):
+        with stage("parse") as timed:
+            pass
+        self.assertIsNone(timed.timings)
+        self.assertIsNone(finish_request("validate", 200))
+
+    def test_server_timing_header(self):
+        client = app.test_client()
+        response = client.post("/api/hl7/v1/validate/", json={"data": VALID})
+        self.assertEqual(response.status_code, 200)
+        stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+        for name in ("tokenize", "parse", "validate", "read_report", "structure", "total"):
+            self.assertIn(name, stages)
+
+        text = client.get("/metrics").get_data(as_text=True)
+        self.assertIn("# TYPE hl7validator_stage_duration_seconds histogram", text)
+        self.assertIn(
+            'hl7validator_stage_duration_seconds_bucket{stage="parse",version="2.4",message_type="ADT^A34",le="+Inf"}',
+            text,
+        )
+        self.assertIn('hl7validator_validations_total{version="2.4",message_type="ADT^A34",status="Success"}', text)
+        self.assertIn('hl7validator_cache_hits_total{cache="segment"}', text)
+
+    def test_workers_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            worker, scraper = Registry(directory), Registry(directory)
+            for registry in (worker, scraper):
+                start_request()
+                with stage("parse"):
+                    pass
+                timings, _ = finish_request("validate", 200)
+                registry.record(timings, "validate", 200)
+            worker.flush()
+            # a worker that exited is still counted
+            os.rename(worker.path(), os.path.join(directory, "metrics_1_exited.json"))
+            text = scraper.render()
+            self.assertIn('hl7validator_requests_total{endpoint="validate",status="200"} 2', text)
+            self.assertIn(
+                'hl7validator_stage_duration_seconds_count{stage="parse",version="none",message_type="none"} 2', text
+            )
+
+    def test_forked_worker_counts_on_its_own(self):
+        metrics.registry.inc("hl7validator_requests_total", (("endpoint", "validate"), ("status", "200")))
+        self.addCleanup(metrics.registry.reset)
+        segment_cache.hits += 5  # the warm-up of the preloaded gunicorn master
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                state = [metrics.registry.instance, metrics.registry.counters, segment_cache.hits]
+                os.write(write, json.dumps(state).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as f:
+            instance, counters, hits = json.load(f)
+        os.waitpid(pid, 0)
+        # a worker reusing the pid of one that exited writes a snapshot of its own
+        self.assertNotEqual(instance, metrics.registry.instance)
+        self.assertEqual((counters, hits), ({}, 0))
+
+    def test_buckets_are_cumulative(self):
+        registry = Registry()
+        timings = Timings()
+        timings.add("parse", 0.003)
+        registry.record(timings, "validate", 200)
+        text = registry.render()
+        self.assertIn('stage="parse",version="none",message_type="none",le="0.0025"} 0', text)
+        self.assertIn('stage="parse",version="none",message_type="none",le="0.005"} 1', text)
+        self.assertIn('stage="parse",version="none",message_type="none",le="+Inf"} 1', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+from hl7validator.mllp import MLLPServer, START_BLOCK, END_BLOCK, build_ack
+from messages import VALID as VALID_2_4
+
+
+VALID = VALID_2_4.replace("|P|2.4|", "|P|2.5|")
+INVALID = VALID.replace("EVN|A34|20190520144959", "EVN|A34").replace("24919117", "24919118")
+
+
+def segments(ack):
+    return {line.split("|")[0]: line.split("|") for line in ack.strip("\r").split("\r")}
+
+
+class TestMLLP(unittest.TestCase):
+    def test_ack_accept(self):
+        ack = segments(build_ack(VALID, {"statusCode": "Success", "message": "Valid", "details": [], "hl7version": "2.5"}))
+        self.assertEqual(ack["MSH"][2:6], ["PACS_HCIS", "HCIS", "MCDTS", "HCIS"])
+        self.assertEqual(ack["MSH"][8], "ACK^A34^ACK")
+        self.assertEqual(ack["MSA"][1:3], ["AA", "24919117"])
+        self.assertNotIn("ERR", ack)
+
+        # MSH-9.3 only exists from v2.3.1 on
+        older = VALID.replace("|P|2.5|", "|P|2.3|")
+        ack = segments(build_ack(older, {"statusCode": "Success", "message": "Valid", "details": [], "hl7version": "2.3"}))
+        self.assertEqual(ack["MSH"][8], "ACK^A34")
+
+    def test_ack_error(self):
+        validation = {
+            "statusCode": "Failed",
+            "message": "Not valid",
+            "details": [{"level": "Error", "message": " Missing required child EVN.EVN_2\n"}],
+            "hl7version": "2.5",
+        }
+        ack = segments(build_ack(VALID, validation))
+        self.assertEqual(ack["MSA"][1], "AE")
+        self.assertEqual(ack["ERR"][3], "101^Required field missing^HL70357")
+        self.assertEqual(ack["ERR"][8], "Missing required child EVN.EVN_2")
+
+    def test_ack_reject(self):
+        validation = {"statusCode": "Failed", "message": "[Error parsing message] No MSH9", "details": "", "hl7version": None}
+        ack = segments(build_ack("MSH|^~\\&|A|B|C|D|2019|||1|P|2.4", validation))
+        self.assertEqual(ack["MSA"][1:3], ["AR", "1"])
+        self.assertEqual(ack["ERR"][1], "^^^207&[Error parsing message] No MSH9&HL70357")
+
+
+class TestMLLPServer(unittest.IsolatedAsyncioTestCase):
+    async def test_pipelined_messages(self):
+        """
+        Pipelined messages on one connection are acknowledged in order
+        """
+        server = MLLPServer("127.0.0.1", 0)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            for msg in (VALID, INVALID, VALID):
+                writer.write(START_BLOCK + msg.encode() + END_BLOCK)
+            await writer.drain()
+            acks = []
+            for _ in range(3):
+                await reader.readuntil(START_BLOCK)
+                frame = await reader.readuntil(END_BLOCK)
+                acks.append(segments(frame[: -len(END_BLOCK)].decode()))
+            writer.close()
+            await writer.wait_closed()
+        finally:
+            await server.close()
+        self.assertEqual([a["MSA"][1:3] for a in acks], [["AA", "24919117"], ["AE", "24919118"], ["AA", "24919117"]])
+        self.assertIn("ERR", acks[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+import unittest
+
+LAZY_MODULES = ["pandas", "flasgger", "flask_babel"]
+
+
+class TestLazyImports(unittest.TestCase):
+    def loaded_after(self, code):
+        result = subprocess.run(
+            [sys.executable, "-c", code + "\nimport sys\nprint(' '.join(sys.modules))"],
+            capture_output=True,
+            text=True,
+            check=True,
+            env={**os.environ, "WARMUP": "false"},
+        )
+        return result.stdout.split()
+
+    def test_import_does_not_load_optional_subsystems(self):
+        modules = self.loaded_after("import hl7validator")
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_first_request_loads_extensions(self):
+        modules = self.loaded_after(
+            "from hl7validator import app\n"
+            "assert app.test_client().get('/apispec_1.json').status_code == 200"
+        )
+        self.assertIn("flasgger", modules)
+        self.assertIn("flask_babel", modules)
+        self.assertNotIn("pandas", modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
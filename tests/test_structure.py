@@ -0,0 +1,48 @@
+import unittest
+from hl7validator.api import hl7validatorapi
+from hl7validator.structure import compile_structure, find_structure
+
+ADT_A01 = "MSH|^~\\&|A|B|C|D|20240101||ADT^A01^ADT_A01|1|P|2.5\r{}"
+
+
+class TestStructure(unittest.TestCase):
+    def test_order(self):
+        automaton = compile_structure("2.5", "ADT_A01")
+        self.assertTrue(automaton.accepts("MSH EVN PID ZXY PV1".split()))
+        self.assertEqual(automaton.check("MSH PID EVN PV1".split()), ([(2, "EVN")], []))
+        self.assertEqual(automaton.check("MSH EVN PID PID PV1".split()), ([(3, "PID")], []))
+        self.assertEqual(automaton.check("MSH PV1".split()), ([], [(1, "EVN"), (1, "PID")]))
+
+    def test_groups(self):
+        automaton = compile_structure("2.5", "ORU_R01")
+        self.assertTrue(automaton.accepts("MSH PID PV1 ORC OBR NTE OBX NTE OBX OBR OBX PID OBR OBX".split()))
+        self.assertEqual(automaton.check("MSH PID OBX".split()), ([], [(2, "OBR")]))
+
+    def test_find_structure(self):
+        self.assertEqual(find_structure("2.5", "ADT", "A04"), "ADT_A01")
+        # v2.3 has no ADT_A05
+        self.assertEqual(find_structure("2.3", "ADT", "A31"), "ADT_A01")
+        self.assertEqual(find_structure("2.3", "ADT", "A34"), "ADT_A30")
+        self.assertEqual(find_structure("2.3", "ACK", "A01"), "ACK")
+        self.assertIsNone(find_structure("2.3", "XYZ", "A01"))
+        self.assertIsNone(compile_structure("2.3", "ADT_A05"))
+
+    def test_out_of_place_segment(self):
+        response = hl7validatorapi(ADT_A01.format("PID|||1||DOE^J\rEVN|A01|20240101\rPV1||I"))
+        self.assertEqual(response["statusCode"], "Failed")
+        detail = response["details"][0]
+        self.assertEqual(detail["message"], "Segment EVN at position 3 is out of place in message structure ADT_A01")
+        self.assertEqual(detail["code"], "100")
+        self.assertEqual(detail["location"]["index"], 2)
+
+    def test_old_version_without_structure(self):
+        msg = "MSH|^~\\&|A|B|C|D|20240101||ADT^A08|1|P|2.3\rEVN|A08|20240101\rPID|||1||DOE^J"
+        response = hl7validatorapi(msg)
+        self.assertEqual(
+            [d["message"] for d in response["details"]],
+            ["Missing required segment PV1 at the end of message structure ADT_A01"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
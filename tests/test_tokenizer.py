@@ -0,0 +1,42 @@
+import unittest
+from hl7validator.api import set_reference
+from hl7validator.tokenizer import Tokens
+
+MSG = "MSH|^~\\&|A|B|C|D|20240101||ADT^A01~X^Y|1|P|2.5\r\nPID|1||42^^^H||DOE^J\r\nZXY"
+
+
+class TestTokenizer(unittest.TestCase):
+    def test_segments(self):
+        tokens = Tokens(MSG)
+        self.assertEqual(list(tokens.lines), ["MSH|^~\\&|A|B|C|D|20240101||ADT^A01~X^Y|1|P|2.5", "PID|1||42^^^H||DOE^J", "ZXY"])
+        self.assertEqual(tokens.segment_ids(), ["MSH", "PID", "ZXY"])
+        self.assertEqual(tokens.normalized(), MSG.replace("\r\n", "\r"))
+
+    def test_normalized_is_not_copied(self):
+        msg = MSG.replace("\r\n", "\r")
+        self.assertIs(Tokens(msg).normalized(), msg)
+        self.assertEqual(Tokens("MSH|^~\\&|A").normalized(), "MSH|^~\\&|A\r")
+
+    def test_fields(self):
+        tokens = Tokens(MSG)
+        self.assertEqual(tokens.field(0, 1), "|")
+        self.assertEqual(tokens.field(0, 2), "^~\\&")
+        self.assertEqual(tokens.field(0, 12), "2.5")
+        self.assertEqual(tokens.field(1, 5), "DOE^J")
+        self.assertEqual(tokens.field(1, 30), "")
+        self.assertEqual(tokens.fields(1), "PID|1||42^^^H||DOE^J".split("|"))
+        self.assertEqual(tokens.components(0, 9), ["ADT", "A01"])
+        self.assertEqual(tokens.components(0, 9, repetition=1), ["X", "Y"])
+        self.assertEqual(tokens.repetitions(0, 9), ["ADT^A01", "X^Y"])
+
+    def test_delimiters_from_msh(self):
+        tokens = Tokens("MSH#*@\\$#A#B#C#D#20240101##ADT*A04#1#P#2.3.1\rEVN#A04\rPID#1##42*H\rPV1#1#I")
+        self.assertEqual(tokens.delimiters.field, "#")
+        self.assertEqual(tokens.delimiters.repetition, "@")
+        self.assertEqual(tokens.components(2, 3), ["42", "H"])
+        msg = tokens.normalized()
+        self.assertIn("#ADT*A04*ADT_A01#", set_reference(msg, "2.3.1", tokens))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from hl7validator import app
+from hl7validator.api import (
+    build_tree_structure,
+    highlight_message,
+    hl7validatorapi,
+    render_message,
+    segment_subtree,
+    ValidationContext,
+)
+
+MSG = "MSH|^~\\&|LAB|HCIS|EHR|HCIS|20240101000000||ORU^R01^ORU_R01|42|P|2.5\rPID|||1^^^HCIS||DOE^JOHN||19700101|M\rOBX|1|NM|GLU||5.4"
+
+
+class TestLazyTree(unittest.TestCase):
+    def test_lazy_tree_has_segment_headers_only(self):
+        context = ValidationContext(MSG)
+        validation = hl7validatorapi(MSG, context=context)
+        tree, _ = build_tree_structure(MSG, validation, context=context, lazy=True)
+        self.assertEqual(tree.count('class="tree-node segment-node"'), 3)
+        self.assertIn('data-segment="1"', tree)
+        self.assertIn('data-text="OBX|1|NM|GLU||5.4"', tree)
+        self.assertNotIn("field-node", tree)
+        self.assertNotIn("PID-5", tree)
+
+    def test_subtree_matches_eager_tree(self):
+        validation = hl7validatorapi(MSG)
+        tree, _ = build_tree_structure(MSG, validation)
+        subtree = segment_subtree(MSG, 1)
+        self.assertEqual((subtree["segment"], subtree["hl7version"]), ("PID", "2.5"))
+        name = subtree["fields"][1]
+        self.assertEqual((name["location"], name["value"]), ("PID-5", "DOE^JOHN"))
+        self.assertEqual(name["children"][0]["name"], "Family Name (FN)")
+        for field in subtree["fields"]:
+            self.assertIn(f'<span class="node-id">{field["location"]}</span>', tree)
+
+    def test_single_pass_matches_separate_views(self):
+        msg = MSG.replace("19700101", "1970-01-01")  # highlight adds a date error the tree flags
+        for lazy in (False, True):
+            context = ValidationContext(msg)
+            validation = hl7validatorapi(msg, context=context)
+            highlighted, validation = highlight_message(msg, validation, context=context)
+            tree, validation = build_tree_structure(msg, validation, context=context, lazy=lazy)
+
+            context = ValidationContext(msg)
+            validation = hl7validatorapi(msg, context=context)
+            self.assertEqual(render_message(msg, validation, context=context, lazy_tree=lazy),
+                             (highlighted, tree, validation))
+        tree, _ = build_tree_structure(msg, validation)
+        self.assertIn('<span class="node-id error">PID-7</span>', tree)
+
+    def test_endpoint(self):
+        client = app.test_client()
+        response = client.post("/api/hl7/v1/tree/segment", json={"data": MSG, "segment": 2, "errors": ["OBX-5"]})
+        self.assertEqual(response.status_code, 200)
+        subtree = response.json
+        fields = {f["location"]: f for f in subtree["fields"]}
+        self.assertTrue(fields["OBX-5"]["error"])
+        self.assertFalse(fields["OBX-2"]["error"])
+
+        # the tree view sends the segment line only
+        response = client.post(
+            "/api/hl7/v1/tree/segment",
+            json={"text": "OBX|1|NM|GLU||5.4", "segment": 2, "hl7version": "2.5", "errors": ["OBX-5"]},
+        )
+        self.assertEqual(response.json, subtree)
+        response = client.post("/api/hl7/v1/tree/segment", json={"text": "OBX|1|NM|GLU||5.4", "segment": 2})
+        self.assertEqual(response.status_code, 400)
+
+        response = client.post("/api/hl7/v1/tree/segment", json={"data": MSG, "segment": 3})
+        self.assertEqual(response.status_code, 404)
+        response = client.post("/api/hl7/v1/tree/segment", json={"data": MSG})
+        self.assertEqual(response.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import gc
+import sys
+import unittest
+from unittest import mock
+from hl7validator.cache import segment_cache
+from hl7validator.warmup import warm_up, VERSIONS
+
+
+class TestWarmUp(unittest.TestCase):
+    def test_versions(self):
+        self.assertEqual(VERSIONS[0], "2.1")
+        self.assertIn("2.8", VERSIONS)
+        self.assertLess(VERSIONS.index("2.3"), VERSIONS.index("2.3.1"))
+
+    def test_loads_references(self):
+        seconds = warm_up(["2.3.1", "2.7"], freeze=False)
+        self.assertGreater(seconds, 0)
+        self.assertIn("hl7apy.v2_3_1", sys.modules)
+        self.assertIn("hl7apy.v2_7", sys.modules)
+
+    def test_fills_segment_cache(self):
+        # workers inherit the rendered segments of the warm-up message
+        with mock.patch.object(segment_cache, "maxsize", 100):
+            segment_cache.clear()
+            warm_up(["2.5"], freeze=False)
+            self.assertEqual(segment_cache.stats()["size"], 4)
+            segment_cache.clear()
+
+    def test_freeze(self):
+        try:
+            warm_up(["2.5"])
+            self.assertGreater(gc.get_freeze_count(), 0)
+        finally:
+            gc.unfreeze()
+
+
+if __name__ == "__main__":
+    unittest.main()